@@ -0,0 +1,77 @@
+import time
+from collections import Counter
+from telegram import MessageEntity
+from telegram.constants import ChatType
+from telegram.ext.filters import MessageFilter
+
+
+class AddressedToBot(MessageFilter):
+    # Filter-level cheap reject: only private chats, @mentions of the bot and
+    # replies to the bot's own messages reach the ask handler. Everything
+    # else is dropped before any handler code, ACL or Supabase call runs.
+    def __init__(self, username):
+        super().__init__(name="AddressedToBot")
+        self.username = username.lower().lstrip("@")
+        self.mention = f"@{self.username}"
+        self.accepted = 0
+        self.rejected = 0
+
+    def filter(self, message):
+        if self._is_addressed(message):
+            self.accepted += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def _is_addressed(self, message):
+        if message.chat.type == ChatType.PRIVATE:
+            return True
+
+        replied = message.reply_to_message
+        if (
+            replied is not None
+            and replied.from_user is not None
+            and (replied.from_user.username or "").lower() == self.username
+        ):
+            return True
+
+        text = message.text or ""
+        if self.mention not in text.lower():
+            return False
+        for entity, value in message.parse_entities(
+            [MessageEntity.MENTION, MessageEntity.TEXT_MENTION]
+        ).items():
+            if entity.type == MessageEntity.TEXT_MENTION:
+                value = f"@{entity.user.username or ''}"
+            if value.lower() == self.mention:
+                return True
+        return False
+
+
+class AdmissionPipeline:
+    # Ordered admission stages, cheapest first. Each stage is a coroutine
+    # taking (update, context) and returning True to let the update through;
+    # a stage that rejects is responsible for replying to the user.
+    # `observe(stage name, seconds)`, if given, is called after each stage.
+    def __init__(self, stages, observe=None):
+        self.stages = stages
+        self.observe = observe
+        self.rejected = Counter()
+        self.admitted = 0
+
+    async def admit(self, update, context):
+        for name, stage in self.stages:
+            if self.observe is None:
+                admitted = await stage(update, context)
+            else:
+                started = time.perf_counter()
+                admitted = await stage(update, context)
+                self.observe(name, time.perf_counter() - started)
+            if not admitted:
+                self.rejected[name] += 1
+                return False
+        self.admitted += 1
+        return True
+
+    def stats(self):
+        return {"admitted": self.admitted, "rejected": dict(self.rejected)}
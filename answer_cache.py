@@ -0,0 +1,191 @@
+import re
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+from resolver import canonicalize
+
+# Letters and digits in any script, so "кетамин" is a word rather than
+# nothing at all
+WORD = re.compile(r"[^\W_]+(?:[-'][^\W_]+)*")
+
+# Words that don't change what is being asked, including the fillers people
+# put around dosing questions ("a normal dose of", "typical dosage for").
+# Question words, modals, "not" and "safe" stay: "when should I take X" and
+# "why should I take X" are different questions.
+STOP_WORDS = frozenset(
+    "a about an and any are as at be been could do does for from get give "
+    "hey hi i i'd i'm im in info into is it it's its just know let me my of "
+    "on or please pls psyai so some tell than that the their them then "
+    "there these they this to u us was we what what's whats "
+    "will with would you your normal typical usual common standard "
+    "average good recommended".split()
+)
+
+# Kept words that change a question's meaning however many other words two
+# questions share: a hit needs the same ones on both sides.
+DISTINGUISHING_WORDS = frozenset(
+    "how when why where which who much many can should safe not no never "
+    "without don't dont can't cannot isn't".split()
+)
+
+SYNONYMS = {
+    "dosage": "dose",
+    "dosing": "dose",
+    "dosed": "dose",
+    "doses": "dose",
+    "amount": "dose",
+    "combo": "combine",
+    "combination": "combine",
+    "combining": "combine",
+    "mix": "combine",
+    "mixing": "combine",
+    "interaction": "combine",
+    "effect": "effects",
+    "last": "duration",
+    "lasts": "duration",
+    "long": "duration",
+}
+
+
+def normalize_question(text, canonical_substance=None):
+    # The set of words that carry a question's meaning: lower-cased, stop
+    # words dropped, plurals and synonyms folded, and substance names put
+    # in canonical form ("2C-B" and "2cb" both become "2cb").
+    text = unicodedata.normalize("NFKC", text).lower().replace("’", "'")
+    tokens = set()
+    for word in WORD.findall(text):
+        if word in STOP_WORDS:
+            continue
+        if len(word) > 4 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        word = SYNONYMS.get(word, word)
+        substance = canonical_substance(word) if canonical_substance else None
+        tokens.add(substance or canonicalize(word) or word)
+    return frozenset(tokens)
+
+
+class AnswerCache:
+    # In-memory cache of ask-mode answers for near-duplicate questions.
+    # Each question is reduced to its normalized word set; a MinHash
+    # signature of that set, split into `bands` LSH bands, finds candidate
+    # questions that were asked before, and a candidate is a hit when the
+    # exact Jaccard similarity of the word sets reaches `threshold` and both
+    # have the same DISTINGUISHING_WORDS.
+    # Questions with fewer than `min_words` words ("MDMA?") say too little
+    # to be matched and are neither cached nor looked up. Entries
+    # expire after `ttl` seconds and the least recently used are evicted
+    # beyond `max_entries`.
+    def __init__(
+        self,
+        threshold=0.8,
+        ttl=6 * 3600,
+        max_entries=5000,
+        min_words=2,
+        num_perm=32,
+        bands=16,
+        canonical_substance=None,
+        clock=time.monotonic,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.min_words = min_words
+        self.rows = num_perm // bands
+        self.bands = bands
+        self.canonical_substance = canonical_substance
+        self.clock = clock
+        # (a * x + b) mod p permutations, fixed so signatures are stable
+        prime = (1 << 61) - 1
+        self.prime = prime
+        self.permutations = [
+            ((i * 0x9E3779B97F4A7C15 + 1) % prime, (i * 0xC2B2AE3D27D4EB4F + 7) % prime)
+            for i in range(1, num_perm + 1)
+        ]
+        self.entries = OrderedDict()  # id -> (model, words, bands, answer, created_at)
+        self.index = defaultdict(set)  # (model, band, band values) -> ids
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    def signature(self, words):
+        hashes = [hash(word) & 0xFFFFFFFFFFFFFFFF for word in words]
+        prime = self.prime
+        return [min((a * h + b) % prime for h in hashes) for a, b in self.permutations]
+
+    def _bands(self, model, words):
+        signature = self.signature(words)
+        rows = self.rows
+        return [
+            (model, band, tuple(signature[band * rows : (band + 1) * rows]))
+            for band in range(self.bands)
+        ]
+
+    def get(self, question, model):
+        words = normalize_question(question, self.canonical_substance)
+        if len(words) < self.min_words:
+            self.misses += 1
+            return None
+        candidates = set()
+        for key in self._bands(model, words):
+            candidates.update(self.index.get(key, ()))
+
+        now = self.clock()
+        best = None
+        best_similarity = self.threshold
+        distinguishing = words & DISTINGUISHING_WORDS
+        for entry_id in candidates:
+            _, stored, _, answer, created_at = self.entries[entry_id]
+            if created_at + self.ttl <= now:
+                self._remove(entry_id)
+                continue
+            if stored & DISTINGUISHING_WORDS != distinguishing:
+                continue
+            similarity = len(words & stored) / len(words | stored)
+            if similarity >= best_similarity:
+                best, best_similarity = entry_id, similarity
+        if best is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(best)
+        self.hits += 1
+        return self.entries[best][3]
+
+    def put(self, question, model, answer):
+        words = normalize_question(question, self.canonical_substance)
+        if len(words) < self.min_words:
+            return
+        bands = self._bands(model, words)
+        # A question asked again replaces the answer it had
+        for entry_id in set.intersection(*(self.index.get(key, set()) for key in bands)):
+            if self.entries[entry_id][1] == words:
+                self._remove(entry_id)
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (model, words, bands, answer, self.clock())
+        for key in bands:
+            self.index[key].add(entry_id)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, entry_id):
+        _, _, bands, _, _ = self.entries.pop(entry_id)
+        for key in bands:
+            ids = self.index[key]
+            ids.discard(entry_id)
+            if not ids:
+                del self.index[key]
+
+    def invalidate(self):
+        removed = len(self.entries)
+        self.entries.clear()
+        self.index.clear()
+        return removed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0,
+        }
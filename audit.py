@@ -0,0 +1,141 @@
+import asyncio
+import html
+import json
+import logging
+import logging.handlers
+import time
+import telegram
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+MAX_DIGEST_LENGTH = 4000
+
+
+class AuditDigest:
+    # Takes query audit events off the answer path. `record` only appends to
+    # a buffer; a background task flushes every `interval` seconds, or as
+    # soon as `batch_size` events are waiting, as digest messages to the
+    # admin chat and as lines in a rotating JSONL log. The log is opened by
+    # start(), so a worker process can point `log_path` at its own file
+    # first: processes sharing one would each rotate it.
+    def __init__(
+        self,
+        send,
+        admin_chat_id,
+        log_path=None,
+        interval=60,
+        batch_size=50,
+        max_log_bytes=10 * 1024 * 1024,
+        log_backups=5,
+    ):
+        self.send = send
+        self.admin_chat_id = admin_chat_id
+        self.interval = interval
+        self.batch_size = batch_size
+        self.events = []
+        self.full = asyncio.Event()
+        self.task = None
+        self.recorded = 0
+        self.digests = 0
+        self.log_path = log_path
+        self.max_log_bytes = max_log_bytes
+        self.log_backups = log_backups
+        self.log = None
+
+    def _open_log(self):
+        handler = logging.handlers.RotatingFileHandler(
+            self.log_path, maxBytes=self.max_log_bytes, backupCount=self.log_backups
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.log = logging.getLogger(f"psyai.audit.{self.log_path}")
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.log.addHandler(handler)
+
+    def record(self, kind, user_id, user_name, chat_id, chat_title, chat_desc, query):
+        self.events.append(
+            {
+                "ts": time.time(),
+                "kind": kind,
+                "user_id": user_id,
+                "user_name": user_name,
+                "chat_id": chat_id,
+                "chat_title": chat_title,
+                "chat_desc": chat_desc,
+                "query": query,
+            }
+        )
+        self.recorded += 1
+        if len(self.events) >= self.batch_size:
+            self.full.set()
+
+    def format_event(self, event):
+        verb = "asked for info on" if event["kind"] == "info" else "asked"
+        user = html.escape(event["user_name"] or str(event["user_id"]))
+        chat = html.escape(event["chat_title"] or "DM")
+        return (
+            f'• <a href="tg://user?id={event["user_id"]}">{user}</a> '
+            f'(id: {event["user_id"]}, chat: {event["chat_id"]} {chat}) '
+            f'{verb}: <code>{html.escape((event["query"] or "")[:1000])}</code>'
+        )
+
+    def render(self, events):
+        messages = []
+        current = f"<b>PsyAI digest</b> ({len(events)} queries)"
+        for event in events:
+            line = self.format_event(event)
+            if len(current) + len(line) + 1 > MAX_DIGEST_LENGTH:
+                messages.append(current)
+                current = line
+            else:
+                current += "\n" + line
+        messages.append(current)
+        return messages
+
+    def _write_log(self, events):
+        for event in events:
+            self.log.info(json.dumps(event, ensure_ascii=False))
+
+    async def flush(self):
+        events, self.events = self.events, []
+        self.full.clear()
+        if not events:
+            return
+        if self.log is not None:
+            try:
+                await asyncio.to_thread(self._write_log, events)
+            except Exception as error:
+                logger.error(f"Error writing audit log: {error}")
+        for text in self.render(events):
+            self.digests += 1
+            self.send(
+                chat_id=self.admin_chat_id,
+                text=text,
+                parse_mode=telegram.constants.ParseMode.HTML,
+                disable_web_page_preview=True,
+            )
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            # Shielded so stop() can't drop a batch that is half way out.
+            await asyncio.shield(self.flush())
+
+    def start(self):
+        if self.log is None and self.log_path:
+            self._open_log()
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
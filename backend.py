@@ -0,0 +1,106 @@
+import json
+import logging
+import httpx
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+
+class PsyAIClient:
+    # One pooled, keep-alive connection set shared by every handler so that
+    # many questions can be in flight without blocking the event loop.
+    def __init__(
+        self,
+        base_url,
+        pool_size=100,
+        keepalive=20,
+        connect_timeout=5.0,
+        read_timeout=120.0,
+    ):
+        self.base_url = base_url
+        self.limits = httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=keepalive
+        )
+        self.timeout = httpx.Timeout(
+            read_timeout, connect=connect_timeout, pool=connect_timeout
+        )
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, limits=self.limits, timeout=self.timeout
+            )
+        return self._client
+
+    async def post_and_parse(self, path: str, payload: dict, params: dict = None):
+        try:
+            response = await self.client.post(path, json=payload, params=params)
+            return {"data": response.json()}
+        except Exception as error:
+            logger.error(f"Error in post_and_parse: {error}")
+            return None
+
+    async def post_answer(self, path: str, payload: dict, params: dict = None):
+        # Like post_and_parse, but raises instead of returning an error body,
+        # so callers can tell a failing backend from an answer.
+        response = await self.client.post(path, json=payload, params=params)
+        response.raise_for_status()
+        data = response.json()
+        if not isinstance(data, dict) or "assistant" not in data:
+            raise ValueError(f"no answer in backend response: {str(data)[:200]}")
+        return {"data": data}
+
+    async def stream(self, path: str, payload: dict, params: dict = None):
+        # Yields answer text as it is generated. Accepts either server-sent
+        # events ("data: ..." lines, optionally JSON with an "assistant" or
+        # "delta" field, terminated by "[DONE]") or a plain chunked body.
+        params = {**(params or {}), "stream": "true"}
+        async with self.client.stream(
+            "POST", path, json=payload, params=params
+        ) as response:
+            response.raise_for_status()
+            if "text/event-stream" not in response.headers.get("content-type", ""):
+                async for text in response.aiter_text():
+                    if text:
+                        yield text
+                return
+
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:]
+                if data.startswith(" "):
+                    data = data[1:]
+                if data.strip() == "[DONE]":
+                    return
+                yield parse_stream_event(data)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+def build_prompt_payload(
+    query: str, model: str, temperature: float, tokens: int, drug: bool
+):
+    raw = (
+        {"question": f"{query}"}
+        if model == "gemini"
+        else {"question": query, "temperature": temperature, "tokens": tokens}
+    )
+    if drug:
+        raw["format"] = "html"
+        raw["drug"] = True
+    return raw
+
+
+def parse_stream_event(data: str):
+    try:
+        event = json.loads(data)
+    except ValueError:
+        return data
+    if isinstance(event, dict):
+        return event.get("delta") or event.get("assistant") or ""
+    return str(event)
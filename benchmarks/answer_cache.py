@@ -0,0 +1,120 @@
+"""Hit rate, wrong-answer rate and lookup cost of the ask-mode answer cache.
+
+Generates questions from paraphrase templates for a set of intents and
+substances, with greetings and punctuation added at random, asks them in
+random order against AnswerCache and against an exact-match cache on the
+lower-cased text, and counts hits, hits that returned the answer for a
+different intent or substance, and time per lookup. Some intents differ
+only in a question word, a negation or "safe", and some substance names
+are not in Latin script; exits with 1 on any wrong answer.
+
+    python benchmarks/answer_cache.py --questions 5000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from answer_cache import AnswerCache  # noqa: E402
+
+SUBSTANCES = [
+    ["2C-B", "2cb", "2c-b"],
+    ["2C-I", "2ci"],
+    ["MDMA", "molly", "mdma"],
+    ["LSD", "lsd", "acid"],
+    ["ketamine", "Ketamine", "ket"],
+    ["DMXE", "dmxe"],
+    ["3-FL-PCP", "3fl-pcp", "3-fl-pcp"],
+    ["psilocybin", "Psilocybin"],
+    ["tramadol", "Tramadol"],
+    ["GHB", "ghb"],
+    ["кетамин", "Кетамин"],
+    ["мефедрон", "Мефедрон"],
+    ["μεσκαλίνη", "Μεσκαλίνη"],
+]
+INTENTS = {
+    "dose": [
+        "what's a normal dose of {s}",
+        "{s} dosage?",
+        "What is the typical dosage for {s}",
+        "how much {s} should I take",
+        "{s} dose",
+    ],
+    "duration": [
+        "how long does {s} last",
+        "{s} duration",
+        "how long does {s} last?",
+        "what is the duration of {s}",
+    ],
+    "combine": [
+        "can I mix {s} with alcohol",
+        "{s} and alcohol combo",
+        "is it safe to combine {s} and alcohol?",
+    ],
+    "effects": [
+        "what are the effects of {s}",
+        "{s} effects",
+        "what does {s} feel like",
+    ],
+    # Pairs that share every other word with a different question
+    "when_to_take": ["when should I take {s}", "when should I take {s} tonight"],
+    "why_take": ["why should I take {s}", "why should I take {s} tonight"],
+    "sleep": ["what happens if I sleep on {s}", "what happens when I sleep on {s}"],
+    "no_sleep": [
+        "what happens if I do not sleep on {s}",
+        "what happens if I don't sleep on {s}",
+    ],
+    "safe_amount": ["how much {s} is safe", "how much {s} is safe to take"],
+    "too_much": ["how much {s} is too much", "how much {s} is too much to take"],
+}
+PREFIXES = ["", "", "hey ", "hi psyai, ", "quick question: ", "pls tell me "]
+SUFFIXES = ["", "", "?", "??", " please", " thanks"]
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    questions = []
+    for _ in range(args.questions):
+        substance = rng.randrange(len(SUBSTANCES))
+        intent = rng.choice(list(INTENTS))
+        text = rng.choice(INTENTS[intent]).format(s=rng.choice(SUBSTANCES[substance]))
+        text = rng.choice(PREFIXES) + text + rng.choice(SUFFIXES)
+        questions.append((text, (intent, substance)))
+
+    cache = AnswerCache(threshold=args.threshold)
+    exact = {}
+    exact_hits = 0
+    wrong = 0
+    elapsed = 0.0
+    for text, truth in questions:
+        start = time.perf_counter()
+        answer = cache.get(text, "openai")
+        elapsed += time.perf_counter() - start
+        if answer is None:
+            cache.put(text, "openai", truth)
+        elif answer != truth:
+            wrong += 1
+        key = text.lower()
+        if key in exact:
+            exact_hits += 1
+        else:
+            exact[key] = truth
+
+    stats = cache.stats()
+    print(f"{len(questions)} questions, {len(INTENTS) * len(SUBSTANCES)} distinct asks")
+    print(f"exact-text cache: hit rate {exact_hits / len(questions):.3f}")
+    print(f"answer cache:     hit rate {stats['hit_rate']:.3f}, wrong answers {wrong}, "
+          f"{stats['entries']} entries, {elapsed / len(questions) * 1e6:.1f}us per lookup")
+    sys.exit(1 if wrong else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", type=int, default=5000)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,189 @@
+"""BackendRouter against local stub backends with injected latency and faults.
+
+Starts two stub /prompt endpoints whose latency has a heavy tail, then runs
+the same load through a single route and through the router, with hedging.
+Then makes one endpoint fail and checks that its breaker opens and traffic
+moves to the other, that a consistently slower endpoint stops being picked,
+and that a stream falls back when its route is down.
+
+    python benchmarks/backend_hedging.py --requests 400 --latency 0.05 --tail 0.05
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import socket
+import sys
+import time
+from collections import Counter
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from backend import PsyAIClient, build_prompt_payload  # noqa: E402
+from routing import BackendRouter, CircuitBreaker, Route  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Stub:
+    # A /prompt endpoint: `latency` seconds per answer, `tail` of answers
+    # taking `tail_factor` times longer, and `failing` answering 500.
+    def __init__(self, name, latency, tail, tail_factor, seed):
+        self.name = name
+        self.latency = latency
+        self.tail = tail
+        self.tail_factor = tail_factor
+        self.failing = False
+        self.rng = random.Random(seed)
+        self.received = Counter()
+        self.port = free_port()
+        self.runner = None
+
+    async def prompt(self, request):
+        await request.json()
+        model = request.query.get("model")
+        self.received[model] += 1
+        if self.failing:
+            return web.Response(status=500)
+        delay = self.latency * self.rng.uniform(0.8, 1.2)
+        if self.rng.random() < self.tail:
+            delay *= self.tail_factor
+        if request.query.get("stream") == "true":
+            response = web.StreamResponse(headers={"Content-Type": "text/plain"})
+            await response.prepare(request)
+            for word in ("streamed ", "from ", self.name):
+                await asyncio.sleep(delay / 3)
+                await response.write(word.encode())
+            await response.write_eof()
+            return response
+        await asyncio.sleep(delay)
+        return web.json_response({"assistant": f"{model} answer from {self.name}"})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/prompt", self.prompt)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def payload_for(model):
+    return build_prompt_payload("what is a normal dose", model, 0.2, 3000, False)
+
+
+def make_router(clients, models=("openai",), hedge_budget=0.1, cooldown=30):
+    return BackendRouter(
+        [
+            Route(f"{name}/{model}", client, model, breaker=CircuitBreaker(cooldown=cooldown))
+            for name, client in clients.items()
+            for model in models
+        ],
+        hedge_budget=hedge_budget,
+    )
+
+
+async def load(router, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    answered = Counter()
+    errors = 0
+
+    async def one():
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                result = await router.post("/prompt", payload_for, "openai")
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+            answered[result["data"]["assistant"].rsplit(" ", 1)[-1]] += 1
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return latencies, answered, errors
+
+
+def report(label, latencies, answered, errors, router):
+    print(
+        f"{label:>22}: p50 {percentile(latencies, 0.5) * 1000:6.1f}ms "
+        f"p99 {percentile(latencies, 0.99) * 1000:7.1f}ms, answered by {dict(answered)}, "
+        f"errors {errors}, hedges {router.hedges} ({router.hedge_wins} won)"
+    )
+
+
+async def main(args):
+    logging.disable(logging.WARNING)  # the failure runs log every failed call
+    primary = Stub("primary", args.latency, args.tail, args.tail_factor, seed=1)
+    secondary = Stub("secondary", args.latency, args.tail, args.tail_factor, seed=2)
+    for stub in (primary, secondary):
+        await stub.start()
+    clients = {
+        stub.name: PsyAIClient(f"http://127.0.0.1:{stub.port}")
+        for stub in (primary, secondary)
+    }
+
+    try:
+        # Tail latency: one route vs two routes with hedging
+        single = make_router({"primary": clients["primary"]})
+        report("single route", *await load(single, args.requests, args.concurrency), single)
+        hedged = make_router(clients)
+        report("hedged (10% budget)", *await load(hedged, args.requests, args.concurrency), hedged)
+
+        # Failing endpoint: the breaker opens and traffic moves over
+        primary.failing = True
+        primary.received.clear()
+        failover = make_router(clients, cooldown=0.5)
+        latencies, answered, errors = await load(failover, args.requests // 2, args.concurrency)
+        report("primary failing", latencies, answered, errors, failover)
+        route = failover.routes[0]
+        print(f"{'':>24}primary breaker {route.breaker.state} after {route.breaker.trips} trip(s), "
+              f"{sum(primary.received.values())} calls reached it")
+        primary.failing = False
+        await asyncio.sleep(0.6)
+        await load(failover, args.concurrency, args.concurrency)
+        print(f"{'':>24}after recovery and cooldown: primary breaker {route.breaker.state}")
+
+        # A consistently slower endpoint stops being picked
+        primary.latency, primary.tail = args.latency * 3, 0
+        ranked = make_router(clients, hedge_budget=0)
+        latencies, answered, errors = await load(ranked, args.requests // 2, 1)
+        report("primary 3x slower", latencies, answered, errors, ranked)
+        primary.latency = args.latency
+
+        # Streams skip a route that fails before its first delta
+        primary.failing = True
+        streamed = make_router(clients, models=("openai", "gemini"))
+        text = "".join([delta async for delta in streamed.stream("/prompt", payload_for, "openai")])
+        print(f"{'stream, primary down':>22}: {text!r}")
+    finally:
+        for client in clients.values():
+            await client.close()
+        for stub in (primary, secondary):
+            await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--tail", type=float, default=0.05)
+    parser.add_argument("--tail-factor", type=float, default=10)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,126 @@
+"""Concurrent throughput of the PsyAI backend client against a local stub.
+
+Compares the old blocking ``requests.post`` path with the pooled async
+``PsyAIClient``. The stub answers every ``/prompt`` after a fixed delay to
+simulate LLM generation time.
+
+    python benchmarks/backend_throughput.py --requests 200 --latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend import PsyAIClient, build_prompt_payload  # noqa: E402
+
+
+async def start_stub(latency):
+    body = json.dumps({"assistant": "stub answer"}).encode()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                if length:
+                    await reader.readexactly(length)
+                await asyncio.sleep(latency)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                    + body
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0, backlog=1024)
+    port = server.sockets[0].getsockname()[1]
+    return server, f"http://127.0.0.1:{port}"
+
+
+def run_stub_in_thread(latency):
+    # The stub gets its own loop so the blocking client cannot starve it.
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    result = {}
+
+    async def serve():
+        result["server"], result["url"] = await start_stub(latency)
+        started.set()
+        await result["server"].serve_forever()
+
+    threading.Thread(
+        target=loop.run_until_complete, args=(serve(),), daemon=True
+    ).start()
+    started.wait()
+    return result["url"]
+
+
+async def run_blocking(base_url, n):
+    # What the handlers did before: a blocking call per question, so the
+    # event loop serves one question at a time no matter how many arrive.
+    def post_and_parse_url(url, payload):
+        response = requests.post(url, json=payload)
+        return {"data": response.json()}
+
+    async def one(i):
+        payload = build_prompt_payload(f"q{i}", "openai", 0.2, 3000, False)
+        return post_and_parse_url(f"{base_url}/prompt?model=openai", payload)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    return time.perf_counter() - start
+
+
+async def run_pooled(base_url, n, pool_size):
+    client = PsyAIClient(base_url, pool_size=pool_size, keepalive=pool_size)
+
+    async def one(i):
+        payload = build_prompt_payload(f"q{i}", "openai", 0.2, 3000, False)
+        return await client.post_and_parse("/prompt", payload, {"model": "openai"})
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(n)))
+    elapsed = time.perf_counter() - start
+    await client.close()
+    assert all(results), "pooled client returned an error"
+    return elapsed
+
+
+async def main(args):
+    base_url = run_stub_in_thread(args.latency)
+    blocking_n = min(args.requests, args.blocking_requests)
+    blocking = await run_blocking(base_url, blocking_n)
+    pooled = await run_pooled(base_url, args.requests, args.pool_size)
+
+    print(f"stub latency: {args.latency * 1000:.0f} ms")
+    print(
+        f"blocking requests.post : {blocking_n:5d} req in {blocking:7.2f}s "
+        f"-> {blocking_n / blocking:8.1f} req/s"
+    )
+    print(
+        f"pooled PsyAIClient     : {args.requests:5d} req in {pooled:7.2f}s "
+        f"-> {args.requests / pooled:8.1f} req/s (pool={args.pool_size})"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--blocking-requests", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--pool-size", type=int, default=100)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,128 @@
+"""Memory use of follow-up context per 100k active conversations.
+
+Fills ConversationStore with `--threads` conversations of `--turns` turns
+each (questions and answers of realistic length, built from an English-like
+vocabulary so compression isn't flattered), and compares the memory traced
+by tracemalloc with keeping the last turns as plain strings in deques.
+Also times add() and context(), and the prompt size a follow-up sends
+compared with pasting the whole previous answer.
+
+    python benchmarks/context_memory.py --threads 100000 --turns 3
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from conversations import ConversationStore  # noqa: E402
+
+WORDS = (
+    "the of and to a in is it you that dose effects onset duration hours minutes "
+    "common oral nasal threshold light strong heavy redose tolerance nausea anxiety "
+    "visuals euphoria stimulation sedation combine avoid alcohol benzodiazepines "
+    "opioids stimulants serotonin syndrome risk safer start low go slow test kit "
+    "reagent water hydration sleep set setting sitter trip comedown afterglow "
+    "body mind music friends dangerous interactions blood pressure heart rate "
+    "mg ug milligrams micrograms insufflated ingested smoked vaporized weight "
+    "factors individual sensitivity may vary always consult reliable sources"
+).split()
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def answer(rng):
+    return "\n".join(
+        " ".join(sentence(rng, rng.randint(8, 20)) for _ in range(3)) for _ in range(6)
+    )
+
+
+def traced(build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    holder = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return holder, current, elapsed
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    questions = [sentence(rng, rng.randint(5, 15)) + "?" for _ in range(500)]
+    answers = [answer(rng) for _ in range(200)]
+    print(f"average answer: {sum(map(len, answers)) // len(answers)} chars")
+
+    def turns(index):
+        for turn in range(args.turns):
+            yield questions[(index + turn) % len(questions)], answers[(index * 7 + turn) % len(answers)]
+
+    def key_of(index):
+        return (-1000000000000 - index % 5000, index % 7 or None, 100000000 + index)
+
+    def build_store():
+        store = ConversationStore(max_bytes=1 << 40)
+        for index in range(args.threads):
+            key = key_of(index)
+            for turn, (question, text) in enumerate(turns(index)):
+                store.add(key, question, text, [index * args.turns + turn])
+        return store
+
+    def build_naive():
+        naive = {}
+        for index in range(args.threads):
+            key = (-1000000000000 - index % 5000, index % 7 or None, 100000000 + index)
+            history = naive.setdefault(key, deque(maxlen=4))
+            for question, text in turns(index):
+                # fresh copies, as text arriving from the backend would be
+                history.append(("".join(question), "".join([text, ""])))
+        return naive
+
+    store, store_bytes, store_time = traced(build_store)
+    naive, naive_bytes, _ = traced(build_naive)
+    del naive
+    per = 100000 / args.threads
+    print(f"{args.threads} conversations x {args.turns} turns")
+    print(f"  plain deques:      {naive_bytes * per / 2**20:8.1f} MiB per 100k conversations")
+    print(f"  ConversationStore: {store_bytes * per / 2**20:8.1f} MiB per 100k conversations "
+          f"(its own estimate {store.bytes * per / 2**20:.1f} MiB)")
+    adds = args.threads * args.turns
+    print(f"  add: {store_time / adds * 1e6:.1f}us")
+
+    # A reply to the last answer of each conversation
+    keys = [
+        (key_of(index), (index + 1) * args.turns - 1)
+        for index in range(min(args.threads, 10000))
+    ]
+    start = time.perf_counter()
+    contexts = [store.context(key, reply_to) for key, reply_to in keys]
+    elapsed = time.perf_counter() - start
+    assert all(contexts), "a reply to a stored answer got no context"
+    print(f"  context: {elapsed / len(keys) * 1e6:.1f}us, "
+          f"{sum(map(len, contexts)) // len(contexts)} chars sent on a follow-up "
+          f"instead of {sum(map(len, answers)) // len(answers)}")
+
+    capped = ConversationStore(max_bytes=args.cap_mb << 20)
+    for index in range(args.threads):
+        for question, text in turns(index):
+            capped.add(index, question, text)
+    print(f"  with a {args.cap_mb} MiB cap: {capped.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=100000)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--cap-mb", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,120 @@
+"""Throughput and invariants of formatters.split_html on large answers.
+
+Generates random Telegram HTML (nested tags, entities, astral-plane emoji,
+long unbroken words) and checks every chunk against the invariants the
+Bot API cares about before timing the splitter on ~100 KB inputs.
+
+    python benchmarks/html_chunker.py --size 100000 --cases 500
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from html.parser import HTMLParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from formatters import MAX_MESSAGE_LENGTH, split_html, utf16_length  # noqa: E402
+
+WORDS = ["dose", "onset", "tolerance", "mg", "ketamine", "😀", "🧪", "naïve", "х"]
+TAGS = ["b", "i", "u", "s", "code", "a", "pre", "blockquote"]
+
+
+def random_html(size, rng):
+    out = []
+    stack = []
+    length = 0
+    while length < size:
+        roll = rng.random()
+        if roll < 0.08 and len(stack) < 4:
+            tag = rng.choice(TAGS)
+            if tag == "a":
+                out.append(f'<a href="https://example.org/{rng.randint(0, 99)}">')
+            else:
+                out.append(f"<{tag}>")
+            stack.append(tag)
+        elif roll < 0.16 and stack:
+            out.append(f"</{stack.pop()}>")
+        elif roll < 0.2:
+            out.append(rng.choice(["&amp;", "&lt;", "&gt;", "&quot;"]))
+        elif roll < 0.3:
+            out.append("\n")
+        elif roll < 0.31:
+            out.append("x" * rng.randint(50, 300))  # a word with nowhere to break
+        else:
+            out.append(rng.choice(WORDS) + " ")
+        length += len(out[-1])
+    out.extend(f"</{tag}>" for tag in reversed(stack))
+    return "".join(out)
+
+
+class Visible(HTMLParser):
+    # Telegram-style view of a chunk: the visible text, and whether every
+    # tag that was opened is closed in the same chunk.
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text = []
+        self.stack = []
+        self.balanced = True
+
+    def handle_starttag(self, tag, attrs):
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack.pop() != tag:
+            self.balanced = False
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+
+def visible(chunk):
+    parser = Visible()
+    parser.feed(chunk)
+    parser.close()
+    return "".join(parser.text), parser.balanced and not parser.stack
+
+
+def check(text, limit):
+    chunks = split_html(text, limit)
+    joined = []
+    for chunk in chunks:
+        shown, balanced = visible(chunk)
+        assert balanced, f"unbalanced chunk: {chunk[:200]!r}"
+        assert utf16_length(shown) <= limit, f"chunk of {utf16_length(shown)} units"
+        assert shown.strip(), "empty chunk"
+        joined.append(shown)
+    # Only whitespace at cuts may be dropped.
+    squash = lambda s: re.sub(r"\s+", "", s)  # noqa: E731
+    assert squash("".join(joined)) == squash(visible(text)[0]), "text lost or reordered"
+    return len(chunks)
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    for _ in range(args.cases):
+        text = random_html(rng.randint(1, 20000), rng)
+        check(text, rng.choice([50, 300, 1000, MAX_MESSAGE_LENGTH]))
+    print(f"{args.cases} random inputs: all chunks balanced, within limit, lossless")
+
+    text = random_html(args.size, rng)
+    check(text, MAX_MESSAGE_LENGTH)
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        chunks = split_html(text)
+    elapsed = (time.perf_counter() - start) / args.repeat
+    print(
+        f"{len(text) / 1000:.0f} KB -> {len(chunks)} chunks in {elapsed * 1000:.2f} ms "
+        f"({len(text) / elapsed / 1e6:.1f} MB/s)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100_000)
+    parser.add_argument("--cases", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=7)
+    main(parser.parse_args())
@@ -0,0 +1,81 @@
+"""Queue wait per tier under overload, with and without tier priority.
+
+Sends a mix of privileged, subscriber, trial and restricted requests at a
+rate above what a simulated backend can serve through LLMScheduler, then
+reports each tier's wait percentiles and how many requests were shed. The
+"fifo" run puts every request in the same tier, which is how the backend
+was shared before the scheduler.
+
+    python benchmarks/llm_scheduler.py --rate 40 --concurrency 8 --latency 0.3
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from scheduler import TIER_NAMES, TRIAL, LLMScheduler, Shed  # noqa: E402
+
+MIX = (0.05, 0.25, 0.5, 0.2)  # share of requests per tier
+
+
+async def run(args, prioritized):
+    rng = random.Random(args.seed)
+    scheduler = LLMScheduler(
+        max_concurrency=args.concurrency,
+        max_queue=args.max_queue,
+        deadline=args.deadline,
+    )
+    positions = []
+
+    async def backend():
+        await asyncio.sleep(rng.uniform(0.5, 1.5) * args.latency)
+
+    async def request(tier):
+        try:
+            await scheduler.run(
+                tier if prioritized else TRIAL, backend, on_queued=positions.append
+            )
+        except Shed:
+            pass
+
+    tasks = []
+    for _ in range(args.requests):
+        tier = rng.choices(range(len(TIER_NAMES)), MIX)[0]
+        tasks.append((tier, asyncio.ensure_future(request(tier))))
+        await asyncio.sleep(rng.expovariate(args.rate))
+    await asyncio.gather(*(task for _, task in tasks))
+    return scheduler, positions, [tier for tier, _ in tasks]
+
+
+async def main(args):
+    capacity = args.concurrency / args.latency
+    print(f"offered {args.rate}/s against ~{capacity:.0f}/s of backend capacity")
+    for prioritized in (False, True):
+        scheduler, positions, tiers = await run(args, prioritized)
+        print("tiered" if prioritized else "fifo")
+        print(f"  queued {len(positions)} times, deepest position {max(positions, default=0)}")
+        if not prioritized:
+            stats = scheduler.stats()["tiers"]["trial"]
+            print(f"  all tiers: wait p50 {stats['wait_p50']}s p95 {stats['wait_p95']}s, "
+                  f"shed {stats['shed']}")
+            continue
+        for name, stats in scheduler.stats()["tiers"].items():
+            print(f"  {name:>10}: {stats['admitted']:5} admitted, wait p50 "
+                  f"{stats['wait_p50']:6.3f}s p95 {stats['wait_p95']:6.3f}s "
+                  f"max {stats['wait_max']:6.3f}s, shed {stats['shed']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--max-queue", type=int, default=100)
+    parser.add_argument("--deadline", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,703 @@
+"""End-to-end load test of the bot against local stand-ins.
+
+Runs the real Application, handlers, admission pipeline, outbox and caches
+from psygptbot, long-polling a fake Bot API server, with a fake PsyAI
+/prompt backend (configurable latency, errors and streaming) and a fake
+Supabase REST endpoint for user_association, all on local ports. Replays a
+synthetic mix of group chatter, @mentions, follow-up replies, private
+questions and /info commands (or recorded updates, one Bot API update per
+JSON line) at a target rate with Poisson arrivals, then reports throughput,
+p50/p99 latency per handler as seen by the fake Bot API, the bot's own
+outcome counts, and outbound calls per service.
+
+Latency is measured from the moment an update is offered to getUpdates:
+"first" is the first reply to it (usually the thinking message), "answer"
+the last message or edit carrying its answer. The bot's tunables
+(OUTBOX_*, RATE_LIMIT_*, LLM_*, ...) are read from the environment as usual.
+
+    python benchmarks/load_test.py --rate 30 --duration 30 --backend-latency 0.8
+    python benchmarks/load_test.py --rate 30 --stream --json results.json --max-p99 10
+    python benchmarks/load_test.py --replay updates.jsonl --rate 20
+"""
+import argparse
+import asyncio
+import base64
+import importlib
+import json
+import logging
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOKEN = "123456:load-test"
+BOT_ID = 123456
+BOT_USERNAME = "psyai_load_bot"
+ADMIN_ID = 1
+# Share of synthetic users that already have a Supabase row; the rest are
+# created on their first question
+KNOWN_SHARE = 0.8
+THINKING = "One moment, PsyAI is thinking..."
+
+QUESTIONS = [
+    "what is the onset of oral ketamine",
+    "how long does lsd last",
+    "is it safe to mix mdma and alcohol",
+    "what is a common dose of psilocybin mushrooms",
+    "how long should i wait between mdma sessions",
+    "can i take 2c-b with an ssri",
+    "what does a reagent test kit tell me",
+    "how do i help a friend having a bad trip",
+    "is kratom addictive",
+    "what are the risks of combining opioids and benzodiazepines",
+    "how much water should i drink on mdma",
+    "does tolerance to lsd build quickly",
+    "what is the duration of dmt when smoked",
+    "how do i dose ketamine nasally",
+    "what is serotonin syndrome",
+    "can i drive the day after taking mushrooms",
+    "how long does mescaline take to kick in",
+    "is it dangerous to redose 2c-b",
+    "what should i do if someone overdoses on ghb",
+    "how do i test for fentanyl",
+]
+PREFIXES = ["", "", "", "hey ", "quick question: ", "hi, ", "yo "]
+FOLLOWUPS = [
+    "and what about redosing?",
+    "how long until it wears off?",
+    "is that different for first timers?",
+    "what if i weigh less than average?",
+]
+SUBSTANCES = [
+    "ketamine", "lsd", "mdma", "psilocybin", "2c-b", "dmt", "mescaline",
+    "kratom", "dmxe", "fxe", "3-fl-pcp", "ghb", "cocaine", "alprazolam",
+]
+CHATTER = [
+    "lol", "anyone around?", "good morning everyone", "that's wild",
+    "did anyone see the new thread", "thanks for the info", "brb",
+    "has anyone tried the new reagent kits", "stay safe out there",
+]
+WORDS = (
+    "dose onset duration hours minutes common oral nasal threshold light strong "
+    "redose tolerance nausea anxiety visuals euphoria combine avoid alcohol risk "
+    "start low go slow test kit reagent hydration sleep set setting sitter"
+).split()
+DEFAULT_MIX = "chatter=70,mention=14,followup=3,private=3,info=10"
+HANDLERS = {
+    "chatter": None, "mention": "ask", "followup": "ask", "private": "ask", "info": "info",
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def histogram_percentile(buckets, series, fraction):
+    # Linear interpolation inside the bucket holding the percentile, as
+    # Prometheus' histogram_quantile does
+    total = sum(series[:-1])
+    if not total:
+        return math.nan
+    rank = fraction * total
+    seen = 0
+    lower = 0.0
+    for bound, count in zip(buckets + (math.inf,), series):
+        if count and seen + count >= rank:
+            if bound == math.inf:
+                return lower
+            return lower + (bound - lower) * (rank - seen) / count
+        seen += count
+        lower = bound
+    return lower
+
+
+def param(params, name):
+    # Bot API parameters arrive form-encoded, with objects as JSON text
+    value = params.get(name)
+    if isinstance(value, str) and value[:1] in "{[":
+        return json.loads(value)
+    return value
+
+
+def ok(result):
+    return web.json_response({"ok": True, "result": result})
+
+
+class FakeTelegram:
+    # The Bot API methods the bot uses. Updates are handed out by long-polled
+    # getUpdates; each reply is matched to the update it answers through
+    # reply_parameters, and edits through the message they edit.
+    def __init__(self, latency):
+        self.latency = latency
+        self.me = {
+            "id": BOT_ID, "is_bot": True, "first_name": "PsyAI", "username": BOT_USERNAME,
+        }
+        self.pending = []
+        self.arrived = asyncio.Event()
+        self.calls = Counter()
+        self.offered = {}  # (chat id, message id) -> time offered to getUpdates
+        self.first = {}  # (chat id, message id) -> time of the first reply
+        self.answered = {}  # (chat id, message id) -> time of the last answer text
+        self.origin = {}  # (chat id, bot message id) -> (chat id, message id)
+        self.message_ids = iter(range(10**9, 2 * 10**9))
+        self.app = web.Application(client_max_size=16 << 20)
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    def offer(self, update):
+        message = update.get("message") or {}
+        if message:
+            self.offered[(message["chat"]["id"], message["message_id"])] = time.perf_counter()
+        self.pending.append(update)
+        self.arrived.set()
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return ok(await self.get_updates(params))
+        if method == "getMe":
+            return ok(self.me)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ("sendMessage", "editMessageText"):
+            return ok(self.message(method, params))
+        return ok(True)
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        self.pending = [update for update in self.pending if update["update_id"] >= offset]
+        if not self.pending:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[: int(params.get("limit") or 100)]
+
+    def message(self, method, params):
+        now = time.perf_counter()
+        chat_id = int(param(params, "chat_id"))
+        text = param(params, "text") or ""
+        if method == "sendMessage":
+            message_id = next(self.message_ids)
+            reply = param(params, "reply_parameters") or {}
+            replied = param(params, "reply_to_message_id") or reply.get("message_id")
+            origin = (chat_id, int(replied)) if replied else None
+            if origin is not None:
+                self.origin[(chat_id, message_id)] = origin
+        else:
+            message_id = int(param(params, "message_id"))
+            origin = self.origin.get((chat_id, message_id))
+        if origin is not None:
+            self.first.setdefault(origin, now)
+            if not text.startswith(THINKING):
+                self.answered[origin] = now
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": self.me,
+            "text": text,
+        }
+
+
+class FakeBackend:
+    # PsyAI's /prompt: a lognormal delay around `latency` seconds, then the
+    # whole answer, or with ?stream=true the answer as server-sent events
+    # spread over the same delay.
+    def __init__(self, latency, jitter, error_rate, answer_chars, chunks, rng):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.answer_chars = answer_chars
+        self.chunks = chunks
+        self.rng = rng
+        self.calls = Counter()
+        self.app = web.Application()
+        self.app.router.add_post("/prompt", self.prompt)
+
+    def delay(self):
+        if not self.latency:
+            return 0
+        return self.rng.lognormvariate(math.log(self.latency), self.jitter)
+
+    def answer(self, payload):
+        rng = random.Random(f"{payload.get('question')}|{payload.get('drug')}")
+        words = []
+        length = 0
+        while length < self.answer_chars:
+            word = rng.choice(WORDS)
+            words.append(word)
+            length += len(word) + 1
+        sentences = [" ".join(words[i:i + 12]).capitalize() + "." for i in range(0, len(words), 12)]
+        if payload.get("drug"):
+            return "<b>Dose card</b>\n" + "\n".join(f"• {s}" for s in sentences)
+        return "\n\n".join(
+            " ".join(sentences[i:i + 4]) for i in range(0, len(sentences), 4)
+        )
+
+    async def prompt(self, request):
+        payload = await request.json()
+        stream = request.query.get("stream") == "true"
+        self.calls["stream" if stream else "prompt"] += 1
+        delay = self.delay()
+        if self.rng.random() < self.error_rate:
+            self.calls["errors"] += 1
+            await asyncio.sleep(delay / 2)
+            return web.json_response({"detail": "overloaded"}, status=503)
+        text = self.answer(payload)
+        if not stream:
+            await asyncio.sleep(delay)
+            return web.json_response({"assistant": text})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        step = max(1, len(text) // self.chunks)
+        for start in range(0, len(text), step):
+            await asyncio.sleep(delay / self.chunks)
+            event = json.dumps({"delta": text[start:start + step]})
+            await response.write(f"data: {event}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class FakeSupabase:
+    # PostgREST's /rest/v1/user_association for the select, upsert and
+    # update calls the bot makes, and the trial ledger's
+    # consume_trial_prompts RPC, over rows held in memory.
+    def __init__(self, latency):
+        self.latency = latency
+        self.rows = {}
+        self.calls = Counter()
+        self.app = web.Application()
+        self.app.router.add_route("*", "/rest/v1/user_association", self.handle)
+        self.app.router.add_post("/rest/v1/rpc/consume_trial_prompts", self.consume)
+
+    def matching(self, query):
+        condition = query.get("telegram_id", "")
+        if condition.startswith("eq."):
+            ids = [int(condition[3:])]
+        elif condition.startswith("in.("):
+            ids = [int(value) for value in condition[4:-1].split(",") if value]
+        else:
+            return []
+        return [self.rows[telegram_id] for telegram_id in ids if telegram_id in self.rows]
+
+    async def handle(self, request):
+        self.calls[request.method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.method == "GET":
+            rows = self.matching(request.query)
+            return web.json_response(rows[: int(request.query.get("limit", len(rows) or 1))])
+        body = await request.json()
+        if request.method == "POST":
+            rows = body if isinstance(body, list) else [body]
+            for row in rows:
+                self.rows.setdefault(int(row["telegram_id"]), dict(row))
+            return web.json_response([self.rows[int(row["telegram_id"])] for row in rows])
+        if request.method == "PATCH":
+            rows = self.matching(request.query)
+            for row in rows:
+                row.update(body)
+            return web.json_response(rows)
+        return web.json_response([])
+
+    async def consume(self, request):
+        self.calls["RPC"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        body = await request.json()
+        for telegram_id, amount in zip(body["telegram_ids"], body["amounts"]):
+            row = self.rows.get(int(telegram_id))
+            if row is not None:
+                row["trial_prompts"] = max(row["trial_prompts"] - amount, 0)
+        return web.json_response(None)
+
+
+def group_ids(args):
+    # The first four are the privileged, beta, restricted and limited groups
+    return [-1001000000000 - index for index in range(max(args.groups, 4))]
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in HANDLERS:
+            raise SystemExit(f"unknown kind in --mix: {kind!r}")
+        weights[kind.strip()] = float(weight)
+    return weights
+
+
+def synthetic_updates(args, rng):
+    # Endless (kind, update) pairs; groups and users are drawn with a skew so
+    # a few busy chats and regulars dominate, as in the real groups
+    weights = parse_mix(args.mix)
+    kinds = list(weights)
+    groups = group_ids(args)
+    users = [200000000 + index for index in range(args.users)]
+    message_ids = Counter()
+    while True:
+        kind = rng.choices(kinds, [weights[k] for k in kinds])[0]
+        user_id = users[int(len(users) * rng.random() ** 1.5)]
+        user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        if kind == "private":
+            chat = {"id": user_id, "type": "private", "first_name": user["first_name"]}
+        else:
+            group = groups[int(len(groups) * rng.random() ** args.group_skew)]
+            chat = {"id": group, "type": "supergroup", "title": f"Group {-group % 1000}"}
+        message_ids[chat["id"]] += 1
+        message = {
+            "message_id": message_ids[chat["id"]],
+            "date": int(time.time()),
+            "chat": chat,
+            "from": user,
+        }
+        if kind == "chatter":
+            message["text"] = rng.choice(CHATTER)
+        elif kind == "info":
+            text = f"/info {rng.choice(SUBSTANCES)}"
+            message["text"] = text
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": 5}]
+        elif kind == "followup":
+            message["text"] = rng.choice(FOLLOWUPS)
+            message["reply_to_message"] = {
+                "message_id": 10**9 - message_ids[chat["id"]],
+                "date": int(time.time()),
+                "chat": chat,
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "PsyAI",
+                         "username": BOT_USERNAME},
+                "text": "Earlier answer. " + " ".join(rng.choice(WORDS) for _ in range(60)),
+            }
+        else:
+            question = rng.choice(PREFIXES) + rng.choice(QUESTIONS)
+            if kind == "private":
+                message["text"] = question
+            else:
+                message["text"] = f"@{BOT_USERNAME} {question}"
+                message["entities"] = [
+                    {"type": "mention", "offset": 0, "length": len(BOT_USERNAME) + 1}
+                ]
+        yield kind, {"message": message}
+
+
+def classify(update):
+    message = update.get("message") or {}
+    text = message.get("text") or ""
+    if text.startswith("/info"):
+        return "info"
+    replied = message.get("reply_to_message") or {}
+    if (
+        message.get("chat", {}).get("type") == "private"
+        or f"@{BOT_USERNAME}" in text.lower()
+        or (replied.get("from") or {}).get("id") == BOT_ID
+    ):
+        return "mention"
+    return "chatter"
+
+
+def recorded_updates(path):
+    # Recorded updates name the recording bot; they are replayed as if they
+    # had been sent to this one
+    with open(path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    for update in lines:
+        update.pop("update_id", None)
+        message = update.get("message") or {}
+        if message.get("text"):
+            username = os.getenv("REPLAY_BOT_USERNAME")
+            if username:
+                message["text"] = message["text"].replace(f"@{username}", f"@{BOT_USERNAME}")
+            replied = message.get("reply_to_message") or {}
+            if (replied.get("from") or {}).get("is_bot"):
+                replied["from"] = {"id": BOT_ID, "is_bot": True, "first_name": "PsyAI",
+                                   "username": BOT_USERNAME}
+        yield classify(update), update
+
+
+def configure(args, workdir, ports, groups):
+    # Everything that points the bot at the stand-ins, before it is imported
+    os.environ.update({
+        "TELETOKEN": TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{ports['telegram']}",
+        "BASE_URL_BETA": f"http://127.0.0.1:{ports['backend']}",
+        "BASE_URL": f"http://127.0.0.1:{ports['backend']}",
+        "SUPABASE_URL": f"http://127.0.0.1:{ports['supabase']}",
+        "SUPABASE_KEY": "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.load-test",
+        "BOT_USERNAME": BOT_USERNAME,
+        "BOT_GREETING_MSG": base64.b64encode(b"Hi!").decode(),
+        "ADMIN_TELEGRAM_ID": str(ADMIN_ID),
+        "RESTRICTED_USER_IDS": "2",
+        "PRIVILEGED_USER_IDS": "3",
+        "BETA_TESTER_USERS": "4",
+        "RESTRICTED_GROUP_IDS": str(groups[2]),
+        "LIMITED_GROUP_IDS": str(groups[3]),
+        "PRIVILEGED_GROUPS": str(groups[0]),
+        "BETA_TESTER_GROUPS": str(groups[1]),
+        "DOWNTIME": "0",
+        "FREEMODE": str(int(args.freemode)),
+        "STREAM_ANSWERS": str(int(args.stream)),
+        "WEBHOOK_URL": "",
+        "METRICS_PORT": "0",
+        "WORKERS": "1",
+        "STATE_BACKEND": "local",
+        "STATE_PATH": os.path.join(workdir, "state.sqlite3"),
+        "BROADCAST_STATE_PATH": os.path.join(workdir, "broadcasts.sqlite3"),
+        "PURGE_STATE_PATH": os.path.join(workdir, "purges.sqlite3"),
+        "INFO_CACHE_PATH": os.path.join(workdir, "info_cards.sqlite3"),
+        "AUDIT_LOG_PATH": os.path.join(workdir, "audit.jsonl"),
+        "PROFILE_DIR": os.path.join(workdir, "profiles"),
+    })
+
+
+async def start_site(app, port):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def handled(bot):
+    counts = Counter()
+    for (handler, _, _), value in bot.request_total.values.items():
+        counts[handler] += value
+    return counts
+
+
+async def drive(fake, source, args, rng, sent):
+    started = time.perf_counter()
+    due = started
+    update_id = 1
+    for kind, update in source:
+        now = time.perf_counter()
+        if now - started >= args.duration:
+            break
+        due += rng.expovariate(args.rate)
+        if due > now:
+            await asyncio.sleep(due - now)
+        update["update_id"] = update_id
+        update_id += 1
+        message = update.get("message") or {}
+        if message:
+            sent[kind].append((message["chat"]["id"], message["message_id"]))
+        fake.offer(update)
+    return time.perf_counter() - started
+
+
+async def drain(bot, expected, timeout):
+    # Until every handled update was answered and the outbox is empty
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        counts = handled(bot)
+        outbox = bot.outbox.stats()
+        if (
+            all(counts[handler] >= count for handler, count in expected.items())
+            and not outbox["queued"]
+            and not bot.outbox.inflight
+        ):
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+def report(args, fake, backend, supabase, bot, sent, elapsed, drained):
+    # Throughput is over the time from the first update to the last answer
+    window = max(
+        max(fake.answered.values(), default=0) - min(fake.offered.values(), default=0),
+        elapsed,
+    )
+    results = {"seconds": window, "sent": {}, "handlers": {}, "outcomes": {}, "outbound": {}}
+    total = sum(len(keys) for keys in sent.values())
+    print(f"offered {total} updates in {elapsed:.1f}s ({total / elapsed:.1f}/s), "
+          f"last answer after {window:.1f}s"
+          + ("" if drained else ", not drained before --drain"))
+    print("  " + ", ".join(f"{kind} {len(keys)}" for kind, keys in sent.items()))
+    results["sent"] = {kind: len(keys) for kind, keys in sent.items()}
+
+    print("\nlatency from offer to reply (fake Bot API):")
+    by_handler = {}
+    for kind, keys in sent.items():
+        by_handler.setdefault(HANDLERS[kind], []).extend(keys)
+    for handler, keys in sorted(by_handler.items(), key=lambda item: str(item[0])):
+        if not keys:
+            continue
+        if handler is None:
+            replied = sum(1 for key in keys if key in fake.first)
+            print(f"  chatter: {len(keys)} updates, {replied} replied to")
+            results["handlers"]["chatter"] = {"updates": len(keys), "replied": replied}
+            continue
+        first = [fake.first[key] - fake.offered[key] for key in keys if key in fake.first]
+        answer = [fake.answered[key] - fake.offered[key] for key in keys if key in fake.answered]
+        stats = {
+            "updates": len(keys),
+            "answered": len(answer),
+            "throughput": len(answer) / window,
+            "first_p50": percentile(first, 0.5),
+            "first_p99": percentile(first, 0.99),
+            "answer_p50": percentile(answer, 0.5),
+            "answer_p99": percentile(answer, 0.99),
+        }
+        results["handlers"][handler] = stats
+        if not answer:
+            print(f"  {handler}: {len(keys)} updates, none answered")
+            continue
+        print(f"  {handler}: {len(keys)} updates, {len(answer)} answered "
+              f"({stats['throughput']:.1f}/s), first reply p50 {stats['first_p50']:.3f}s "
+              f"p99 {stats['first_p99']:.3f}s, answer p50 {stats['answer_p50']:.3f}s "
+              f"p99 {stats['answer_p99']:.3f}s")
+
+    print("\nbot outcomes (psyai_requests_total, psyai_request_seconds):")
+    for (handler, outcome), series in sorted(bot.request_seconds.series.items()):
+        count = sum(series[:-1])
+        p50 = histogram_percentile(bot.request_seconds.buckets, series, 0.5)
+        p99 = histogram_percentile(bot.request_seconds.buckets, series, 0.99)
+        results["outcomes"][f"{handler}/{outcome}"] = {"count": count, "p50": p50, "p99": p99}
+        print(f"  {handler:5} {outcome:9} {count:6}  p50 {p50:.3f}s  p99 {p99:.3f}s")
+
+    outbound = {
+        "telegram": dict(fake.calls),
+        "backend": dict(backend.calls),
+        "supabase": dict(supabase.calls),
+    }
+    results["outbound"] = outbound
+    print("\noutbound calls:")
+    for service, calls in outbound.items():
+        calls = ", ".join(f"{name} {count}" for name, count in sorted(calls.items()))
+        print(f"  {service}: {calls or 'none'}")
+    outbox = bot.outbox.stats()
+    print(f"  outbox: {outbox}")
+    tiers = bot.llm_scheduler.stats()["tiers"]
+    print("  llm scheduler: " + ", ".join(
+        f"{tier} {stats['admitted']} admitted, {sum(stats['shed'].values())} shed, "
+        f"wait p95 {stats['wait_p95']:.2f}s"
+        for tier, stats in tiers.items()
+    ))
+    results["outbox"] = outbox
+    return results
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="psyai-load-")
+    ports = {name: free_port() for name in ("telegram", "backend", "supabase")}
+    configure(args, workdir, ports, group_ids(args))
+
+    fake = FakeTelegram(args.telegram_latency)
+    backend = FakeBackend(
+        args.backend_latency, args.backend_jitter, args.backend_errors,
+        args.answer_chars, args.stream_chunks, random.Random(args.seed + 1),
+    )
+    supabase = FakeSupabase(args.supabase_latency)
+    for index in range(args.users):
+        if rng.random() < KNOWN_SHARE:
+            telegram_id = 200000000 + index
+            supabase.rows[telegram_id] = {
+                "telegram_id": telegram_id,
+                "trial_prompts": 5,
+                "subscription_status": rng.random() < args.subscribers,
+                "stripe_id": "placeholder",
+            }
+    runners = [
+        await start_site(fake.app, ports["telegram"]),
+        await start_site(backend.app, ports["backend"]),
+        await start_site(supabase.app, ports["supabase"]),
+    ]
+
+    bot = importlib.import_module("psygptbot")
+    if not args.verbose:
+        logging.getLogger("PsyAI Log 🤖").setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        logging.getLogger("telegram").setLevel(logging.WARNING)
+    application = bot.build_application()
+    source = recorded_updates(args.replay) if args.replay else synthetic_updates(args, rng)
+    sent = {kind: [] for kind in HANDLERS}
+
+    async with application:
+        await bot.on_startup(application)
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=10)
+        try:
+            elapsed = await drive(fake, source, args, rng, sent)
+            expected = Counter()
+            for kind, keys in sent.items():
+                if HANDLERS[kind]:
+                    expected[HANDLERS[kind]] += len(keys)
+            drained = await drain(bot, expected, args.drain)
+        finally:
+            await application.updater.stop()
+            await application.stop()
+            await bot.on_shutdown(application)
+    for runner in runners:
+        await runner.cleanup()
+
+    results = report(args, fake, backend, supabase, bot, sent, elapsed, drained)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, default=str)
+    slow = [
+        handler for handler, stats in results["handlers"].items()
+        if (stats.get("answer_p99") or 0) > args.max_p99
+    ]
+    if args.max_p99 and slow:
+        print(f"\nanswer p99 above {args.max_p99}s for: {', '.join(slow)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=20, help="updates per second")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--drain", type=float, default=60,
+                        help="seconds to wait for outstanding answers")
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--replay", help="recorded updates, one JSON update per line")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--group-skew", type=float, default=1.5,
+                        help="higher puts more of the traffic in the first groups; "
+                        "the outbox sends at most 20 messages a minute per group")
+    parser.add_argument("--subscribers", type=float, default=0.3,
+                        help="share of known users with an active subscription")
+    parser.add_argument("--freemode", action="store_true")
+    parser.add_argument("--stream", action="store_true", help="stream answers")
+    parser.add_argument("--backend-latency", type=float, default=1.0,
+                        help="median seconds per /prompt call")
+    parser.add_argument("--backend-jitter", type=float, default=0.5,
+                        help="sigma of the lognormal /prompt latency")
+    parser.add_argument("--backend-errors", type=float, default=0.0,
+                        help="share of /prompt calls failing with 503")
+    parser.add_argument("--answer-chars", type=int, default=1500)
+    parser.add_argument("--stream-chunks", type=int, default=20)
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--supabase-latency", type=float, default=0.02)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--max-p99", type=float, default=0,
+                        help="exit with 1 if a handler's answer p99 exceeds this")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="keep the bot's info logs")
+    sys.exit(asyncio.run(main(parser.parse_args())))
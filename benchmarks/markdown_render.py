@@ -0,0 +1,126 @@
+"""Golden outputs and throughput of formatters.convert_to_telegram_html.
+
+Checks the converter against benchmarks/markdown_golden.json, then times
+it against the previous chain of regex passes on synthetic answers.
+
+    python benchmarks/markdown_render.py --size 20000
+    python benchmarks/markdown_render.py --update   # rewrite the goldens
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from formatters import convert_to_telegram_html  # noqa: E402
+
+GOLDEN = os.path.join(ROOT, "benchmarks", "markdown_golden.json")
+
+
+def legacy_convert(text):
+    # The converter as it was: one re.sub per construct, plus sanitize_html.
+    text = re.sub(r"<(?!/?(a|b|i|code|pre)\b)[^>]*>", "", text)
+    text = re.sub(r"## (.*)", r"<b>\1</b>", text)
+    text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text)
+    text = re.sub(r"__(.*?)__", r"<u>\1</u>", text)
+    text = re.sub(r"\*(.*?)\*", r"<i>\1</i>", text)
+    text = re.sub(r"_(.*?)_", r"<i>\1</i>", text)
+    text = re.sub(r"\+\+(.*?)\+\+", r"<u>\1</u>", text)
+    text = re.sub(r"~~(.*?)~~", r"<s>\1</s>", text)
+    text = re.sub(r"\|\|(.*?)\|\|", r'<span class="tg-spoiler">\1</span>', text)
+    text = re.sub(r"\[(.*?)\]\((http[s]?:\/\/.*?)\)", r'<a href="\2">\1</a>', text)
+    text = re.sub(
+        r"\[(.*?)\]\(tg:\/\/user\?id=(\d+)\)", r'<a href="tg://user?id=\2">\1</a>', text
+    )
+    text = re.sub(r"`([^`]+)`", r"<code>\1</code>", text)
+    text = re.sub(r"```([^`]*)```", r"<pre>\1</pre>", text, flags=re.DOTALL)
+    text = re.sub(r"^> (.*)", r"<blockquote>\1</blockquote>", text, flags=re.MULTILINE)
+    return text
+
+
+LINES = [
+    "## {word}",
+    "**{word}**: {n}-{m} mg, onset *{n} min*, duration _{m} h_",
+    "- Avoid combining with __{word}__ or ++{word}++.",
+    "> {word} can be dangerous at {n} mg & above",
+    "See [{word}](https://example.org/{word}?dose={n}&unit=mg) for details.",
+    "Use `{word}_{n}` carefully; ~~old advice~~ ||{word}||",
+    "Plain sentence about {word} with no markup at all, {n} < {m}.",
+]
+PROSE = (
+    "{word} is usually taken orally. Effects and their duration vary with dose, "
+    "setting and individual tolerance, so start low and wait before redosing."
+)
+WORDS = ["MDMA", "ketamine", "psilocybin", "LSD", "2C-B", "DMT", "tramadol"]
+
+
+def synthetic_answer(size, rng, markup=0.2):
+    # `markup` is the fraction of lines carrying formatting; the rest are
+    # plain prose, as most of a typical answer is.
+    lines = []
+    length = 0
+    while length < size:
+        template = rng.choice(LINES) if rng.random() < markup else PROSE
+        line = template.format(
+            word=rng.choice(WORDS), n=rng.randint(1, 99), m=rng.randint(100, 300)
+        )
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+
+def check_golden(update):
+    with open(GOLDEN, encoding="utf-8") as golden:
+        cases = json.load(golden)
+    failures = 0
+    for case in cases:
+        actual = convert_to_telegram_html(case["input"])
+        if update:
+            case["expected"] = actual
+        elif actual != case["expected"]:
+            failures += 1
+            print(f"FAIL {case['name']}")
+            print(f"  expected {case['expected']!r}\n  actual   {actual!r}")
+    if update:
+        with open(GOLDEN, "w", encoding="utf-8") as golden:
+            json.dump(cases, golden, indent=2, ensure_ascii=False)
+            golden.write("\n")
+        print(f"rewrote {len(cases)} golden outputs")
+    else:
+        print(f"golden: {len(cases) - failures}/{len(cases)} passed")
+    return failures
+
+
+def timed(convert, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        convert(text)
+    return (time.perf_counter() - start) / repeat
+
+
+def main(args):
+    failures = check_golden(args.update)
+    rng = random.Random(args.seed)
+    for markup in args.markup:
+        text = synthetic_answer(args.size, rng, markup)
+        legacy = timed(legacy_convert, text, args.repeat)
+        current = timed(convert_to_telegram_html, text, args.repeat)
+        print(f"{len(text) / 1000:.1f} KB answer, {markup:.0%} formatted lines")
+        print(f"  regex chain: {legacy * 1000:8.3f} ms")
+        print(f"  single pass: {current * 1000:8.3f} ms ({legacy / current:.1f}x)")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=20_000)
+    parser.add_argument("--markup", type=float, nargs="+", default=[0.0, 0.2, 1.0])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--update", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,66 @@
+"""Hot-path cost of the metrics layer and the cost of a /metrics scrape.
+
+Times Counter.inc, Histogram.observe and Histogram.time as the handlers use
+them, and a full render of a registry holding as many series as the bot
+produces (handlers x models x outcomes, handlers x stages).
+
+    python benchmarks/metrics_overhead.py --calls 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from metrics import Registry  # noqa: E402
+
+HANDLERS = ("ask", "info")
+MODELS = ("openai", "gemini")
+OUTCOMES = ("answered", "cached", "card", "rejected", "busy", "error")
+STAGES = ("admission", "query", "downtime", "acl", "rate_limit", "entitlement",
+          "backend", "format", "chunk", "send")
+
+
+def per_call(fn, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - start) / calls * 1e9
+
+
+def main(args):
+    registry = Registry()
+    requests = registry.counter("psyai_requests_total", "h", ("handler", "model", "outcome"))
+    seconds = registry.histogram("psyai_request_seconds", "h", ("handler", "outcome"))
+    stages = registry.histogram("psyai_stage_seconds", "h", ("handler", "stage"))
+
+    def timed():
+        with stages.time("ask", "format"):
+            pass
+
+    baseline = per_call(lambda: None, args.calls)
+    print(f"empty call:            {baseline:6.0f}ns")
+    print(f"Counter.inc:           {per_call(lambda: requests.inc('ask', 'openai', 'answered'), args.calls):6.0f}ns")
+    print(f"Histogram.observe:     {per_call(lambda: seconds.observe(0.42, 'ask', 'answered'), args.calls):6.0f}ns")
+    print(f"Histogram.time block:  {per_call(timed, args.calls):6.0f}ns")
+
+    for handler in HANDLERS:
+        for model in MODELS:
+            for outcome in OUTCOMES:
+                requests.inc(handler, model, outcome)
+                seconds.observe(1.0, handler, outcome)
+        for stage in STAGES:
+            stages.observe(0.01, handler, stage)
+    start = time.perf_counter()
+    for _ in range(100):
+        text = registry.render()
+    elapsed = (time.perf_counter() - start) / 100
+    print(f"render: {elapsed * 1e3:.2f}ms for {text.count(chr(10))} lines")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=1000000)
+    main(parser.parse_args())
@@ -0,0 +1,166 @@
+"""Push a burst of sends through the Outbox against a fake Bot API.
+
+The fake bot raises RetryAfter at a configurable rate and records when
+each call landed. The run checks that every message is delivered, that
+per-chat order is preserved, that global and per-chat send rates stay
+within Telegram's limits, that user answers overtake admin audit traffic,
+and that deletions (which don't count against a chat's message limit)
+aren't held to the 20 messages a minute of a group. Exits with 1 if any
+check fails.
+
+    python benchmarks/outbox_flood.py --chats 20 --messages 8 --flood-rate 0.1
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import telegram
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from outbox import HIGH, LOW, Outbox  # noqa: E402
+
+ADMIN_CHAT = 1
+CLEANUP_CHAT = -999
+GLOBAL_BURST = 5
+PRIVATE_RATE, PRIVATE_BURST = 1, 3
+GROUP_RATE, GROUP_BURST = 20 / 60, 5
+
+
+class FakeBotAPI:
+    def __init__(self, flood_rate, retry_after, seed):
+        self.rng = random.Random(seed)
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.delivered = defaultdict(list)
+        self.deleted = []
+        self.calls = []
+        self.floods = 0
+        self.message_id = 0
+
+    async def _call(self):
+        await asyncio.sleep(0.005)
+        self.calls.append(time.monotonic())
+        if self.rng.random() < self.flood_rate:
+            self.floods += 1
+            raise telegram.error.RetryAfter(self.retry_after)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call()
+        self.message_id += 1
+        self.delivered[chat_id].append((time.monotonic(), text))
+        return SimpleNamespace(chat_id=chat_id, message_id=self.message_id)
+
+    async def delete_message(self, chat_id, message_id):
+        await self._call()
+        self.deleted.append(time.monotonic())
+        return True
+
+
+def peak(stamps, window):
+    stamps = sorted(stamps)
+    return max((sum(1 for t in stamps if s <= t < s + window) for s in stamps), default=0)
+
+
+async def main(args):
+    bot = FakeBotAPI(args.flood_rate, args.retry_after, args.seed)
+    outbox = Outbox(
+        bot,
+        global_rate=args.global_rate,
+        global_burst=GLOBAL_BURST,
+        private_rate=PRIVATE_RATE,
+        private_burst=PRIVATE_BURST,
+        group_rate=GROUP_RATE,
+        group_burst=GROUP_BURST,
+    )
+    outbox.start()
+    start = time.monotonic()
+
+    futures = []
+    for i in range(args.messages):
+        # Audit traffic is queued first, yet answers should still go first.
+        futures.append(
+            outbox.send_message(ADMIN_CHAT, text=f"audit {i}", priority=LOW)
+        )
+    for chat in range(args.chats):
+        chat_id = -1000 - chat if chat % 2 else 1000 + chat
+        for i in range(args.messages):
+            futures.append(outbox.send_message(chat_id, text=f"{i}", priority=HIGH))
+    deletions = [
+        outbox.delete_message(CLEANUP_CHAT, message_id) for message_id in range(args.deletions)
+    ]
+
+    results = await asyncio.gather(*futures, *deletions, return_exceptions=True)
+    elapsed = time.monotonic() - start
+    await outbox.stop()
+
+    lost = sum(isinstance(result, BaseException) for result in results)
+    delivered = sum(len(sent) for sent in bot.delivered.values())
+    lost += len(futures) - delivered + len(deletions) - len(bot.deleted)
+    in_order = all(
+        [text for _, text in sent] == [str(i) for i in range(len(sent))]
+        for chat_id, sent in bot.delivered.items()
+        if chat_id != ADMIN_CHAT
+    )
+    global_peak = peak(bot.calls, 1)
+    global_limit = args.global_rate + GLOBAL_BURST
+    over_rate = []
+    for chat_id, sent in bot.delivered.items():
+        stamps = [t for t, _ in sent]
+        if chat_id < 0:
+            limit, count = GROUP_BURST + GROUP_RATE * 60, peak(stamps, 60)
+        else:
+            limit, count = PRIVATE_BURST + PRIVATE_RATE, peak(stamps, 1)
+        if count > limit:
+            over_rate.append(chat_id)
+    first_answer = min(
+        t
+        for chat_id, sent in bot.delivered.items()
+        if chat_id != ADMIN_CHAT
+        for t, _ in sent
+    )
+    last_audit = max(t for t, _ in bot.delivered[ADMIN_CHAT])
+    deletions_took = max(bot.deleted, default=start) - start
+    # At a group's message rate the deletions alone would take this long
+    deletions_throttled = deletions_took > (args.deletions - GROUP_BURST) / GROUP_RATE / 2
+
+    print(f"delivered {delivered}/{len(futures)} messages and "
+          f"{len(bot.deleted)}/{len(deletions)} deletions in {elapsed:.1f}s")
+    print(f"429s injected: {bot.floods}, retried: {outbox.retried}")
+    print(f"per-chat order preserved: {in_order}")
+    print(f"peak calls in any 1s window: {global_peak} (limit {global_limit:g})")
+    print(f"chats over their message rate: {over_rate or 'none'}")
+    print(f"first answer before last audit: {first_answer < last_audit}")
+    print(f"{args.deletions} deletions in one group took {deletions_took:.1f}s")
+    failures = [
+        name
+        for name, failed in (
+            ("lost calls", lost),
+            ("reordered", not in_order),
+            ("over the global rate", global_peak > global_limit),
+            ("over a chat's rate", over_rate),
+            ("audit before answers", first_answer > last_audit),
+            ("deletions held to the group message rate", deletions_throttled),
+        )
+        if failed
+    ]
+    if failures:
+        print(f"FAILED: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=8)
+    parser.add_argument("--deletions", type=int, default=40)
+    parser.add_argument("--flood-rate", type=float, default=0.1)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--global-rate", type=float, default=25)
+    parser.add_argument("--seed", type=int, default=3)
+    asyncio.run(main(parser.parse_args()))
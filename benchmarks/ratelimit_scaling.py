@@ -0,0 +1,70 @@
+"""Per-call cost of the rate limiters as the number of live keys grows.
+
+Each limiter is filled with up to a million distinct keys and the cost of
+further calls is sampled along the way; a flat ns/call column means the
+per-call cost does not depend on how many keys are tracked.
+
+    python benchmarks/ratelimit_scaling.py --keys 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import SlidingWindowCounter, TokenBucket  # noqa: E402
+
+
+def measure(limiter, keys, checkpoints, sample):
+    rng = random.Random(1)
+    next_key = 0
+    for checkpoint in checkpoints:
+        while next_key < checkpoint:
+            limiter.allow(next_key)
+            next_key += 1
+        probes = [rng.randrange(next_key) for _ in range(sample)]
+        start = time.perf_counter_ns()
+        for key in probes:
+            limiter.allow(key)
+        per_call = (time.perf_counter_ns() - start) / sample
+        print(f"  {next_key:>9,d} keys: {per_call:7.0f} ns/call")
+
+
+def main(args):
+    checkpoints = [
+        n for n in (1_000, 10_000, 100_000, 1_000_000, 10_000_000) if n <= args.keys
+    ]
+    limiters = {
+        "TokenBucket": lambda: TokenBucket(rate=1, capacity=20, idle_ttl=3600),
+        "SlidingWindowCounter": lambda: SlidingWindowCounter(limit=20, window=3600),
+    }
+    for name, factory in limiters.items():
+        print(name)
+        measure(factory(), args.keys, checkpoints, args.sample)
+
+        tracemalloc.start()
+        limiter = factory()
+        for key in range(args.keys):
+            limiter.allow(key)
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  {current / len(limiter):.0f} bytes/key at {len(limiter):,d} keys")
+
+    # Idle keys are evicted as time passes, so memory stays bounded.
+    now = [0.0]
+    limiter = TokenBucket(rate=1, capacity=20, clock=lambda: now[0])
+    for key in range(args.keys // 10):
+        limiter.allow(key)
+    now[0] += 3600
+    limiter.allow("fresh")
+    print(f"TokenBucket after 1h idle: {len(limiter)} live key(s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--keys", type=int, default=1_000_000)
+    parser.add_argument("--sample", type=int, default=100_000)
+    main(parser.parse_args())
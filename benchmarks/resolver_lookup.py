@@ -0,0 +1,128 @@
+"""Lookup latency of SubstanceResolver over tens of thousands of aliases.
+
+Builds a synthetic index of substance-like names and times exact hits,
+spelling variants, typos and misses. Then checks, against the real local
+dose cards, that names of other substances one or two characters away
+(positional isomers, other substituents) never get a card, and that
+Cyrillic, CJK and punctuation-only names neither collide nor reach the
+/info card cache. Exits with 1 if one does.
+
+    python benchmarks/resolver_lookup.py --aliases 50000
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from card_cache import CardCache  # noqa: E402
+from dose_cards import LocalCardStore  # noqa: E402
+from resolver import SubstanceResolver  # noqa: E402
+
+PREFIXES = ["", "2-", "3-", "4-", "5-", "n-", "o-", "alpha-", "3-fl-", "4-meo-"]
+STEMS = ["pcp", "pce", "mxe", "dmt", "mda", "pvp", "amt", "bk-", "eth", "meth"]
+
+
+def synthetic_names(n, rng):
+    names = set()
+    while len(names) < n:
+        tail = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9)))
+        names.add(rng.choice(PREFIXES) + rng.choice(STEMS) + tail)
+    return sorted(names)
+
+
+# Aliases of the built-in dose cards (constants.CUSTOM_DOSE_CARDS)
+CARDS = [
+    (["dmxe", "deoxymethoxetamine"], "DMXE"),
+    (["fxe", "fluorexetamine"], "FXE"),
+    (["3-fl-pcp", "3-fluoro-pcp"], "3-FL-PCP"),
+    (["phenethylmethadone", "pmh"], "insufficient data"),
+    (["norphenadoxone", "n-pdx"], "insufficient data"),
+]
+# Other substances close to ones with a local card; none may get that card
+LOOKALIKES = [
+    "3-CL-PCP", "4-FL-PCP", "4-fluoro-pcp", "3-fl-pce", "2-fl-pcp",
+    "fluoroketamine", "2-FDCK", "dcke", "mxe", "methoxetamine", "dxe", "fxe2",
+]
+# Typos of names with a local card that should still find it
+TYPOS = ["flourexetamine", "fluorexetamnie", "deoxymethoxettamine", "3-fluoro-pcpp"]
+UNICODE_NAMES = ["ЛСД", "大麻", "???", "Кетамин", "ЛСД-25"]
+
+
+def typo(name, rng):
+    # Two adjacent letters swapped, or a letter doubled
+    letters = [i for i in range(len(name) - 1) if name[i].isalpha() and name[i + 1].isalpha()]
+    if not letters:
+        return name
+    i = rng.choice(letters)
+    if rng.random() < 0.5:
+        return name[:i] + name[i + 1] + name[i] + name[i + 2 :]
+    return name[:i] + name[i] + name[i:]
+
+
+def substitution(name, rng):
+    i = rng.randrange(len(name))
+    return name[:i] + rng.choice(string.ascii_lowercase + string.digits) + name[i + 1 :]
+
+
+def variant(name):
+    return name.upper().replace("-", " ")
+
+
+def timed(resolver, queries):
+    start = time.perf_counter()
+    found = sum(resolver.get(q, fuzzy=True) is not None for q in queries)
+    elapsed = time.perf_counter() - start
+    return elapsed / len(queries) * 1e6, found
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    names = synthetic_names(args.aliases, rng)
+    resolver = SubstanceResolver()
+    start = time.perf_counter()
+    for i in range(0, len(names), 2):
+        resolver.add(names[i : i + 2], f"card{i}")
+    print(f"indexed {len(resolver)} aliases in {time.perf_counter() - start:.2f}s")
+
+    sample = rng.sample(names, args.queries)
+    workloads = {
+        "exact": sample,
+        "variant": [variant(name) for name in sample],
+        "typo": [typo(name, rng) for name in sample],
+        "substitution": [substitution(name, rng) for name in sample],
+        "miss": ["zz" + typo(name, rng) + "qq" for name in sample],
+    }
+    for label, queries in workloads.items():
+        micros, found = timed(resolver, queries)
+        print(f"{label:12s}: {micros:8.1f} us/lookup, {found}/{len(queries)} resolved")
+
+    cards = LocalCardStore(builtin=CARDS)
+    wrong = [name for name in LOOKALIKES if cards.get(name) is not None]
+    wrong += [name for name in LOOKALIKES if cards.cards.get(name, fuzzy=True) is not None]
+    found = [name for name in TYPOS if cards.cards.get(name, fuzzy=True) is not None]
+    print(f"lookalikes given a card: {wrong or 'none'}; "
+          f"typos resolved with fuzzy=True: {len(found)}/{len(TYPOS)}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CardCache(os.path.join(tmp, "cards.sqlite3"))
+        cache.put(UNICODE_NAMES[0], "openai", "card")
+        collided = [name for name in UNICODE_NAMES[1:] if cache.get(name, "openai") is not None]
+        cache.put("???", "openai", "card")
+        cached_empty = cache.get("!!!", "openai") is not None
+        cache.close()
+    print(f"card cache collisions: {collided or 'none'}, punctuation cached: {cached_empty}")
+    if wrong or collided or cached_empty:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--aliases", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=7)
+    main(parser.parse_args())
@@ -0,0 +1,217 @@
+"""Throughput of multi-process mode and correctness of the shared state.
+
+Routes synthetic updates through ShardRouter to worker processes running
+sharding.serve_shard with a real telegram.ext.Application. Its handler
+charges the shared rate limiter and trial ledger after a short admission
+wait, ends its chat turn the way psygptbot's handlers do, then does the
+CPU-bound part of answering (Markdown conversion and chunking of a canned
+answer) and waits a random backend latency. An admin /reload_cards update is relayed to
+every worker as a control message, the way psygptbot broadcasts admin
+commands. Exits with 1 unless every chat's updates were handled in order,
+no user got more trial prompts than they had and every worker got the
+control message, for 1..N workers. Also reports how many answers were
+in flight at once in one chat, which is 1 if a chat's backend calls are
+serialized.
+
+    python benchmarks/shard_scaling.py --workers 1 2 4 --updates 4000
+    python benchmarks/shard_scaling.py --unordered   # plain concurrent_updates
+"""
+import argparse
+import asyncio
+import os
+import queue
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import telegram
+from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from formatters import convert_to_telegram_html, split_html  # noqa: E402
+from ledger import TrialLedger  # noqa: E402
+from ratelimit import CompositeLimiter  # noqa: E402
+from shared_state import SharedSlidingWindowCounter, SqliteState  # noqa: E402
+from sharding import (  # noqa: E402
+    ChatOrderedProcessor,
+    ShardRouter,
+    relay_control,
+    release_chat_turn,
+    serve_shard,
+)
+
+ANSWER = (
+    "## Ketamine\n**Dose**: 30-75 mg insufflated, *onset* 5-15 min.\n"
+    "- Avoid combining with __alcohol__ or ~~benzodiazepines~~ depressants.\n"
+    "> Test your substances. See [guide](https://example.org/guide?x=1&y=2).\n"
+) * 4
+TRIALS = 5
+ADMIN_CHAT = 1
+
+
+class OfflineBot(telegram.Bot):
+    # Application.initialize() asks for the bot's own user; nothing else in
+    # this benchmark calls the Bot API.
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = telegram.User(1, "bench", True, username="bench_bot")
+        return self._bot_user
+
+
+class NullStore:
+    async def write(self, balances):
+        pass
+
+
+def worker(index, count, inbox, control, state_path, results, latency, admission, ordered):
+    # Stands in for psygptbot.run_worker: same routing, update loop and
+    # shared state, canned work instead of the Bot API and backend.
+    state = SqliteState(state_path)
+    limiter = CompositeLimiter(
+        {"user": SharedSlidingWindowCounter(state, "user", limit=10**9, window=3600)}
+    )
+    ledger = TrialLedger(NullStore(), balances=state)
+    rng = random.Random(index)
+    handled = []
+    granted = defaultdict(int)
+    in_flight = defaultdict(int)
+    overlap = 0
+
+    async def answer(update, context):
+        nonlocal overlap
+        message = update.effective_message
+        user_id = update.effective_user.id
+        # Admission, e.g. a cached entitlement lookup
+        await asyncio.sleep(rng.uniform(0, admission))
+        limiter.allow({"user": user_id})
+        if ledger.try_consume(user_id, TRIALS) is not None:
+            granted[user_id] += 1
+        handled.append((message.chat_id, message.message_id))
+        release_chat_turn()
+        in_flight[message.chat_id] += 1
+        overlap = max(overlap, in_flight[message.chat_id])
+        split_html(convert_to_telegram_html(ANSWER))
+        await asyncio.sleep(rng.uniform(0, latency))
+        in_flight[message.chat_id] -= 1
+
+    async def reload_cards(update, context):
+        control.put({"control": "reload_cards", "chat_id": update.effective_chat.id})
+
+    def on_control(message):
+        if message["control"] == "reload_cards":
+            results.put(("control", index))
+
+    async def on_startup(application):
+        ledger.start()
+
+    async def on_shutdown(application):
+        await ledger.stop()
+        results.put(("done", index, handled, dict(granted), overlap))
+
+    application = (
+        ApplicationBuilder()
+        .bot(OfflineBot("1:bench"))
+        .updater(None)
+        .concurrent_updates(ChatOrderedProcessor() if ordered else True)
+        .build()
+    )
+    application.add_handler(CommandHandler("reload_cards", reload_cards))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, answer))
+    asyncio.run(serve_shard(application, inbox, on_startup, on_shutdown, on_control))
+
+
+def update(update_id, chat_id, user_id, message_id, text="hi"):
+    message = {
+        "message_id": message_id,
+        "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+        "date": 0,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+
+async def run(workers, args):
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory() as tmp:
+        state_path = os.path.join(tmp, "state.sqlite3")
+        SqliteState(state_path).close()
+        router = ShardRouter(worker, workers)
+        results = router.context.Queue()
+        router.args = (state_path, results, args.latency, args.admission_latency, not args.unordered)
+        router.start()
+        relay = loop.create_task(relay_control(router))
+
+        next_message = defaultdict(int)
+        start = time.perf_counter()
+        for update_id in range(args.updates):
+            chat_id = -(1000 + update_id % args.chats)
+            user_id = 1 + (update_id * 7) % args.users  # users post in many chats
+            next_message[chat_id] += 1
+            router.dispatch(update(update_id, chat_id, user_id, next_message[chat_id]))
+        router.dispatch(
+            update(args.updates, ADMIN_CHAT, ADMIN_CHAT, 1, text="/reload_cards")
+        )
+
+        # Workers stop on None, so wait for the relayed control message first
+        reached = set()
+        try:
+            while len(reached) < workers:
+                kind, index, *_ = await loop.run_in_executor(None, results.get, True, 60)
+                reached.add(index)
+        except queue.Empty:
+            pass
+        for inbox in router.inboxes:
+            inbox.put(None)
+        outcomes = [
+            await loop.run_in_executor(None, results.get, True, 60)
+            for _ in range(workers)
+        ]
+        elapsed = time.perf_counter() - start
+        relay.cancel()
+        await asyncio.to_thread(router.stop)
+
+    last_seen = {}
+    reordered = 0
+    granted = defaultdict(int)
+    for _, _, handled, grants, _ in outcomes:
+        for chat_id, message_id in handled:
+            if message_id <= last_seen.get(chat_id, 0):
+                reordered += 1
+            last_seen[chat_id] = message_id
+        for user_id, count in grants.items():
+            granted[user_id] += count
+    handled = sum(len(outcome[2]) for outcome in outcomes)
+    over = sum(1 for count in granted.values() if count > TRIALS)
+    overlap = max(outcome[4] for outcome in outcomes)
+    print(
+        f"{workers} worker(s): {args.updates / elapsed:7.0f} updates/s, "
+        f"handled {handled}/{args.updates}, out of order: {reordered}, "
+        f"users over their trial: {over}, control reached {len(reached)}/{workers}, "
+        f"answers in flight per chat: up to {overlap}"
+    )
+    return handled == args.updates and not reordered and not over and len(reached) == workers
+
+
+def main(args):
+    passed = [asyncio.run(run(workers, args)) for workers in args.workers]
+    if not all(passed):
+        print("FAILED")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=4000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--admission-latency", type=float, default=0.05)
+    parser.add_argument("--unordered", action="store_true")
+    main(parser.parse_args())
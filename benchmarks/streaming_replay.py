@@ -0,0 +1,94 @@
+"""Stream an answer from a local SSE stub into a fake bot.
+
+Reports time to first visible text, total generation time and how many
+edits/messages the throttled StreamingReply produced.
+
+    python benchmarks/streaming_replay.py --tokens 400 --token-delay 0.01
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend import PsyAIClient  # noqa: E402
+from streaming import StreamingReply  # noqa: E402
+
+
+async def start_sse_stub(tokens, token_delay):
+    async def handle(reader, writer):
+        head = await reader.readuntil(b"\r\n\r\n")
+        for line in head.split(b"\r\n"):
+            if line.lower().startswith(b"content-length:"):
+                await reader.readexactly(int(line.split(b":", 1)[1]))
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+        )
+        for i in range(tokens):
+            event = f"data: {json.dumps({'delta': f'word{i} '})}\n\n".encode()
+            writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            await writer.drain()
+            await asyncio.sleep(token_delay)
+        done = b"data: [DONE]\n\n"
+        writer.write(f"{len(done):x}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+
+class FakeBot:
+    def __init__(self):
+        self.events = []
+        self.next_id = 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.next_id += 1
+        self.events.append(("send", time.perf_counter(), len(text)))
+        return SimpleNamespace(chat_id=chat_id, message_id=self.next_id)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.events.append(("edit", time.perf_counter(), len(text)))
+
+    async def delete_message(self, chat_id, message_id):
+        self.events.append(("delete", time.perf_counter(), 0))
+
+
+async def main(args):
+    server, base_url = await start_sse_stub(args.tokens, args.token_delay)
+    bot = FakeBot()
+    client = PsyAIClient(base_url)
+    async with server:
+        thinking = await bot.send_message(1, "One moment, PsyAI is thinking...")
+        reply = StreamingReply(
+            bot, thinking, min_interval=args.interval, max_length=args.max_length
+        )
+        start = time.perf_counter()
+        async for delta in client.stream("/prompt", {"question": "q"}):
+            await reply.feed(delta)
+        generated = time.perf_counter() - start
+        chunks = [reply.text[i : i + 3000] for i in range(0, len(reply.text), 3000)]
+        await reply.finish(chunks, parse_mode=None)
+        await client.close()
+
+    edits = [e for e in bot.events if e[0] == "edit"]
+    sends = [e for e in bot.events if e[0] == "send"]
+    first = edits[0][1] - start if edits else float("nan")
+    print(f"generation time        : {generated * 1000:8.0f} ms")
+    print(f"time to first text     : {first * 1000:8.0f} ms")
+    print(f"edits / messages sent  : {len(edits)} / {len(sends)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=400)
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--max-length", type=int, default=1000)
+    asyncio.run(main(parser.parse_args()))
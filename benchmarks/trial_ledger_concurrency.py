@@ -0,0 +1,93 @@
+"""Drive the trial ledger with many simultaneous messages per user.
+
+Uses a local fake store with artificial write latency and checks that no
+user is granted more prompts than their trial allows, that the store ends
+up with the same balances as the ledger, and that prompts an admin grants
+in the store while the ledger is running are kept.
+
+    python benchmarks/trial_ledger_concurrency.py --users 200 --messages 50
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ledger import LocalBalances, TrialLedger  # noqa: E402
+
+
+class FakeTrialStore:
+    def __init__(self, balances, latency):
+        self.rows = dict(balances)
+        self.latency = latency
+        self.writes = 0
+
+    async def read(self, telegram_id):
+        await asyncio.sleep(random.random() * self.latency)
+        return self.rows[telegram_id]
+
+    async def write(self, consumed):
+        await asyncio.sleep(self.latency)
+        self.writes += 1
+        for telegram_id, amount in consumed.items():
+            self.rows[telegram_id] = max(self.rows[telegram_id] - amount, 0)
+
+
+async def main(args):
+    initial = {user: random.randint(0, args.trial) for user in range(args.users)}
+    store = FakeTrialStore(initial, args.latency)
+    # Reads below go straight to the store, with no cache to wait out
+    ledger = TrialLedger(
+        store, flush_interval=args.flush_interval, balances=LocalBalances(hold=0)
+    )
+    ledger.start()
+    granted = dict.fromkeys(initial, 0)
+
+    async def message(user):
+        # Same shape as the handler: an awaited read, then the decrement.
+        known = await store.read(user)
+        if ledger.try_consume(user, known) is not None:
+            granted[user] += 1
+
+    async def grant(users):
+        # An admin adds prompts directly in the database mid-run
+        await asyncio.sleep(args.flush_interval * 3)
+        for user in users:
+            store.rows[user] += args.grant
+            initial[user] += args.grant
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        grant(random.sample(sorted(initial), args.users // 10)),
+        *(message(user) for user in initial for _ in range(args.messages)),
+    )
+    # Messages after the flushes see the granted prompts
+    await asyncio.sleep(args.flush_interval * 3)
+    await asyncio.gather(*(message(user) for user in initial for _ in range(args.messages)))
+    elapsed = time.perf_counter() - start
+    await ledger.stop()
+
+    over = [user for user in initial if granted[user] > initial[user]]
+    mismatched = [
+        user for user in initial if store.rows[user] != initial[user] - granted[user]
+    ]
+    total = args.users * args.messages * 2
+    print(f"{total} messages in {elapsed:.2f}s, {store.writes} store writes")
+    print(f"over-granted users: {len(over)}, store mismatches: {len(mismatched)}, "
+          f"balances still held after stop: {len(ledger.balances.balances)}")
+    if over or mismatched or ledger.balances.balances:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--trial", type=int, default=5)
+    parser.add_argument("--grant", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--flush-interval", type=float, default=0.05)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,134 @@
+"""Replays recorded Telegram updates and Stripe events against WebhookServer.
+
+Starts the webhook server on a local port with an in-memory stand-in for
+the application and the database, posts the payloads in
+benchmarks/payloads/ (Stripe events signed like Stripe signs them), checks
+the resulting entitlement state, then measures update ingestion rate.
+
+    python benchmarks/webhook_replay.py --updates 5000 --concurrency 50
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import socket
+import sys
+import time
+from types import SimpleNamespace
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from entitlements import EntitlementCache  # noqa: E402
+from webhooks import StripeEvents, WebhookServer, application_inbox  # noqa: E402
+
+PAYLOADS = os.path.join(ROOT, "benchmarks", "payloads")
+SECRET = "whsec_replay"
+TELEGRAM_SECRET = "replay-token"
+
+
+def load(name):
+    with open(os.path.join(PAYLOADS, name), "rb") as payload:
+        return payload.read()
+
+
+def stripe_signature(payload, secret=SECRET):
+    timestamp = int(time.time())
+    signed = f"{timestamp}.".encode() + payload
+    digest = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def main(args):
+    rows = {
+        5550001: {
+            "telegram_id": 5550001,
+            "subscription_status": False,
+            "stripe_id": "placeholder",
+            "trial_prompts": 0,
+        }
+    }
+
+    async def loader(telegram_id):
+        return dict(rows[telegram_id])
+
+    async def persist(telegram_id, fields):
+        rows[telegram_id].update(fields)
+
+    async def lookup_customer(customer_id):
+        for telegram_id, row in rows.items():
+            if row["stripe_id"] == customer_id:
+                return telegram_id
+        return None
+
+    entitlements = EntitlementCache(loader)
+    events = StripeEvents(entitlements, persist, lookup_customer)
+    application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+    port = free_port()
+    server = WebhookServer("127.0.0.1", port)
+    server.add_telegram("/telegram", application_inbox(application), TELEGRAM_SECRET)
+    server.add_stripe("/stripe", events, SECRET)
+    await server.start()
+    base = f"http://127.0.0.1:{port}"
+    await entitlements.get(5550001)  # warm the cache, as a recent user would be
+
+    async with aiohttp.ClientSession() as session:
+        async def post_stripe(name, signature=None):
+            payload = load(name)
+            headers = {"Stripe-Signature": signature or stripe_signature(payload)}
+            async with session.post(f"{base}/stripe", data=payload, headers=headers) as r:
+                body = await r.json() if r.status == 200 else None
+                return r.status, body
+
+        checkout = "stripe_checkout_completed.json"
+        print("checkout.session.completed:", await post_stripe(checkout))
+        assert (await entitlements.get(5550001))["subscription_status"] is True
+        print("  retried delivery:", await post_stripe(checkout))
+        print("  bad signature:  ", await post_stripe(checkout, "t=1,v1=0"))
+        deleted = "stripe_subscription_deleted.json"
+        print("customer.subscription.deleted:", await post_stripe(deleted))
+        assert (await entitlements.get(5550001))["subscription_status"] is False
+        assert rows[5550001]["subscription_status"] is False
+
+        update = json.loads(load("telegram_message.json"))
+        headers = {"X-Telegram-Bot-Api-Secret-Token": TELEGRAM_SECRET}
+        async with session.post(f"{base}/telegram", json=update) as response:
+            print("update without secret token:", response.status)
+        async with session.post(f"{base}/telegram", json=update, headers=headers) as response:
+            print("update:", response.status)
+        received = application.update_queue.get_nowait()
+        assert received.message.text == update["message"]["text"]
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def post_update(update_id):
+            async with semaphore:
+                body = dict(update, update_id=update_id)
+                async with session.post(f"{base}/telegram", json=body, headers=headers) as r:
+                    assert r.status == 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post_update(i) for i in range(args.updates)))
+        elapsed = time.perf_counter() - start
+
+    await server.stop()
+    print(f"{args.updates} updates in {elapsed:.2f}s ({args.updates / elapsed:.0f}/s), "
+          f"{application.update_queue.qsize()} queued")
+    print(f"server counters: {dict(server.received)}, stripe: {dict(events.counts)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
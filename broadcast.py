@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import sqlite3
+import time
+import telegram
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+PENDING = "pending"
+DELIVERED = "delivered"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+
+class BroadcastStore:
+    # SQLite record of every broadcast and of each recipient's outcome, so a
+    # broadcast interrupted by a restart picks up where it left off.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " audience TEXT NOT NULL,"
+            " text TEXT NOT NULL,"
+            " parse_mode TEXT,"
+            " cursor INTEGER,"
+            " enumerated INTEGER NOT NULL DEFAULT 0,"
+            " finished_at REAL,"
+            " created_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS recipients ("
+            " broadcast_id INTEGER NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " status TEXT NOT NULL,"
+            " error TEXT,"
+            " PRIMARY KEY (broadcast_id, chat_id));"
+        )
+
+    def create(self, audience, text, parse_mode):
+        return self.db.execute(
+            "INSERT INTO broadcasts (audience, text, parse_mode, created_at)"
+            " VALUES (?, ?, ?, ?)",
+            (audience, text, parse_mode, time.time()),
+        ).lastrowid
+
+    def get(self, broadcast_id):
+        cursor = self.db.execute(
+            "SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip((column[0] for column in cursor.description), row))
+
+    def unfinished(self):
+        return [
+            row[0]
+            for row in self.db.execute(
+                "SELECT id FROM broadcasts WHERE finished_at IS NULL ORDER BY id"
+            )
+        ]
+
+    def add_recipients(self, broadcast_id, chat_ids, cursor):
+        # Recipients and the enumeration cursor are saved together, so a
+        # page is never both skipped and unrecorded.
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO recipients VALUES (?, ?, ?, NULL)",
+                [(broadcast_id, chat_id, PENDING) for chat_id in chat_ids],
+            )
+            self.db.execute(
+                "UPDATE broadcasts SET cursor = ? WHERE id = ?", (cursor, broadcast_id)
+            )
+
+    def mark_enumerated(self, broadcast_id):
+        self.db.execute(
+            "UPDATE broadcasts SET enumerated = 1 WHERE id = ?", (broadcast_id,)
+        )
+
+    def pending(self, broadcast_id, limit):
+        return [
+            row[0]
+            for row in self.db.execute(
+                "SELECT chat_id FROM recipients"
+                " WHERE broadcast_id = ? AND status = ? LIMIT ?",
+                (broadcast_id, PENDING, limit),
+            )
+        ]
+
+    def set_status(self, broadcast_id, chat_id, status, error=None):
+        self.db.execute(
+            "UPDATE recipients SET status = ?, error = ?"
+            " WHERE broadcast_id = ? AND chat_id = ?",
+            (status, error, broadcast_id, chat_id),
+        )
+
+    def finish(self, broadcast_id):
+        self.db.execute(
+            "UPDATE broadcasts SET finished_at = ? WHERE id = ?",
+            (time.time(), broadcast_id),
+        )
+
+    def counts(self, broadcast_id):
+        counts = dict.fromkeys((PENDING, DELIVERED, FAILED, BLOCKED), 0)
+        for status, count in self.db.execute(
+            "SELECT status, COUNT(*) FROM recipients"
+            " WHERE broadcast_id = ? GROUP BY status",
+            (broadcast_id,),
+        ):
+            counts[status] = count
+        return counts
+
+    def close(self):
+        self.db.close()
+
+
+class BroadcastEngine:
+    # Sends a broadcast to many chats concurrently. `send` is a coroutine
+    # function with Bot.send_message's signature that enforces the global
+    # rate budget (the outbox); `concurrency` caps how many sends are in
+    # flight. Recipients come from `sources[audience](cursor)`, an async
+    # iterator of (chat_ids, cursor) pages, and are recorded page by page so
+    # a large audience is never held in memory and a restart resumes.
+    def __init__(self, send, store, sources, concurrency=20):
+        self.send = send
+        self.store = store
+        self.sources = sources
+        self.concurrency = concurrency
+        self.running = {}
+
+    def start(self, audience, text, parse_mode=None, on_done=None):
+        broadcast_id = self.store.create(audience, text, parse_mode)
+        self.resume(broadcast_id, on_done)
+        return broadcast_id
+
+    def resume(self, broadcast_id, on_done=None):
+        if broadcast_id in self.running:
+            return self.running[broadcast_id]
+        task = asyncio.get_running_loop().create_task(
+            self._run(broadcast_id, on_done)
+        )
+        self.running[broadcast_id] = task
+        task.add_done_callback(lambda _: self.running.pop(broadcast_id, None))
+        return task
+
+    async def _deliver(self, broadcast, chat_id):
+        try:
+            await self.send(
+                chat_id=chat_id,
+                text=broadcast["text"],
+                parse_mode=broadcast["parse_mode"],
+            )
+        except telegram.error.Forbidden as error:
+            self.store.set_status(broadcast["id"], chat_id, BLOCKED, str(error))
+        except Exception as error:
+            logger.error(f"Broadcast {broadcast['id']} to {chat_id} failed: {error}")
+            self.store.set_status(broadcast["id"], chat_id, FAILED, str(error))
+        else:
+            self.store.set_status(broadcast["id"], chat_id, DELIVERED)
+
+    async def _drain(self, broadcast):
+        # Recipients are marked as they complete, so re-reading pending rows
+        # until none are left also retries whatever a restart interrupted.
+        while True:
+            chat_ids = self.store.pending(broadcast["id"], self.concurrency * 10)
+            if not chat_ids:
+                return
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def deliver(chat_id):
+                async with semaphore:
+                    await self._deliver(broadcast, chat_id)
+
+            await asyncio.gather(*(deliver(chat_id) for chat_id in chat_ids))
+
+    async def _run(self, broadcast_id, on_done):
+        broadcast = self.store.get(broadcast_id)
+        await self._drain(broadcast)
+        if not broadcast["enumerated"]:
+            source = self.sources[broadcast["audience"]]
+            async for chat_ids, cursor in source(broadcast["cursor"]):
+                self.store.add_recipients(broadcast_id, chat_ids, cursor)
+                await self._drain(broadcast)
+            self.store.mark_enumerated(broadcast_id)
+        await self._drain(broadcast)
+        self.store.finish(broadcast_id)
+
+        counts = self.store.counts(broadcast_id)
+        logger.info(f"Broadcast {broadcast_id} finished: {counts}")
+        if on_done is not None:
+            await on_done(broadcast_id, counts)
+        return counts
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from resolver import canonicalize as normalize_substance
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+
+class CardCache:
+    # Disk-backed cache of /info drug cards, keyed on the normalized
+    # substance name plus the model and output format that produced them.
+    # Entries expire after `ttl` seconds and the least recently read entries
+    # are evicted once more than `max_entries` are stored. Names that
+    # normalize to nothing (e.g. only punctuation) are never cached.
+    # Reads don't write: access times and expired keys are buffered and
+    # written, along with the eviction, every `interval` seconds from a
+    # worker thread once start() has been called, so the connection is
+    # used under `lock`.
+    def __init__(
+        self, path, ttl=7 * 24 * 3600, max_entries=5000, clock=time.time, interval=30
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.interval = interval
+        self.hits = 0
+        self.misses = 0
+        self.accessed = {}  # key -> last read
+        self.expired = set()
+        self.task = None
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # A lost access time or card after a crash only costs a refetch.
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cards ("
+            " substance TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " format TEXT NOT NULL,"
+            " body TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL,"
+            " PRIMARY KEY (substance, model, format))"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS cards_accessed_at ON cards (accessed_at)"
+        )
+        # Written by versions that reduced non-Latin names to ""
+        self.db.execute("DELETE FROM cards WHERE substance = ''")
+
+    def get(self, substance, model, format="html"):
+        key = (normalize_substance(substance), model, format)
+        if not key[0]:
+            return None
+        now = self.clock()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT body, created_at FROM cards"
+                " WHERE substance = ? AND model = ? AND format = ?",
+                key,
+            ).fetchone()
+        if row is None or row[1] + self.ttl <= now:
+            if row is not None:
+                self.accessed.pop(key, None)
+                self.expired.add(key)
+            self.misses += 1
+            return None
+        self.accessed[key] = now
+        self.hits += 1
+        return row[0]
+
+    def put(self, substance, model, body, format="html"):
+        substance = normalize_substance(substance)
+        if not substance:
+            return
+        now = self.clock()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?, ?)",
+                (substance, model, format, body, now, now),
+            )
+
+    def invalidate(self, substance=None):
+        with self.lock:
+            if substance is None:
+                return self.db.execute("DELETE FROM cards").rowcount
+            return self.db.execute(
+                "DELETE FROM cards WHERE substance = ?", (normalize_substance(substance),)
+            ).rowcount
+
+    def _write(self, accessed, expired):
+        with self.lock, self.db:
+            self.db.executemany(
+                "UPDATE cards SET accessed_at = MAX(accessed_at, ?)"
+                " WHERE substance = ? AND model = ? AND format = ?",
+                [(at, *key) for key, at in accessed.items()],
+            )
+            # Recheck: the card may have been refetched since
+            self.db.executemany(
+                "DELETE FROM cards WHERE substance = ? AND model = ? AND format = ?"
+                " AND created_at + ? <= ?",
+                [(*key, self.ttl, self.clock()) for key in expired],
+            )
+            self.db.execute(
+                "DELETE FROM cards WHERE rowid IN ("
+                " SELECT rowid FROM cards ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    async def flush(self):
+        accessed, self.accessed = self.accessed, {}
+        expired, self.expired = self.expired, set()
+        try:
+            await asyncio.to_thread(self._write, accessed, expired)
+        except Exception as error:
+            logger.error(f"Error writing info card cache: {error}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await asyncio.shield(self.flush())
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+    def close(self):
+        self.db.close()
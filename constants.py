@@ -1,7 +1,7 @@
 from dotenv import load_dotenv
 import os
 import base64
-from utils import RateLimiter, MultiKeyDict
+from resolver import SubstanceResolver
 
 load_dotenv()
 
@@ -40,7 +40,6 @@ BETA_TESTER_GROUPS = os.getenv("BETA_TESTER_GROUPS")
 BETA_TESTER_USERS = os.getenv("BETA_TESTER_USERS")
 BOT_GREETING_MSG = base64.b64decode(os.getenv("BOT_GREETING_MSG")).decode("utf-8")
 
-print(RESTRICTED_USER_IDS)
 # Text & info message parsing
 SORRY_MSG = lambda x: f"Sorry, I couldn't fetch the {x}. Please try again later."
 ESCAPE_TEXT = lambda text: text
@@ -54,6 +53,121 @@ BETA_TESTER_GROUPS = [int(id) for id in BETA_TESTER_GROUPS.split(",") if id] if
 BETA_TESTER_USERS = [int(id) for id in BETA_TESTER_USERS.split(",") if id] if "," in BETA_TESTER_USERS else [int(BETA_TESTER_USERS)]
 
 BOT_USERNAME = os.getenv("BOT_USERNAME")
+# Bot API server; a local telegram-bot-api server or a test stand-in
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+
+# Backend HTTP client
+BACKEND_POOL_SIZE = int(os.getenv("BACKEND_POOL_SIZE", "100"))
+BACKEND_KEEPALIVE = int(os.getenv("BACKEND_KEEPALIVE", "20"))
+BACKEND_CONNECT_TIMEOUT = float(os.getenv("BACKEND_CONNECT_TIMEOUT", "5"))
+BACKEND_READ_TIMEOUT = float(os.getenv("BACKEND_READ_TIMEOUT", "120"))
+
+# Backend routing across BASE_URL_BETA, BASE_URL and models: a route's breaker
+# opens after that many consecutive failures for the cooldown, and slow calls
+# are hedged to the next route past that latency percentile, for at most that
+# share of calls
+BACKEND_BREAKER_FAILURES = int(os.getenv("BACKEND_BREAKER_FAILURES", "5"))
+BACKEND_BREAKER_COOLDOWN = float(os.getenv("BACKEND_BREAKER_COOLDOWN", "30"))
+BACKEND_HEDGE_PERCENTILE = float(os.getenv("BACKEND_HEDGE_PERCENTILE", "0.95"))
+BACKEND_HEDGE_BUDGET = float(os.getenv("BACKEND_HEDGE_BUDGET", "0.1"))
+
+# Rate limits
+RATE_LIMIT_RESTRICTED_GROUP_PER_HOUR = int(os.getenv("RATE_LIMIT_RESTRICTED_GROUP_PER_HOUR", "20"))
+RATE_LIMIT_USER_PER_HOUR = int(os.getenv("RATE_LIMIT_USER_PER_HOUR", "120"))
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", "20"))
+RATE_LIMIT_GLOBAL_BURST = int(os.getenv("RATE_LIMIT_GLOBAL_BURST", "60"))
+
+# Outbound Bot API scheduler
+OUTBOX_GLOBAL_PER_SECOND = float(os.getenv("OUTBOX_GLOBAL_PER_SECOND", "25"))
+OUTBOX_MAX_INFLIGHT = int(os.getenv("OUTBOX_MAX_INFLIGHT", "64"))
+
+# Admin audit digest. With WORKERS > 1 each worker logs to its own file,
+# with its shard index before the extension (audit.0.jsonl, ...).
+AUDIT_LOG_PATH = os.getenv("AUDIT_LOG_PATH", "audit.jsonl")
+AUDIT_DIGEST_INTERVAL = float(os.getenv("AUDIT_DIGEST_INTERVAL", "60"))
+AUDIT_DIGEST_BATCH_SIZE = int(os.getenv("AUDIT_DIGEST_BATCH_SIZE", "50"))
+
+# Webhooks: set WEBHOOK_URL to receive updates by webhook instead of polling.
+# The same server hosts the Stripe endpoint whenever STRIPE_ENDPOINT_SECRET is set.
+# WEBHOOK_SECRET is required in webhook mode; Telegram sends it with every update.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+STRIPE_WEBHOOK_PATH = os.getenv("STRIPE_WEBHOOK_PATH", "/stripe/webhook")
+
+# Prometheus metrics on a local port, /metrics; 0 turns them off. In
+# multi-process mode worker N listens on METRICS_PORT + N.
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# /profile: where reports are written, how long a run lasts by default and
+# how often the event loop's stack is sampled
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_DEFAULT_SECONDS = float(os.getenv("PROFILE_DEFAULT_SECONDS", "30"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+
+# Multi-process mode: WORKERS > 1 runs one ingest process that routes updates
+# by chat to that many worker processes. Rate limits and trial balances are
+# then kept in a shared SQLite file instead of in each process.
+WORKERS = int(os.getenv("WORKERS", "1"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite" if WORKERS > 1 else "local")
+STATE_PATH = os.getenv("STATE_PATH", "state.sqlite3")
+
+# Resumable /announce broadcasts
+BROADCAST_STATE_PATH = os.getenv("BROADCAST_STATE_PATH", "broadcasts.sqlite3")
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "1000"))
+
+# Topic purges
+PURGE_STATE_PATH = os.getenv("PURGE_STATE_PATH", "purges.sqlite3")
+PURGE_REPORT_INTERVAL = float(os.getenv("PURGE_REPORT_INTERVAL", "10"))
+# Logged topic message ids are written every PURGE_LOG_INTERVAL seconds and
+# kept for PURGE_RETENTION_DAYS; older messages can't be purged.
+PURGE_LOG_INTERVAL = float(os.getenv("PURGE_LOG_INTERVAL", "5"))
+PURGE_RETENTION_DAYS = float(os.getenv("PURGE_RETENTION_DAYS", "30"))
+
+# LLM request scheduler: concurrent backend calls, callers allowed to wait,
+# and how long they may wait before being turned away
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "200"))
+LLM_QUEUE_DEADLINE = float(os.getenv("LLM_QUEUE_DEADLINE", "90"))
+LLM_BUSY_MSG = os.getenv(
+    "LLM_BUSY_MSG", "PsyAI is very busy right now. Please try again in a few minutes."
+)
+
+# Stream answers into the "thinking" message as they are generated
+STREAM_ANSWERS = int(os.getenv("STREAM_ANSWERS", "0"))
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# Entitlement cache
+ENTITLEMENT_CACHE_TTL = float(os.getenv("ENTITLEMENT_CACHE_TTL", "300"))
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000"))
+TRIAL_LEDGER_FLUSH_INTERVAL = float(os.getenv("TRIAL_LEDGER_FLUSH_INTERVAL", "5"))
+
+# /info card cache
+INFO_CACHE_PATH = os.getenv("INFO_CACHE_PATH", "info_cards.sqlite3")
+INFO_CACHE_TTL = float(os.getenv("INFO_CACHE_TTL", str(7 * 24 * 3600)))
+INFO_CACHE_MAX_ENTRIES = int(os.getenv("INFO_CACHE_MAX_ENTRIES", "5000"))
+
+# Ask-mode answer cache: how similar two questions' normalized words must be
+# (Jaccard, 0-1) to share an answer, how long answers are kept, and how many
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.8"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(6 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+# Questions with fewer meaningful words than this are never cached
+ANSWER_CACHE_MIN_WORDS = int(os.getenv("ANSWER_CACHE_MIN_WORDS", "2"))
+
+# Follow-up context: turns kept per (chat, thread, user), the prompt tokens
+# they may add, tokens kept per turn, idle time before a conversation is
+# dropped, and the memory all conversations may use
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "4"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "400"))
+CONTEXT_TURN_TOKENS = int(os.getenv("CONTEXT_TURN_TOKENS", "150"))
+CONTEXT_IDLE_TTL = float(os.getenv("CONTEXT_IDLE_TTL", "1800"))
+CONTEXT_MAX_MEMORY_MB = float(os.getenv("CONTEXT_MAX_MEMORY_MB", "64"))
 
 # Custom Dose Cards
 CUSTOM_DOSE_CARD_DMXE = os.getenv("CUSTOM_DOSE_CARD_DMXE", "DMXE dose information")
@@ -62,6 +176,18 @@ CUSTOM_DOSE_CARD_3_FL_PCP = os.getenv("CUSTOM_DOSE_CARD_3_FL_PCP", "3-FL-PCP dos
 CUSTOM_KVL_DRUGS_PHENETHYLMETHADONE = os.getenv("CUSTOM_KVL_DRUGS_PHENETHYLMETHADONE", "phenethylmethadone, pmh")
 CUSTOM_KVL_DRUGS_NORPHENADOXONE = os.getenv("CUSTOM_KVL_DRUGS_NORPHENADOXONE", "norphenadoxone, n-pdx")
 
-CUSTOM_KVL_DRUGS = MultiKeyDict()
+CUSTOM_KVL_DRUGS = SubstanceResolver()
 CUSTOM_KVL_DRUGS.add(["phenethylmethadone", "pmh"], CUSTOM_KVL_DRUGS_PHENETHYLMETHADONE)
-CUSTOM_KVL_DRUGS.add(["norphenadoxone", "n-pdx"], CUSTOM_KVL_DRUGS_NORPHENADOXONE)
\ No newline at end of file
+CUSTOM_KVL_DRUGS.add(["norphenadoxone", "n-pdx"], CUSTOM_KVL_DRUGS_NORPHENADOXONE)
+
+# Cards served locally by /info without a backend call
+DOSE_CARDS_PATH = os.getenv("DOSE_CARDS_PATH", "cards")
+INSUFFICIENT_DATA_CARD = os.getenv(
+    "INSUFFICIENT_DATA_CARD",
+    "Sorry, there is insufficient data on this substance to provide an accurate drug information card.",
+)
+CUSTOM_DOSE_CARDS = [
+    (["dmxe", "deoxymethoxetamine"], CUSTOM_DOSE_CARD_DMXE),
+    (["fxe", "fluorexetamine"], CUSTOM_DOSE_CARD_FXE),
+    (["3-fl-pcp", "3-fluoro-pcp"], CUSTOM_DOSE_CARD_3_FL_PCP),
+] + [(keys, INSUFFICIENT_DATA_CARD) for keys in CUSTOM_KVL_DRUGS.key_map.values()]
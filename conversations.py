@@ -0,0 +1,138 @@
+import sys
+import time
+import zlib
+from collections import OrderedDict
+
+SEPARATOR = "\x1e"
+# Rough size of a token in English text, for budgets without a tokenizer
+CHARS_PER_TOKEN = 4
+# Per-thread bookkeeping beyond the stored text: dict slot, key and record
+THREAD_OVERHEAD = 240
+
+
+def trim(text, limit):
+    # Cuts `text` to at most `limit` characters, at a line or sentence end
+    # when there is one in the second half.
+    text = text.strip()
+    if len(text) <= limit:
+        return text
+    cut = max(text.rfind("\n", 0, limit), text.rfind(". ", 0, limit) + 1)
+    if cut < limit // 2:
+        cut = limit
+    return text[:cut].rstrip() + " …"
+
+
+class ConversationStore:
+    # Recent turns per (chat, thread, user), so a follow-up question can be
+    # sent with a short history instead of the whole previous answer. Turns
+    # keep the ids of the bot messages that carried the answer, and the
+    # history is only used for replies to one of them. Each
+    # conversation keeps its last `max_turns` turns, each cut to
+    # `turn_tokens`, as one zlib-compressed blob. Conversations idle for
+    # `idle_ttl` seconds are dropped, and the least recently active go first
+    # once everything stored exceeds `max_bytes`.
+    def __init__(
+        self,
+        max_turns=4,
+        token_budget=400,
+        turn_tokens=150,
+        idle_ttl=1800,
+        max_bytes=64 << 20,
+        clock=time.monotonic,
+    ):
+        self.max_turns = max_turns
+        self.budget = token_budget * CHARS_PER_TOKEN
+        self.turn_chars = turn_tokens * CHARS_PER_TOKEN
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.threads = OrderedDict()  # key -> [last active, blob], oldest first
+        self.bytes = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _size(blob):
+        return sys.getsizeof(blob) + THREAD_OVERHEAD
+
+    def _turns(self, blob):
+        fields = zlib.decompress(blob).decode().split(SEPARATOR)
+        return [
+            (question, answer, tuple(map(int, ids.split())))
+            for question, answer, ids in zip(fields[::3], fields[1::3], fields[2::3])
+        ]
+
+    def add(self, key, question, answer, message_ids=()):
+        now = self.clock()
+        self._expire(now)
+        record = self.threads.pop(key, None)
+        turns = []
+        if record is not None:
+            self.bytes -= self._size(record[1])
+            turns = self._turns(record[1])
+        turns.append(
+            (trim(question, self.turn_chars), trim(answer, self.turn_chars), tuple(message_ids))
+        )
+        del turns[: -self.max_turns]
+        text = SEPARATOR.join(
+            field
+            for question, answer, ids in turns
+            for field in (
+                question.replace(SEPARATOR, " "),
+                answer.replace(SEPARATOR, " "),
+                " ".join(map(str, ids)),
+            )
+        )
+        blob = zlib.compress(text.encode())
+        self.threads[key] = [now, blob]
+        self.bytes += self._size(blob)
+        while self.bytes > self.max_bytes and len(self.threads) > 1:
+            self._drop(next(iter(self.threads)))
+
+    def context(self, key, reply_to):
+        # The turns up to the one whose answer is message `reply_to`, as many
+        # as fit the token budget, oldest first. None when there is no recent
+        # conversation or `reply_to` isn't one of its answers, e.g. when the
+        # user replied to a message from another conversation.
+        record = self.threads.get(key)
+        if record is None or record[0] + self.idle_ttl <= self.clock():
+            return None
+        turns = self._turns(record[1])
+        for end in range(len(turns), 0, -1):
+            if reply_to in turns[end - 1][2]:
+                break
+        else:
+            return None
+        lines = []
+        used = 0
+        for question, answer, _ in reversed(turns[:end]):
+            turn = f"Q: {question}\nA: {answer}"
+            if used + len(turn) > self.budget:
+                if not lines:
+                    lines.append(trim(turn, self.budget))
+                break
+            lines.append(turn)
+            used += len(turn)
+        return "\n\n".join(reversed(lines))
+
+    def forget(self, key):
+        if key in self.threads:
+            self._drop(key)
+
+    def _expire(self, now):
+        while self.threads:
+            key, record = next(iter(self.threads.items()))
+            if record[0] + self.idle_ttl > now:
+                break
+            self._drop(key)
+
+    def _drop(self, key):
+        record = self.threads.pop(key)
+        self.bytes -= self._size(record[1])
+        self.evicted += 1
+
+    def stats(self):
+        return {
+            "threads": len(self.threads),
+            "bytes": self.bytes,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,61 @@
+import logging
+import os
+import re
+from resolver import SubstanceResolver
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+ALIASES_HEADER = re.compile(r"^\s*<!--\s*aliases:(.*?)-->\s*\n?", re.IGNORECASE)
+
+
+class LocalCardStore:
+    # Pre-rendered Telegram-HTML dose cards served from memory.
+    #
+    # Cards are loaded once from `path`, a directory of `<name>.html` files.
+    # A file may start with `<!-- aliases: a, b, c -->` to list extra names;
+    # the file stem is always an alias. `builtin` is a list of
+    # (aliases, card) pairs that are registered on every (re)load.
+    # Lookups go through SubstanceResolver, so spelling variants ("3 FL PCP",
+    # "3fl-pcp") find their card. They are exact otherwise: isomers and
+    # analogues are often a character apart, and the wrong card is worse
+    # than a backend call.
+    def __init__(self, path=None, builtin=()):
+        self.path = path
+        self.builtin = list(builtin)
+        self.cards = SubstanceResolver()
+        self.load()
+
+    def load(self):
+        cards = SubstanceResolver()
+        loaded = 0
+        for aliases, card in self.builtin:
+            cards.add(aliases, card)
+            loaded += 1
+
+        if self.path and os.path.isdir(self.path):
+            for filename in sorted(os.listdir(self.path)):
+                stem, extension = os.path.splitext(filename)
+                if extension.lower() != ".html":
+                    continue
+                try:
+                    with open(os.path.join(self.path, filename), encoding="utf-8") as f:
+                        card = f.read()
+                except OSError as error:
+                    logger.error(f"Failed to load dose card {filename}: {error}")
+                    continue
+                aliases = [stem]
+                header = ALIASES_HEADER.match(card)
+                if header:
+                    aliases += header.group(1).split(",")
+                    card = card[header.end() :]
+                cards.add(aliases, card.strip())
+                loaded += 1
+
+        # Swap in one assignment so readers never see a half-loaded store.
+        self.cards = cards
+        return loaded
+
+    reload = load
+
+    def get(self, name):
+        return self.cards.get(name, fuzzy=False)
@@ -0,0 +1,77 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class EntitlementCache:
+    # In-process cache of user_association rows keyed by telegram_id.
+    # Entries expire after `ttl` seconds, the least recently used entry is
+    # evicted past `max_size`, and concurrent misses for the same user share
+    # a single call to `loader`.
+    def __init__(self, loader, ttl=300, max_size=10000, clock=time.monotonic):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def peek(self, telegram_id):
+        entry = self.entries.get(telegram_id)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            del self.entries[telegram_id]
+            return None
+        self.entries.move_to_end(telegram_id)
+        return value
+
+    def put(self, telegram_id, value):
+        self.entries[telegram_id] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(telegram_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def update(self, telegram_id, **fields):
+        # Patch a cached row in place without resetting its TTL.
+        entry = self.entries.get(telegram_id)
+        if entry is not None:
+            entry[1].update(fields)
+
+    def invalidate(self, telegram_id=None):
+        if telegram_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(telegram_id, None)
+
+    async def get(self, telegram_id):
+        value = self.peek(telegram_id)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        future = self.inflight.get(telegram_id)
+        if future is not None:
+            self.hits += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[telegram_id] = future
+        try:
+            value = await self.loader(telegram_id)
+            if value is not None:
+                self.put(telegram_id, value)
+            future.set_result(value)
+        except Exception as error:
+            future.set_exception(error)
+            # Mark retrieved so a miss with no waiters doesn't log a warning.
+            future.exception()
+        finally:
+            del self.inflight[telegram_id]
+            if not future.done():
+                future.cancel()
+        return future.result()
@@ -7,9 +7,13 @@ def format_message(input_string):
     return formatted_string
 
 
+_MARKDOWN_V2_ESCAPES = str.maketrans(
+    {char: "\\" + char for char in r"_*[]()~`>#\+=-|{}.!"}
+)
+
+
 def escape_markdown_v2(text):
-    escape_chars = r"_*[]()~`>#\+=-|{}.!"
-    return "".join("\\" + char if char in escape_chars else char for char in text)
+    return text.translate(_MARKDOWN_V2_ESCAPES)
 
 
 def sanitize_html(html):
@@ -20,21 +24,240 @@ def sanitize_html(html):
     return sanitized_html
 
 
-def convert_to_telegram_html(text):
-    text = re.sub(r"## (.*)", r"<b>\1</b>", text)
-    text = re.sub(r"\*\*(.*?)\*\*", r"<b>\1</b>", text)
-    text = re.sub(r"__(.*?)__", r"<u>\1</u>", text)
-    text = re.sub(r"\*(.*?)\*", r"<i>\1</i>", text)
-    text = re.sub(r"_(.*?)_", r"<i>\1</i>", text)
-    text = re.sub(r"\+\+(.*?)\+\+", r"<u>\1</u>", text)
-    text = re.sub(r"~~(.*?)~~", r"<s>\1</s>", text)
-    text = re.sub(r"\|\|(.*?)\|\|", r'<span class="tg-spoiler">\1</span>', text)
-    text = re.sub(r"\[(.*?)\]\((http[s]?:\/\/.*?)\)", r'<a href="\2">\1</a>', text)
-    text = re.sub(
-        r"\[(.*?)\]\(tg:\/\/user\?id=(\d+)\)", r'<a href="tg://user?id=\2">\1</a>', text
-    )
-    text = re.sub(r"`([^`]+)`", r"<code>\1</code>", text)
-    text = re.sub(r"```([^`]*)```", r"<pre>\1</pre>", text, flags=re.DOTALL)
-    text = re.sub(r"^> (.*)", r"<blockquote>\1</blockquote>", text, flags=re.MULTILINE)
+# Tags Telegram's HTML parse mode understands; any other tag is dropped.
+# Telegram takes <span> only as a spoiler, so other spans are dropped too.
+TELEGRAM_TAGS = frozenset(
+    [
+        "a", "b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "span",
+        "tg-spoiler", "tg-emoji", "code", "pre", "blockquote",
+    ]
+)
+
+# Unsupported block tags still end a line, so their text doesn't run together.
+_LINE_BREAK_TAGS = frozenset(
+    ["br", "p", "div", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6"]
+)
+
+# One alternation over every construct, scanned once. Every branch starts
+# with a literal character (line-start and word-boundary checks come right
+# after it), which lets the regex engine skip plain text without trying
+# each branch; inline spans render their inside recursively.
+_MARKDOWN = re.compile(
+    r"```(?P<lang>[\w+-]*)\n?(?P<fenced>[^`]*)```"
+    r"|`(?P<code>[^`]+)`"
+    r"|\[(?P<label>[^\]\n]*)\]\((?P<href>(?:https?://|tg://user\?id=\d+)[^)\s]*)\)"
+    r"|<(?P<tag>/?(?P<tag_name>[a-zA-Z][\w-]*)[^<>]*>)"
+    r"|&(?P<entity>(?:#\d+|#x[0-9a-fA-F]+|lt|gt|amp|quot);)"
+    r"|#(?<![^\n]#)#{0,5} +(?P<heading>.+)"
+    r"|>(?<![^\n]>) (?P<quote>.*)"
+    r"|\*\*(?P<bold>.+?)\*\*"
+    r"|__(?P<underline>.+?)__"
+    r"|\+\+(?P<plus_underline>.+?)\+\+"
+    r"|~~(?P<strike>.+?)~~"
+    r"|\|\|(?P<spoiler>.+?)\|\|"
+    r"|\*(?![\s*])(?P<star_italic>.+?)(?<!\s)\*"
+    r"|_(?<!\w_)(?P<italic>.+?)_(?!\w)"
+    r"|<(?P<lt>)|>(?P<gt>)|&(?P<amp>)"
+)
+
+_SPANS = {
+    "heading": ("<b>", "</b>"),
+    "quote": ("<blockquote>", "</blockquote>"),
+    "bold": ("<b>", "</b>"),
+    "underline": ("<u>", "</u>"),
+    "plus_underline": ("<u>", "</u>"),
+    "strike": ("<s>", "</s>"),
+    "spoiler": ('<span class="tg-spoiler">', "</span>"),
+    "star_italic": ("<i>", "</i>"),
+    "italic": ("<i>", "</i>"),
+}
+
+
+# (opening, closing) of each span by the index of its group, so a match's
+# lastindex finds it without a name lookup.
+_GROUP_NAMES = {index: name for name, index in _MARKDOWN.groupindex.items()}
+_SPAN_BY_GROUP = tuple(
+    _SPANS.get(_GROUP_NAMES.get(index)) for index in range(_MARKDOWN.groups + 1)
+)
+
+_SPOILER_CLASS = re.compile(r"""\bclass\s*=\s*["']?tg-spoiler\b""", re.IGNORECASE)
+
+_LITERALS = {"lt": "&lt;", "gt": "&gt;", "amp": "&amp;"}
+_NEEDS_RENDERING = re.compile(r"[`\[<&#>*_+~|]")
+# The same characters as a set, cheaper to check on a span's short inside
+_MARKUP_CHARS = frozenset("`[<&#>*_+~|")
+
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def convert_to_telegram_html(text, allowed_tags=TELEGRAM_TAGS):
+    # Markdown (and any HTML mixed in) to Telegram's HTML parse mode in one
+    # pass: stray <, > and & are escaped, and tags outside `allowed_tags`
+    # are dropped. Plain text between matches is copied by re.sub itself;
+    # only markup reaches Python.
+    spans = []  # whether each open <span> tag was kept
+
+    def render(text):
+        if _NEEDS_RENDERING.search(text) is None:
+            return text
+        return _MARKDOWN.sub(replace, text)
+
+    def replace(match):
+        # Spans are most of the markup in a formatted answer: they come
+        # first, and their inside, usually plain, is only rendered when it
+        # holds markup.
+        index = match.lastindex
+        span = _SPAN_BY_GROUP[index]
+        if span is not None:
+            inside = match.group(index)
+            if not _MARKUP_CHARS.isdisjoint(inside):
+                inside = _MARKDOWN.sub(replace, inside)
+            return span[0] + inside + span[1]
+        kind = match.lastgroup
+        literal = _LITERALS.get(kind)
+        if literal is not None:
+            return literal
+        if kind == "tag":
+            tag = match.group("tag")
+            name = match.group("tag_name").lower()
+            if name == "span" and name in allowed_tags:
+                if tag[0] == "/":
+                    return "</span>" if spans and spans.pop() else ""
+                spans.append(_SPOILER_CLASS.search(tag) is not None)
+                return '<span class="tg-spoiler">' if spans[-1] else ""
+            if name in allowed_tags:
+                return "<" + tag
+            if name == "br" or (name in _LINE_BREAK_TAGS and tag[0] == "/"):
+                return "\n"
+            return ""
+        if kind == "entity":
+            return match.group()
+        if kind == "fenced":
+            lang = match.group("lang")
+            body = _escape(match.group("fenced"))
+            if lang:
+                return f'<pre><code class="language-{lang}">{body}</code></pre>'
+            return f"<pre>{body}</pre>"
+        if kind == "code":
+            return f"<code>{_escape(match.group('code'))}</code>"
+        href = _escape(match.group("href")).replace('"', "&quot;")
+        return f'<a href="{href}">{render(match.group("label"))}</a>'
+
+    return render(text)
 
+
+# Telegram's limit on message text, counted in UTF-16 code units after
+# entity parsing (tags don't count, an HTML entity counts as one).
+MAX_MESSAGE_LENGTH = 4096
+
+_HTML_TOKEN = re.compile(
+    r"<[^<>]*>|&(?:#\d+|#x[0-9a-fA-F]+|lt|gt|amp|quot);|\n|[ \t]+|[^<&\s]+|[<&\s]"
+)
+_TAG_NAME = re.compile(r"<(/?)([a-zA-Z][\w-]*)")
+_VOID_TAGS = {"br"}
+
+
+def utf16_length(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def utf16_prefix(text, units):
+    # Longest prefix of `text` that fits in `units` UTF-16 code units.
+    used = 0
+    for index, char in enumerate(text):
+        used += 2 if ord(char) > 0xFFFF else 1
+        if used > units:
+            return text[:index]
     return text
+
+
+def split_html(text, limit=MAX_MESSAGE_LENGTH):
+    # Splits Telegram HTML into chunks of at most `limit` visible UTF-16
+    # units in one pass. Cuts fall on the last newline, else the last
+    # space, else mid-word, and never inside a tag or entity. Tags still
+    # open at a cut are closed at the end of the chunk and reopened at the
+    # start of the next.
+    chunks = []
+    tokens = [match.group() for match in _HTML_TOKEN.finditer(text)]
+    tokens.reverse()  # used as a stack, so a cut can push tokens back
+
+    stack = []  # (name, opening tag) of the tags open at this point
+    parts = []
+    size = 0
+    has_text = False
+    newline_break = space_break = None  # (len(parts), stack) just after
+
+    def emit(end, open_tags):
+        if has_text:
+            closing = "".join(f"</{name}>" for name, _ in reversed(open_tags))
+            chunks.append("".join(parts[:end]) + closing)
+
+    while tokens:
+        token = tokens.pop()
+        first = token[0]
+
+        if first == "<" and len(token) > 1 and token[-1] == ">":
+            match = _TAG_NAME.match(token)
+            if match is not None:
+                closing, name = match.group(1), match.group(2).lower()
+                if closing:
+                    for index in range(len(stack) - 1, -1, -1):
+                        if stack[index][0] == name:
+                            del stack[index]
+                            break
+                elif name not in _VOID_TAGS and not token.endswith("/>"):
+                    stack.append((name, token))
+            parts.append(token)
+            continue
+
+        units = 1 if first == "&" else utf16_length(token)
+        if size + units <= limit:
+            parts.append(token)
+            size += units
+            if first not in " \t\n":
+                has_text = True
+            elif has_text:
+                # Only breaks with text before them count, so every cut
+                # makes progress.
+                if first == "\n":
+                    newline_break = (len(parts), tuple(stack))
+                else:
+                    space_break = (len(parts), tuple(stack))
+            continue
+
+        # The token doesn't fit: cut at the best break seen so far and
+        # replay whatever followed it into the next chunk.
+        cut = newline_break or space_break
+        if cut is not None:
+            end, open_tags = cut
+            emit(end, open_tags)
+            tokens.append(token)
+            tokens.extend(reversed(parts[end:]))
+        elif first in " \t\n":
+            # Whitespace at a cut is dropped rather than carried over.
+            emit(len(parts), stack)
+            open_tags = tuple(stack)
+        else:
+            head = utf16_prefix(token, limit - size) if first != "&" else ""
+            if not head and not has_text:
+                head = token[0]  # `limit` is narrower than one character
+            if head:
+                parts.append(head)
+                has_text = True
+                if len(head) < len(token):
+                    tokens.append(token[len(head) :])
+            else:
+                tokens.append(token)
+            emit(len(parts), stack)
+            open_tags = tuple(stack)
+
+        stack = list(open_tags)
+        parts = [opening for _, opening in open_tags]
+        size = 0
+        has_text = False
+        newline_break = space_break = None
+
+    emit(len(parts), stack)
+    return chunks
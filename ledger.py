@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+
+class SupabaseTrialStore:
+    # Writes the prompts each user consumed since the last flush as
+    # decrements in one RPC, so grants made in the database in the meantime
+    # are kept. The function has to exist in Supabase:
+    #
+    #   create or replace function consume_trial_prompts(telegram_ids bigint[], amounts int[])
+    #   returns void language sql as $$
+    #     update user_association u
+    #     set trial_prompts = greatest(u.trial_prompts - c.amount, 0)
+    #     from unnest(telegram_ids, amounts) as c(telegram_id, amount)
+    #     where u.telegram_id = c.telegram_id
+    #   $$;
+    def __init__(self, supabase, function="consume_trial_prompts"):
+        self.supabase = supabase
+        self.function = function
+
+    def _write(self, consumed):
+        telegram_ids = list(consumed)
+        self.supabase.rpc(
+            self.function,
+            {
+                "telegram_ids": telegram_ids,
+                "amounts": [consumed[telegram_id] for telegram_id in telegram_ids],
+            },
+        ).execute()
+
+    async def write(self, consumed):
+        await asyncio.to_thread(self._write, consumed)
+
+
+class LocalBalances:
+    # Trial balances held in this process, for users with prompts consumed
+    # since the last flush and for `hold` seconds after it, the entitlement
+    # cache TTL, so a cached row read before the flush can't reseed them.
+    # With several worker processes, use a shared backend instead
+    # (shared_state.SqliteState).
+    def __init__(self, hold=300, clock=time.monotonic):
+        self.hold = hold
+        self.clock = clock
+        self.balances = {}
+        self.pending = defaultdict(int)
+        self.flushed = {}  # telegram_id -> flushed at, oldest first
+
+    def consume(self, telegram_id, known_balance):
+        self._expire()
+        remaining = self.balances.get(telegram_id, known_balance)
+        if remaining <= 0:
+            return None
+        self.balances[telegram_id] = remaining - 1
+        self.pending[telegram_id] += 1
+        self.flushed.pop(telegram_id, None)
+        return remaining - 1
+
+    def reset(self, telegram_id):
+        # With unwritten prompts the balance is reread after the next flush
+        if telegram_id not in self.pending:
+            self.balances.pop(telegram_id, None)
+            self.flushed.pop(telegram_id, None)
+
+    def take_pending(self):
+        pending = dict(self.pending)
+        self.pending.clear()
+        return pending
+
+    def restore_pending(self, pending):
+        for telegram_id, amount in pending.items():
+            self.pending[telegram_id] += amount
+
+    def forget(self, telegram_ids):
+        # Users flushed and idle for `hold` seconds go back to being read
+        # from the database
+        now = self.clock()
+        for telegram_id in telegram_ids:
+            if telegram_id not in self.pending:
+                self.flushed.pop(telegram_id, None)
+                self.flushed[telegram_id] = now
+        self._expire()
+
+    def _expire(self):
+        deadline = self.clock() - self.hold
+        while self.flushed:
+            telegram_id, flushed_at = next(iter(self.flushed.items()))
+            if flushed_at > deadline:
+                break
+            del self.flushed[telegram_id]
+            self.balances.pop(telegram_id, None)
+
+
+class TrialLedger:
+    # Trial-prompt balances with write-behind persistence. `try_consume`
+    # never awaits, so check-and-decrement is atomic on the event loop even
+    # when one user sends many messages at once; `balances` decides where
+    # the balances live (this process by default). Flushes write decrements
+    # and then forget the flushed users once caches have caught up, so later
+    # reads of their balance come from the database again.
+    def __init__(self, store, flush_interval=5.0, balances=None):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.balances = LocalBalances() if balances is None else balances
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def try_consume(self, telegram_id, known_balance):
+        # `known_balance` seeds the ledger when a user has no unflushed
+        # prompts; until the next flush the ledger decides for that user.
+        return self.balances.consume(telegram_id, known_balance)
+
+    def reset(self, telegram_id):
+        # Reread a user's balance, e.g. after an admin grant.
+        self.balances.reset(telegram_id)
+
+    async def flush(self):
+        async with self._flush_lock:
+            pending = self.balances.take_pending()
+            if not pending:
+                return 0
+            # Decrements must be written once: a flush cancelled by stop()
+            # still waits for its write instead of retrying it later.
+            write = asyncio.ensure_future(self.store.write(pending))
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                await asyncio.wait([write])
+                self._settle(write, pending)
+                raise
+            except Exception:
+                pass
+            return self._settle(write, pending)
+
+    def _settle(self, write, pending):
+        error = write.exception()
+        if error is not None:
+            logger.error(f"Error flushing trial ledger: {error}")
+            self.balances.restore_pending(pending)
+            return 0
+        self.balances.forget(pending)
+        return len(pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
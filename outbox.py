@@ -0,0 +1,245 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+import telegram
+from ratelimit import TokenBucket
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+# Priority lanes, lowest value first.
+HIGH = 0  # answers to the user who is waiting
+NORMAL = 1
+LOW = 2  # admin audit traffic
+
+# Calls that post a new message, the only ones Telegram's per-chat message
+# limits count. Edits, deletions and chat actions only use the global budget.
+MESSAGE_METHODS = frozenset({"send_message"})
+
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    if hasattr(retry_after, "total_seconds"):
+        return retry_after.total_seconds()
+    return retry_after
+
+
+class _Job:
+    __slots__ = (
+        "method", "chat_id", "priority", "seq", "kwargs", "future", "key", "retries"
+    )
+
+    def __init__(self, method, chat_id, priority, seq, kwargs, future, key):
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.kwargs = kwargs
+        self.future = future
+        self.key = key
+        self.retries = 0
+
+
+class Outbox:
+    # Outbound Bot API scheduler. Calls are queued per chat (so each chat
+    # sees its messages in order) and dispatched by priority lane, within a
+    # global token bucket and per-chat buckets that follow Telegram's limits
+    # (under 30 calls/s overall, 1 message/s per private chat, 20
+    # messages/min per group; only new messages use the per-chat buckets).
+    # A 429 RetryAfter pauses only the affected chat and the call is retried.
+    # Pending calls that share a `coalesce` key are merged into the latest.
+    #
+    # Every method returns a future: await it for the result (e.g. to get a
+    # message id) or ignore it to fire and forget.
+    def __init__(
+        self,
+        bot=None,
+        global_rate=25,
+        global_burst=5,
+        private_rate=1,
+        private_burst=3,
+        group_rate=20 / 60,
+        group_burst=5,
+        max_inflight=64,
+        max_retries=5,
+        clock=time.monotonic,
+    ):
+        self.bot = bot
+        self.clock = clock
+        self.global_bucket = TokenBucket(global_rate, global_burst, clock=clock)
+        self.private_buckets = TokenBucket(private_rate, private_burst, clock=clock)
+        self.group_buckets = TokenBucket(group_rate, group_burst, clock=clock)
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self.queues = {}
+        self.busy = set()
+        self.ready = []
+        self.paused_until = {}
+        self.pending_keys = {}
+        self.counter = itertools.count()
+        self.inflight = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.tasks = set()
+        self.sent = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    # Bot API methods handlers use.
+
+    def send_message(self, chat_id, priority=HIGH, coalesce=None, **kwargs):
+        return self.submit("send_message", chat_id, priority, coalesce, kwargs)
+
+    def edit_message_text(self, chat_id, message_id, priority=HIGH, **kwargs):
+        key = ("edit", chat_id, message_id)
+        kwargs["message_id"] = message_id
+        return self.submit("edit_message_text", chat_id, priority, key, kwargs)
+
+    def delete_message(self, chat_id, message_id, priority=NORMAL):
+        kwargs = {"message_id": message_id}
+        return self.submit("delete_message", chat_id, priority, None, kwargs)
+
+    def delete_messages(self, chat_id, message_ids, priority=NORMAL):
+        kwargs = {"message_ids": message_ids}
+        return self.submit("delete_messages", chat_id, priority, None, kwargs)
+
+    def send_chat_action(self, chat_id, action, priority=HIGH, **kwargs):
+        kwargs["action"] = action
+        key = ("action", chat_id)
+        return self.submit("send_chat_action", chat_id, priority, key, kwargs)
+
+    # Scheduling.
+
+    def submit(self, method, chat_id, priority, key, kwargs):
+        if key is not None and key in self.pending_keys:
+            job = self.pending_keys[key]
+            job.kwargs = {**kwargs, "chat_id": chat_id}
+            self.coalesced += 1
+            return job.future
+
+        future = asyncio.get_running_loop().create_future()
+        # Fire-and-forget callers never read the result; don't warn about it.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        kwargs["chat_id"] = chat_id
+        job = _Job(method, chat_id, priority, next(self.counter), kwargs, future, key)
+        if key is not None:
+            self.pending_keys[key] = job
+
+        queue = self.queues.setdefault(chat_id, deque())
+        queue.append(job)
+        if len(queue) == 1 and chat_id not in self.busy:
+            self._push(chat_id)
+        return future
+
+    def _push(self, chat_id):
+        queue = self.queues.get(chat_id)
+        if queue:
+            head = queue[0]
+            heapq.heappush(self.ready, (head.priority, head.seq, chat_id))
+            self.wakeup.set()
+
+    def _buckets(self, chat_id):
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        return self.group_buckets if is_group else self.private_buckets
+
+    def _chat_delay(self, chat_id, method, now):
+        paused = self.paused_until.get(chat_id, 0) - now
+        if paused > 0:
+            return paused
+        self.paused_until.pop(chat_id, None)
+        if method not in MESSAGE_METHODS:
+            return 0
+        return self._buckets(chat_id).delay(chat_id)
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.ready or self.inflight >= self.max_inflight:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            now = self.clock()
+            _, _, chat_id = self.ready[0]
+            method = self.queues[chat_id][0].method
+            delay = self._chat_delay(chat_id, method, now)
+            if delay > 0:
+                heapq.heappop(self.ready)
+                loop.call_later(delay, self._push, chat_id)
+                continue
+
+            delay = self.global_bucket.delay(None)
+            if delay > 0:
+                if method in MESSAGE_METHODS:
+                    self._buckets(chat_id).refund(chat_id)
+                await asyncio.sleep(delay)
+                continue
+
+            heapq.heappop(self.ready)
+            job = self.queues[chat_id].popleft()
+            if job.key is not None and self.pending_keys.get(job.key) is job:
+                del self.pending_keys[job.key]
+            self.busy.add(chat_id)
+            self.inflight += 1
+            task = loop.create_task(self._execute(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _execute(self, job):
+        try:
+            result = await getattr(self.bot, job.method)(**job.kwargs)
+        except telegram.error.RetryAfter as error:
+            self.paused_until[job.chat_id] = self.clock() + retry_after_seconds(error)
+            job.retries += 1
+            if job.retries <= self.max_retries:
+                self.retried += 1
+                self.queues.setdefault(job.chat_id, deque()).appendleft(job)
+            else:
+                self.failed += 1
+                job.future.set_exception(error)
+        except Exception as error:
+            self.failed += 1
+            logger.error(f"Outbox {job.method} to {job.chat_id} failed: {error}")
+            job.future.set_exception(error)
+        else:
+            self.sent += 1
+            job.future.set_result(result)
+        finally:
+            self.inflight -= 1
+            self.busy.discard(job.chat_id)
+            if self.queues.get(job.chat_id):
+                self._push(job.chat_id)
+            else:
+                self.queues.pop(job.chat_id, None)
+            self.wakeup.set()
+
+    def start(self, bot=None):
+        if bot is not None:
+            self.bot = bot
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def stop(self, timeout=10):
+        # Give queued messages a chance to go out before shutting down.
+        deadline = self.clock() + timeout
+        while (self.queues or self.inflight) and self.clock() < deadline:
+            await asyncio.sleep(0.05)
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "retried": self.retried,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+            "queued": sum(len(queue) for queue in self.queues.values()),
+        }
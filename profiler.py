@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+# Leaf frames from these files mean the event loop was waiting for I/O
+IDLE_FILES = ("selectors.py",)
+
+
+def frame_label(frame):
+    filename, name, line = frame
+    return f"{os.path.basename(filename)}:{name}:{line}"
+
+
+class SamplingProfiler:
+    # Samples the event loop thread's stack every `interval` seconds from a
+    # background thread while a run is active, and does nothing otherwise.
+    # A run writes collapsed stacks (the input of flamegraph.pl and
+    # speedscope) and a top-functions report to `directory`.
+    def __init__(self, directory, interval=0.005, max_depth=64):
+        self.directory = directory
+        self.interval = interval
+        self.max_depth = max_depth
+        self.active = False
+        self.remaining_updates = None
+        self.finished = None
+
+    def note_update(self):
+        # Called once per handled update; counts down runs bounded by updates
+        if self.remaining_updates is not None:
+            self.remaining_updates -= 1
+            if self.remaining_updates <= 0:
+                self.finished.set()
+
+    def _sample(self, thread_id, stop, stacks):
+        current_frames = sys._current_frames
+        max_depth = self.max_depth
+        while not stop.wait(self.interval):
+            frame = current_frames().get(thread_id)
+            stack = []
+            while frame is not None and len(stack) < max_depth:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_name, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                stacks[tuple(reversed(stack))] += 1
+
+    async def run(self, seconds=None, updates=None, max_seconds=600):
+        # Profiles the calling event loop for `seconds`, or until `updates`
+        # updates were noted (at most `max_seconds`). Returns the report.
+        if self.active:
+            raise RuntimeError("a profile is already running")
+        self.active = True
+        self.finished = asyncio.Event()
+        self.remaining_updates = updates
+        stacks = Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample,
+            args=(threading.get_ident(), stop, stacks),
+            name="psyai-profiler",
+            daemon=True,
+        )
+        started = time.monotonic()
+        sampler.start()
+        try:
+            timeout = max_seconds if seconds is None else min(seconds, max_seconds)
+            try:
+                await asyncio.wait_for(self.finished.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            handled = None if updates is None else updates - max(0, self.remaining_updates)
+            self.active = False
+            self.remaining_updates = None
+        elapsed = time.monotonic() - started
+        return await asyncio.to_thread(self._report, stacks, elapsed, handled)
+
+    def _report(self, stacks, elapsed, updates):
+        total = sum(stacks.values())
+        idle = sum(
+            count for stack, count in stacks.items()
+            if os.path.basename(stack[-1][0]) in IDLE_FILES
+        )
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in stacks.items():
+            if os.path.basename(stack[-1][0]) in IDLE_FILES:
+                continue
+            own[stack[-1]] += count
+            for frame in set(stack):
+                inclusive[frame] += count
+
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        collapsed_path = os.path.join(self.directory, f"profile-{stamp}.collapsed")
+        report_path = os.path.join(self.directory, f"profile-{stamp}.txt")
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            for stack, count in stacks.most_common():
+                f.write(";".join(map(frame_label, stack)) + f" {count}\n")
+
+        busy = total - idle
+        lines = [
+            f"{elapsed:.1f}s, {total} samples every {self.interval * 1000:g}ms, "
+            f"{busy} busy ({busy / total:.0%} of the loop's time)" if total else
+            f"{elapsed:.1f}s, no samples",
+        ]
+        for title, counts in (("Self time", own), ("Including callees", inclusive)):
+            lines.append("")
+            lines.append(f"{title} (% of busy samples):")
+            for frame, count in counts.most_common(25):
+                lines.append(f"{count / busy:6.1%}  {frame_label(frame)}  {frame[0]}")
+        with open(report_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+        return {
+            "seconds": elapsed,
+            "samples": total,
+            "busy": busy,
+            "updates": updates,
+            "top": [(frame_label(frame), count / busy) for frame, count in own.most_common(10)],
+            "collapsed_path": collapsed_path,
+            "report_path": report_path,
+        }
@@ -1,5 +1,9 @@
+import asyncio
+import functools
 import logging
-import requests
+import os
+import re
+import time
 import stripe
 import telegram
 from telegram import Update
@@ -10,17 +14,138 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
 )
-import textwrap
-from telegram.helpers import escape_markdown
-from datetime import timedelta
 from telegram.constants import ChatAction
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
 from supabase import create_client
 from constants import *
-from utils import RateLimiter, calc_downtime
-from formatters import sanitize_html, convert_to_telegram_html
+from utils import calc_downtime
+from ratelimit import CompositeLimiter, SlidingWindowCounter, TokenBucket
+from formatters import (
+    MAX_MESSAGE_LENGTH,
+    convert_to_telegram_html,
+    split_html,
+    utf16_length,
+)
+from backend import PsyAIClient, build_prompt_payload
+from routing import BackendRouter, CircuitBreaker, Route
+from entitlements import EntitlementCache
+from admission import AddressedToBot, AdmissionPipeline
+from ledger import LocalBalances, SupabaseTrialStore, TrialLedger
+from card_cache import CardCache
+from answer_cache import AnswerCache
+from resolver import canonicalize
+from conversations import ConversationStore, trim
+from dose_cards import LocalCardStore
+from singleflight import SingleFlight
+from scheduler import (
+    LLMScheduler,
+    Shed,
+    PRIVILEGED as PRIVILEGED_TIER,
+    RESTRICTED as RESTRICTED_TIER,
+    SUBSCRIBER as SUBSCRIBER_TIER,
+    TRIAL as TRIAL_TIER,
+)
+from streaming import StreamingReply
+from outbox import Outbox, LOW as LOW_PRIORITY
+from audit import AuditDigest
+from broadcast import BroadcastEngine, BroadcastStore
+from purge import PurgeStore, TopicLog, TopicPurger
+from webhooks import StripeEvents, WebhookServer, application_inbox, serve_webhook
+from metrics import Registry
+from profiler import SamplingProfiler
+from shared_state import SharedSlidingWindowCounter, SharedTokenBucket, SqliteState
+from sharding import (
+    ChatOrderedProcessor,
+    EntitlementFanout,
+    ShardRouter,
+    release_chat_turn,
+    run_ingest,
+    serve_shard,
+    shard_for,
+)
+
+# Which worker this process is in multi-process mode; None when it is the only one
+shard_index = None
+# Where this worker sends control messages meant for every worker
+control_queue = None
+
+shared_state = (
+    SqliteState(STATE_PATH, hold=ENTITLEMENT_CACHE_TTL) if STATE_BACKEND == "sqlite" else None
+)
+
+if shared_state is None:
+    rate_limiter = CompositeLimiter(
+        {
+            "user": SlidingWindowCounter(limit=RATE_LIMIT_USER_PER_HOUR, window=3600),
+            "chat": SlidingWindowCounter(
+                limit=RATE_LIMIT_RESTRICTED_GROUP_PER_HOUR, window=3600
+            ),
+            "global": TokenBucket(
+                rate=RATE_LIMIT_GLOBAL_PER_SECOND, capacity=RATE_LIMIT_GLOBAL_BURST
+            ),
+        }
+    )
+else:
+    rate_limiter = CompositeLimiter(
+        {
+            "user": SharedSlidingWindowCounter(
+                shared_state, "user", limit=RATE_LIMIT_USER_PER_HOUR, window=3600
+            ),
+            "chat": SharedSlidingWindowCounter(
+                shared_state,
+                "chat",
+                limit=RATE_LIMIT_RESTRICTED_GROUP_PER_HOUR,
+                window=3600,
+            ),
+            "global": SharedTokenBucket(
+                shared_state,
+                "global",
+                rate=RATE_LIMIT_GLOBAL_PER_SECOND,
+                capacity=RATE_LIMIT_GLOBAL_BURST,
+            ),
+        }
+    )
+
+metrics = Registry()
+request_total = metrics.counter(
+    "psyai_requests_total",
+    "Questions handled, by handler, model and outcome",
+    ("handler", "model", "outcome"),
+)
+request_seconds = metrics.histogram(
+    "psyai_request_seconds",
+    "Time from receiving a question to handing its answer to the outbox",
+    ("handler", "outcome"),
+)
+stage_seconds = metrics.histogram(
+    "psyai_stage_seconds",
+    "Time spent in each stage of answering a question",
+    ("handler", "stage"),
+)
+profiler = SamplingProfiler(PROFILE_DIR, interval=PROFILE_INTERVAL_MS / 1000)
+metrics_server = WebhookServer(METRICS_LISTEN, METRICS_PORT)
+metrics_server.add_metrics("/metrics", metrics)
+
+
+def instrumented(handler):
+    # For handlers that return (model, outcome)
+    def decorate(respond):
+        @functools.wraps(respond)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            model, outcome = "", "exception"
+            try:
+                model, outcome = await respond(update, context)
+            finally:
+                request_total.inc(handler, model, outcome)
+                request_seconds.observe(time.perf_counter() - started, handler, outcome)
+                if profiler.active:
+                    profiler.note_update()
+
+        return wrapper
+
+    return decorate
 
-rate_limiter = RateLimiter(max_requests=20, window_size=timedelta(hours=1))
 
 stripe.api_key = STRIPE_API_KEY
 endpoint_secret = STRIPE_ENDPOINT_SECRET
@@ -34,9 +159,78 @@ logger = logging.getLogger("PsyAI Log 🤖")
 # Supabase
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# PsyAI backend
+psyai_client = PsyAIClient(
+    BASE_URL_BETA,
+    pool_size=BACKEND_POOL_SIZE,
+    keepalive=BACKEND_KEEPALIVE,
+    connect_timeout=BACKEND_CONNECT_TIMEOUT,
+    read_timeout=BACKEND_READ_TIMEOUT,
+)
+backend_clients = {"beta": psyai_client}
+if BASE_URL and BASE_URL != BASE_URL_BETA:
+    backend_clients["main"] = PsyAIClient(
+        BASE_URL,
+        pool_size=BACKEND_POOL_SIZE,
+        keepalive=BACKEND_KEEPALIVE,
+        connect_timeout=BACKEND_CONNECT_TIMEOUT,
+        read_timeout=BACKEND_READ_TIMEOUT,
+    )
+backend_models = ["openai", "gemini"] + ([LLM_ALT_MODEL_ID] if LLM_ALT_MODEL_ID else [])
+# Every model on every endpoint; a question goes to its own model first and
+# only falls back to, or hedges with, another model when that one is slow or down
+backend_router = BackendRouter(
+    [
+        Route(
+            f"{endpoint}/{model}",
+            client,
+            model,
+            breaker=CircuitBreaker(
+                failures=BACKEND_BREAKER_FAILURES, cooldown=BACKEND_BREAKER_COOLDOWN
+            ),
+        )
+        for endpoint, client in backend_clients.items()
+        for model in backend_models
+    ],
+    hedge_percentile=BACKEND_HEDGE_PERCENTILE,
+    hedge_budget=BACKEND_HEDGE_BUDGET,
+)
+backend_flight = SingleFlight()
+# Each worker process gets an equal share of the backend concurrency
+llm_scheduler = LLMScheduler(
+    max_concurrency=max(1, LLM_MAX_CONCURRENCY // WORKERS),
+    max_queue=LLM_MAX_QUEUE,
+    deadline=LLM_QUEUE_DEADLINE,
+)
+
+# Outbound Bot API calls from the answer path; started once the bot exists
+# Each worker process gets an equal share of the bot's global send budget
+outbox = Outbox(
+    global_rate=OUTBOX_GLOBAL_PER_SECOND / WORKERS,
+    max_inflight=OUTBOX_MAX_INFLIGHT,
+)
+
+audit = AuditDigest(
+    functools.partial(outbox.send_message, priority=LOW_PRIORITY),
+    ADMIN_TELEGRAM_ID,
+    log_path=AUDIT_LOG_PATH,
+    interval=AUDIT_DIGEST_INTERVAL,
+    batch_size=AUDIT_DIGEST_BATCH_SIZE,
+)
+
 
 def get_or_create_user_association(telegram_user_id):
     try:
+        response = (
+            supabase.table("user_association")
+            .select("*")
+            .eq("telegram_id", telegram_user_id)
+            .limit(1)
+            .execute()
+        )
+        if response.data:
+            return response.data[0]
+
         new_user = {
             "telegram_id": telegram_user_id,
             "trial_prompts": 5,
@@ -45,7 +239,7 @@ def get_or_create_user_association(telegram_user_id):
         }
         response = (
             supabase.table("user_association")
-            .upsert(new_user, on_conflict="telegram_id")
+            .upsert(new_user, on_conflict="telegram_id", ignore_duplicates=True)
             .execute()
         )
 
@@ -62,10 +256,168 @@ def get_or_create_user_association(telegram_user_id):
         return None
 
 
-def check_stripe_sub(telegram_user_id):
-    print("ID:")
-    print(telegram_user_id)
-    user_association = get_or_create_user_association(telegram_user_id=telegram_user_id)
+async def load_user_association(telegram_user_id):
+    return await asyncio.to_thread(get_or_create_user_association, telegram_user_id)
+
+
+entitlements = EntitlementCache(
+    load_user_association,
+    ttl=ENTITLEMENT_CACHE_TTL,
+    max_size=ENTITLEMENT_CACHE_SIZE,
+)
+
+card_cache = CardCache(
+    INFO_CACHE_PATH, ttl=INFO_CACHE_TTL, max_entries=INFO_CACHE_MAX_ENTRIES
+)
+
+dose_cards = LocalCardStore(DOSE_CARDS_PATH, builtin=CUSTOM_DOSE_CARDS)
+
+
+def canonical_substance(word):
+    # Aliases of a substance with a local card all map to its first alias
+    match = dose_cards.cards.resolve(word, fuzzy=False)
+    return match and canonicalize(dose_cards.cards.key_map[match[1]][0])
+
+
+conversations = ConversationStore(
+    max_turns=CONTEXT_MAX_TURNS,
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    turn_tokens=CONTEXT_TURN_TOKENS,
+    idle_ttl=CONTEXT_IDLE_TTL,
+    max_bytes=int(CONTEXT_MAX_MEMORY_MB * 1024 * 1024),
+)
+
+answer_cache = AnswerCache(
+    threshold=ANSWER_CACHE_THRESHOLD,
+    ttl=ANSWER_CACHE_TTL,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    min_words=ANSWER_CACHE_MIN_WORDS,
+    canonical_substance=canonical_substance,
+)
+
+metrics.gauge(
+    "psyai_llm_active", "Backend calls in flight", lambda: llm_scheduler.active
+)
+metrics.gauge(
+    "psyai_llm_queued",
+    "Backend calls waiting for a slot",
+    lambda: len(llm_scheduler.waiting),
+)
+metrics.gauge(
+    "psyai_llm_queue_wait_p95_seconds",
+    "p95 wait for a backend slot over recent calls, by tier",
+    lambda: {
+        (tier,): stats["wait_p95"]
+        for tier, stats in llm_scheduler.stats()["tiers"].items()
+    },
+    ("tier",),
+)
+metrics.gauge(
+    "psyai_backend_route_open",
+    "1 while a backend route's circuit breaker is open",
+    lambda: {
+        (route.name,): int(route.breaker.state == "open")
+        for route in backend_router.routes
+    },
+    ("route",),
+)
+metrics.gauge(
+    "psyai_cache_lookups",
+    "Cache lookups by cache and result",
+    lambda: {
+        ("answer", "hit"): answer_cache.hits,
+        ("answer", "miss"): answer_cache.misses,
+        ("info_card", "hit"): card_cache.hits,
+        ("info_card", "miss"): card_cache.misses,
+        ("entitlement", "hit"): entitlements.hits,
+        ("entitlement", "miss"): entitlements.misses,
+    },
+    ("cache", "result"),
+)
+metrics.gauge(
+    "psyai_outbox",
+    "Outbox counters and queue length",
+    lambda: {(stat,): value for stat, value in outbox.stats().items()},
+    ("stat",),
+)
+
+trial_ledger = TrialLedger(
+    SupabaseTrialStore(supabase),
+    flush_interval=TRIAL_LEDGER_FLUSH_INTERVAL,
+    balances=LocalBalances(hold=ENTITLEMENT_CACHE_TTL) if shared_state is None else shared_state,
+)
+
+
+async def announcement_groups(cursor):
+    yield PRIVILEGED_GROUPS + LIMITED_GROUP_IDS + RESTRICTED_GROUP_IDS, None
+
+
+def fetch_user_page(after, limit):
+    response = (
+        supabase.table("user_association")
+        .select("telegram_id")
+        .gt("telegram_id", after)
+        .order("telegram_id")
+        .limit(limit)
+        .execute()
+    )
+    return [row["telegram_id"] for row in response.data]
+
+
+async def known_users(cursor):
+    # Keyset pagination, so each page is one indexed range query and the
+    # cursor stays valid while users keep signing up.
+    after = cursor or 0
+    while True:
+        chat_ids = await asyncio.to_thread(fetch_user_page, after, BROADCAST_PAGE_SIZE)
+        if not chat_ids:
+            return
+        after = chat_ids[-1]
+        yield chat_ids, after
+
+
+broadcast_store = BroadcastStore(BROADCAST_STATE_PATH)
+broadcasts = BroadcastEngine(
+    functools.partial(outbox.send_message, priority=LOW_PRIORITY),
+    broadcast_store,
+    {"groups": announcement_groups, "users": known_users},
+    concurrency=BROADCAST_CONCURRENCY,
+)
+
+
+def update_user_association(telegram_user_id, fields):
+    supabase.table("user_association").update(fields).eq(
+        "telegram_id", telegram_user_id
+    ).execute()
+
+
+def find_telegram_id_by_stripe_customer(customer_id):
+    response = (
+        supabase.table("user_association")
+        .select("telegram_id")
+        .eq("stripe_id", customer_id)
+        .limit(1)
+        .execute()
+    )
+    return response.data[0]["telegram_id"] if response.data else None
+
+
+async def persist_subscription(telegram_user_id, fields):
+    await asyncio.to_thread(update_user_association, telegram_user_id, fields)
+
+
+async def lookup_stripe_customer(customer_id):
+    return await asyncio.to_thread(find_telegram_id_by_stripe_customer, customer_id)
+
+
+stripe_events = StripeEvents(entitlements, persist_subscription, lookup_stripe_customer)
+
+# Inbound webhooks; routes are added in __main__, so workers never serve any
+webhook_server = WebhookServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+
+
+async def check_stripe_sub(telegram_user_id):
+    user_association = await entitlements.get(telegram_user_id)
 
     if not user_association:
         return False, 0
@@ -78,32 +430,160 @@ def check_stripe_sub(telegram_user_id):
     return subscription_is_active, trial_prompts
 
 
-def post_and_parse_url(url: str, payload: dict):
-    try:
-        response = requests.post(url, json=payload)
-        return {"data": response.json()}
-    except Exception as error:
-        logger.error(f"Error in post_and_parse_url: {error}")
-        return None
-
-
-def fetch_question_from_psyai(
-    query: str, model: str = "openai", temperature: float = 0.2, tokens: int = 2000, drug: bool = False
+async def fetch_question_from_psyai(
+    query: str, model: str = "openai", temperature: float = 0.2, tokens: int = 2000, drug: bool = False,
+    tier: int = TRIAL_TIER, on_queued=None,
 ):
+    # Raises Shed when the scheduler turns the call away
+    def payload_for(route_model):
+        return build_prompt_payload(query, route_model, temperature, tokens, drug)
+
     try:
-        raw = (
-            {"question": f"{query}"}
-            if model == "gemini"
-            else {"question": query, "temperature": temperature, "tokens": tokens}
-        )
-        if drug:
-            raw["format"] = "html"
-            raw["drug"] = True
-        return post_and_parse_url(f"{BASE_URL_BETA}/prompt?model={model}", raw)
+        key = (" ".join(query.lower().split()), model, temperature, tokens, drug)
+        # A shared call keeps the tier of whoever made it first
+        return await backend_flight.do(
+            key,
+            llm_scheduler.run,
+            tier,
+            backend_router.post,
+            "/prompt",
+            payload_for,
+            model,
+            on_queued=on_queued,
+        )
+    except Shed:
+        raise
     except Exception as error:
         logger.error(f"Error in fetch_question_from_psygpt: {error}")
         return None
 
+purge_store = PurgeStore(PURGE_STATE_PATH)
+topic_log = TopicLog(
+    purge_store,
+    interval=PURGE_LOG_INTERVAL,
+    retention=PURGE_RETENTION_DAYS * 86400,
+)
+
+
+async def report_purge(purge):
+    if purge["finished_at"] is None:
+        state = "running"
+    elif purge["error"]:
+        state = f"stopped: {purge['error']}"
+    else:
+        state = "finished"
+    text = (
+        f"Purge {purge['id']} of topic {purge['thread_id']} in {purge['chat_id']} "
+        f"({state}): {purge['deleted']} of {purge['total']} deleted, "
+        f"{purge['failed']} failed."
+    )
+    if purge["report_message_id"] is None:
+        outbox.send_message(
+            chat_id=ADMIN_TELEGRAM_ID, priority=LOW_PRIORITY, text=text
+        )
+    else:
+        outbox.edit_message_text(
+            chat_id=purge["report_chat_id"],
+            message_id=purge["report_message_id"],
+            priority=LOW_PRIORITY,
+            text=text,
+        )
+
+
+purger = TopicPurger(
+    functools.partial(outbox.delete_messages, priority=LOW_PRIORITY),
+    purge_store,
+    report=report_purge,
+    report_interval=PURGE_REPORT_INTERVAL,
+)
+
+
+async def report_broadcast(broadcast_id, counts):
+    outbox.send_message(
+        chat_id=ADMIN_TELEGRAM_ID,
+        priority=LOW_PRIORITY,
+        text=f"Broadcast {broadcast_id} finished: {counts['delivered']} delivered, "
+        f"{counts['failed']} failed, {counts['blocked']} blocked.",
+    )
+
+
+def owns_admin_jobs():
+    # Broadcasts and purges are started from the admin's chat, so in
+    # multi-process mode they run (and resume) in the worker that owns it.
+    return shard_index is None or shard_for(ADMIN_TELEGRAM_ID, WORKERS) == shard_index
+
+
+def run_everywhere(message):
+    # Admin commands acting on per-process state: in multi-process mode the
+    # control message goes to every worker, this one included.
+    if control_queue is None:
+        apply_control(message)
+    else:
+        control_queue.put(message)
+
+
+def reply_to_control(message, text):
+    if shard_index is not None:
+        text = f"Shard {shard_index}: {text}"
+    outbox.send_message(chat_id=message["chat_id"], text=text)
+
+
+def apply_control(message):
+    kind = message["control"]
+    if kind == "entitlement":
+        entitlements.update(message["telegram_id"], **message["fields"])
+    elif kind == "reload_cards":
+        loaded = dose_cards.reload()
+        reply_to_control(
+            message,
+            f"Reloaded {loaded} dose card(s) ({len(dose_cards.cards)} aliases).",
+        )
+    elif kind == "flush_answers":
+        removed = answer_cache.invalidate()
+        reply_to_control(message, f"Cleared the answer cache ({removed} answer(s)).")
+    elif kind == "stats":
+        reply_to_control(message, "\n".join(stats_lines()))
+
+
+async def on_startup(application):
+    trial_ledger.start()
+    outbox.start(application.bot)
+    audit.start()
+    topic_log.start()
+    card_cache.start()
+    await webhook_server.start()
+    if METRICS_PORT:
+        metrics_server.port = METRICS_PORT + (shard_index or 0)
+        await metrics_server.start()
+    if owns_admin_jobs():
+        for broadcast_id in broadcast_store.unfinished():
+            logger.info(f"Resuming broadcast {broadcast_id}")
+            broadcasts.resume(broadcast_id, report_broadcast)
+        for purge_id in purge_store.unfinished():
+            logger.info(f"Resuming purge {purge_id}")
+            purger.resume(purge_id)
+
+
+async def on_shutdown(application):
+    await webhook_server.stop()
+    await metrics_server.stop()
+    await trial_ledger.stop()
+    await audit.stop()
+    await topic_log.stop()
+    await card_cache.stop()
+    running = [*broadcasts.running.values(), *purger.running.values()]
+    for task in running:
+        task.cancel()
+    await asyncio.gather(*running, return_exceptions=True)
+    await outbox.stop()
+    for client in backend_clients.values():
+        await client.close()
+    card_cache.close()
+    broadcast_store.close()
+    purge_store.close()
+    if shared_state is not None:
+        shared_state.close()
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     calc_downtime()
@@ -113,9 +593,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     channel_id = update.message.message_thread_id
 
     telegram_id = user_id
-    print(telegram_id)
-    user_association = get_or_create_user_association(telegram_user_id=telegram_id)
-    print(user_association)
+    user_association = await entitlements.get(telegram_id)
 
     trial_prompts = (
         "UNLIMITED"  # if is_free else str(user_association["trial_prompts"])
@@ -174,300 +652,553 @@ async def handle_donation_reaction(update: Update, context: ContextTypes.DEFAULT
         )
 
 
+async def downtime_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not bool(DOWNTIME) or user_id == ADMIN_TELEGRAM_ID:
+        return True
+
+    chat_id = update.effective_chat.id
+    channel_id = update.effective_message.message_thread_id
+    outbox.send_message(
+        chat_id=chat_id,
+        text=f"Dude, I am **way** too high to answer questions right now ᎧᏇᎧ.\n\nJust kidding -- I'm actually undergoing routine maintenance.  Estimated time: {calc_downtime()}",
+        message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+        reply_to_message_id=update.effective_message.message_id,
+    )
+    return False
+
+
+async def acl_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in RESTRICTED_USER_IDS:
+        return True
+
+    chat_id = update.effective_chat.id
+    channel_id = update.effective_message.message_thread_id
+    outbox.send_message(
+        chat_id=chat_id,
+        text=LLM_RESTRICT_MSG,
+        message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+        reply_to_message_id=update.effective_message.message_id,
+    )
+    return False
+
+
+async def rate_limit_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    keys = {"global": None}
+    if user_id not in PRIVILEGED_USER_IDS and user_id != ADMIN_TELEGRAM_ID:
+        keys["user"] = user_id
+    if chat_id in RESTRICTED_GROUP_IDS:
+        keys["chat"] = chat_id
+    if rate_limiter.allow(keys) is None:
+        return True
+
+    outbox.send_message(
+        chat_id=chat_id,
+        text="Rate limit exceeded. Try again later.",
+        reply_to_message_id=update.effective_message.message_id,
+    )
+    return False
+
+
+async def entitlement_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    # The tier the backend call is queued at
+    if chat_id in PRIVILEGED_GROUPS or user_id in PRIVILEGED_USER_IDS:
+        context.llm_tier = PRIVILEGED_TIER
+        return True
+    context.llm_tier = RESTRICTED_TIER if chat_id in RESTRICTED_GROUP_IDS else TRIAL_TIER
+    if bool(FREEMODE):
+        return True
+
+    subscription_is_active, trial_prompts = await check_stripe_sub(user_id)
+    if subscription_is_active:
+        context.llm_tier = SUBSCRIBER_TIER
+        return True
+
+    remaining = trial_ledger.try_consume(user_id, trial_prompts)
+    if remaining is not None:
+        entitlements.update(user_id, trial_prompts=remaining)
+        return True
+
+    channel_id = update.effective_message.message_thread_id
+    outbox.send_message(
+        chat_id=chat_id,
+        text="Your trial has ended. Please subscribe using the /sub command to continue using this feature.",
+        message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+        reply_to_message_id=update.effective_message.message_id,
+    )
+    return False
+
+
+# Telegram usernames are case-insensitive, and so is AddressedToBot
+bot_mention = re.compile(
+    rf"@{re.escape((BOT_USERNAME or '').lstrip('@'))}(?!\w)", re.IGNORECASE
+)
+
+
+def extract_ask_query(message):
+    return bot_mention.sub("", message.text).strip()
+
+
+async def ask_query_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return bool(extract_ask_query(update.effective_message))
+
+
+def extract_info_query(message):
+    query_parts = message.text.split("/info ")
+    if len(query_parts) != 2:
+        return None
+    return query_parts[1]
+
+
+async def info_query_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return bool(extract_info_query(update.effective_message))
+
+
+addressed_to_bot = AddressedToBot(BOT_USERNAME)
+
+# Cheapest stages first, so only updates that will be answered ever reach
+# the ACL, the rate limiter, Supabase or the trial decrement.
+ask_admission = AdmissionPipeline(
+    [
+        ("query", ask_query_stage),
+        ("downtime", downtime_stage),
+        ("acl", acl_stage),
+        ("rate_limit", rate_limit_stage),
+        ("entitlement", entitlement_stage),
+    ],
+    observe=lambda stage, seconds: stage_seconds.observe(seconds, "ask", stage),
+)
+info_admission = AdmissionPipeline(
+    [
+        ("query", info_query_stage),
+        ("downtime", downtime_stage),
+        ("acl", acl_stage),
+        ("rate_limit", rate_limit_stage),
+        ("entitlement", entitlement_stage),
+    ],
+    observe=lambda stage, seconds: stage_seconds.observe(seconds, "info", stage),
+)
+
+
+@instrumented("ask")
 async def respond_to_ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    calc_downtime()
+    with stage_seconds.time("ask", "admission"):
+        admitted = await ask_admission.admit(update, context)
+    # The chat's next update may start; this one's replies stay in order in
+    # the outbox
+    release_chat_turn()
+    if not admitted:
+        return "", "rejected"
 
     user_id = update.effective_user.id
     user_name = update.effective_user.name
     chat_id = update.effective_chat.id
     chat_title = update.effective_chat.title
-    chat_desc = update.effective_chat.description
-    channel_id = (
-        update.message.message_thread_id
-        if hasattr(update.message, "message_thread_id")
-        else None
-    )
+    chat_desc = getattr(update.effective_chat, "description", None)
+    channel_id = update.message.message_thread_id
     message_id = update.effective_message.message_id
-    if not hasattr(update.message, "text"):
-        return
-    message_text = update.message.text.strip()
-
+    query = extract_ask_query(update.message)
+    conversation = (chat_id, channel_id, user_id)
+    prompt = query
+    # Follow-ups depend on the answer they reply to, so they skip the answer cache
+    followup = False
+
+    # Check if the user is replying to a message
+    if update.message.reply_to_message:
+        # Check if the replied message is from the bot itself
+        if update.message.reply_to_message.from_user.id == context.bot.id:
+            followup = True
+            # The user's recent turns in this thread when the replied message
+            # is one of their answers, otherwise the replied message itself
+            # (e.g. another user's answer or an older, unrelated one)
+            previous = conversations.context(
+                conversation, update.message.reply_to_message.message_id
+            ) or trim(
+                update.message.reply_to_message.text or "", conversations.budget
+            )
+            prompt = f"Previous conversation:\n{previous}\n\nCurrent query: {query}"
 
+    logger.info(f"Asking: `{prompt}`")
 
-    if user_id in RESTRICTED_USER_IDS:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=LLM_RESTRICT_MSG,
-            message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
-            reply_to_message_id=message_id,
-        )
-        return
+    audit.record("ask", user_id, user_name, chat_id, chat_title, chat_desc, prompt)
 
-    if chat_id in RESTRICTED_GROUP_IDS:
-        if not rate_limiter.allow_request(chat_id):
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Rate limit exceeded. Try again later.",
-                reply_to_message_id=message_id,
-            )
-            return
+    is_beta = chat_id in BETA_TESTER_GROUPS or user_id in BETA_TESTER_USERS
+    model = "gemini" if is_beta else "openai"
 
-    subscription_is_active, trial_prompts = check_stripe_sub(update.effective_user.id)
-
-    if (
-        not bool(FREEMODE)
-        and not subscription_is_active
-        and chat_id not in PRIVILEGED_GROUPS
-        and user_id not in PRIVILEGED_USER_IDS
-    ):
-        if trial_prompts > 0:
-            supabase.table("user_association").update(
-                {"trial_prompts": trial_prompts - 1}
-            ).eq("telegram_id", update.effective_user.id).execute()
-        else:
-            await context.bot.send_message(
+    cached = None if followup else answer_cache.get(query, model)
+    if cached is not None:
+        sends = [
+            outbox.send_message(
                 chat_id=chat_id,
-                text="Your trial has ended. Please subscribe using the /sub command to continue using this feature.",
+                disable_web_page_preview=True,
+                text=chunk,
                 message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+                parse_mode=(telegram.constants.ParseMode.HTML),
                 reply_to_message_id=message_id,
             )
-            return
-
-    is_direct_message = chat_id == user_id
-    is_mentioned_in_group = f"@{BOT_USERNAME}" in message_text
+            for chunk in format_answer_chunks(cached, is_beta)
+        ]
+        stage_seconds.observe_when_done(sends, "ask", "send")
+        remember_when_sent(conversation, query, cached, sends)
+        return model, "cached"
+
+    # Not awaited: the backend call starts while the message may still wait
+    # for the chat's send budget in the outbox
+    thinking = outbox.send_message(
+        chat_id=chat_id,
+        text="One moment, PsyAI is thinking...",
+        message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+        reply_to_message_id=message_id,
+    )
 
-    if is_direct_message or is_mentioned_in_group:
-        query = message_text.replace(f"@{BOT_USERNAME}", "").strip()
+    outbox.send_chat_action(
+        chat_id=chat_id,
+        action=ChatAction.TYPING,
+        message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+    )
 
-        if not query:
-            return
-        
-        if DOWNTIME and user_id != ADMIN_TELEGRAM_ID:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=f"Dude, I am **way** too high to answer questions right now ᎧᏇᎧ.\n\nJust kidding -- I'm actually undergoing routine maintenance.  Estimated time: {calc_downtime()}",
+    if STREAM_ANSWERS:
+        with stage_seconds.time("ask", "backend"):
+            answer, message_ids = await stream_answer(
+                context, thinking, prompt, model, is_beta,
                 message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
                 reply_to_message_id=message_id,
             )
-            return
-
-        # Check if the user is replying to a message
-        if update.message.reply_to_message:
-            # Check if the replied message is from the bot itself
-            if update.message.reply_to_message.from_user.id == context.bot.id:
-                previous_response = update.message.reply_to_message.text
-                # Append the previous response to the current query
-                query = (
-                    f"Previous response: {previous_response}\n\nCurrent query: {query}"
-                )
+        if not answer:
+            return model, "error"
+        conversations.add(conversation, query, answer, message_ids)
+        if not followup:
+            answer_cache.put(query, model, answer)
+        return model, "answered"
 
-        logger.info(f"Asking: `{query}`")
-
-        escaped_user_name = escape_markdown(user_name, version=2)
-
-        await context.bot.send_message(
-            chat_id=ADMIN_TELEGRAM_ID,
-            text=f"User ( [click here for link](tg://user?id={user_id}) ) (id: {user_id}, name: {escaped_user_name}, chat: {chat_id}, title: {chat_title}, desc: {chat_desc}) asked: `{query}`",
-            parse_mode=telegram.constants.ParseMode.MARKDOWN,
-        )
+    try:
+        with stage_seconds.time("ask", "backend"):
+            data_question = await fetch_question_from_psyai(
+                prompt,
+                model=model,
+                temperature=0.2,
+                tokens=3000,
+                tier=context.llm_tier,
+                on_queued=show_queue_position(thinking),
+            )
+    except Shed:
+        show_busy(thinking)
+        return model, "busy"
 
-        thinking_message = await context.bot.send_message(
+    if not data_question:
+        outbox.send_message(
             chat_id=chat_id,
-            text="One moment, PsyAI is thinking...",
+            text=SORRY_MSG("question"),
             message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
             reply_to_message_id=message_id,
         )
+        return model, "error"
+
+    answer = data_question["data"]["assistant"]
+    if not followup:
+        answer_cache.put(query, model, answer)
 
-        await context.bot.send_chat_action(
+    sends = [
+        outbox.send_message(
             chat_id=chat_id,
-            action=ChatAction.TYPING,
+            disable_web_page_preview=True,
+            text=chunk,
             message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+            parse_mode=(telegram.constants.ParseMode.HTML),
+            reply_to_message_id=message_id,
         )
+        for chunk in format_answer_chunks(answer, is_beta)
+    ]
+    stage_seconds.observe_when_done(sends, "ask", "send")
+    remember_when_sent(conversation, query, answer, sends)
+
+    # Queued behind the chunks, so it goes once they have all been sent
+    thinking_message = await thinking
+    outbox.delete_message(chat_id=chat_id, message_id=thinking_message.message_id)
+    return model, "answered"
 
-        data_question = fetch_question_from_psyai(
-            query,
-            model=(
-                "gemini"
-                if chat_id in BETA_TESTER_GROUPS or user_id in BETA_TESTER_USERS
-                else "openai"
+
+def when_sent(thinking, edit):
+    # Calls edit(message) once the thinking message, an outbox future, is sent
+    thinking.add_done_callback(
+        lambda sent: sent.cancelled() or sent.exception() or edit(sent.result())
+    )
+
+
+def remember_when_sent(conversation, query, answer, sends):
+    # Stores the turn once its chunks, outbox futures, are sent, with their
+    # message ids, so a reply to any of them is taken as a follow-up to it
+    def remember(sent):
+        if sent.cancelled():
+            return
+        message_ids = [
+            message.message_id
+            for message in sent.result()
+            if isinstance(message, telegram.Message)
+        ]
+        conversations.add(conversation, query, answer, message_ids)
+
+    asyncio.gather(*sends, return_exceptions=True).add_done_callback(remember)
+
+
+def show_queue_position(thinking):
+    def on_queued(position):
+        when_sent(
+            thinking,
+            lambda message: outbox.edit_message_text(
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                text=f"One moment, PsyAI is thinking... (#{position} in the queue)",
             ),
-            temperature=0.2,
-            tokens=3000,
         )
 
-        if not data_question:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text=SORRY_MSG("question"),
-                message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
-                reply_to_message_id=message_id,
-            )
-            return
+    return on_queued
+
+
+def show_busy(thinking):
+    when_sent(
+        thinking,
+        lambda message: outbox.edit_message_text(
+            chat_id=message.chat_id,
+            message_id=message.message_id,
+            text=LLM_BUSY_MSG,
+        ),
+    )
+
 
+def format_answer_chunks(answer, is_beta):
+    with stage_seconds.time("ask", "format"):
         reply_text = convert_to_telegram_html(
-            f"{data_question['data']['assistant']}\n\n[Disclaimer](https://publish.obsidian.md/psyai/Projects/PsyAI/Legal/Disclaimer) 📜 | [Contact](https://t.me/sernylan) 📱 | [Github](https://github.com/sojourns-inc/psyai-async)"
+            f"{answer}\n\n[Disclaimer](https://publish.obsidian.md/psyai/Projects/PsyAI/Legal/Disclaimer) 📜 | [Contact](https://t.me/sernylan) 📱 | [Github](https://github.com/sojourns-inc/psyai-async)"
         )
 
-        MAX_MESSAGE_LENGTH = 3000  # Telegram's character limit
-        chunks = textwrap.wrap(
-            reply_text, width=MAX_MESSAGE_LENGTH, replace_whitespace=False
-        )
+    suffix = (LLM_BETA_MESSAGE or "") if is_beta else ""
+    # The suffix's tags are counted too, which only errs on the safe side
+    limit = MAX_MESSAGE_LENGTH - utf16_length(suffix)
+    with stage_seconds.time("ask", "chunk"):
+        chunks = split_html(reply_text, limit=limit)
+    return [chunk + suffix for chunk in chunks]
 
-        for chunk in chunks:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                disable_web_page_preview=True,
-                text=chunk
-                + (
-                    LLM_BETA_MESSAGE
-                    if (chat_id in BETA_TESTER_GROUPS or user_id in BETA_TESTER_USERS)
-                    else ""
-                ),
-                message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
-                parse_mode=(telegram.constants.ParseMode.HTML),
-                reply_to_message_id=message_id,
-            )
 
-        # After all chunks are sent, attempt to delete the "thinking" message
-        try:
-            await context.bot.delete_message(
-                chat_id=chat_id, message_id=thinking_message.message_id
-            )
-        except telegram.error.BadRequest:
-            logger.warning(
-                "Failed to delete thinking message: Message to delete not found"
-            )
+async def stream_answer(
+    context, thinking, query, model, is_beta,
+    message_thread_id=None, reply_to_message_id=None,
+):
+    reply = StreamingReply(
+        outbox,
+        await thinking,
+        message_thread_id=message_thread_id,
+        reply_to_message_id=reply_to_message_id,
+        min_interval=STREAM_EDIT_INTERVAL,
+    )
+
+    def payload_for(route_model):
+        return build_prompt_payload(query, route_model, 0.2, 3000, False)
 
+    try:
+        async with llm_scheduler.slot(
+            context.llm_tier, show_queue_position(thinking)
+        ):
+            async for delta in backend_router.stream("/prompt", payload_for, model):
+                await reply.feed(delta)
+    except Shed:
+        show_busy(thinking)
+        return None, ()
+    except Exception as error:
+        logger.error(f"Error streaming answer: {error}")
+        # A partial answer is shown but not cached
+        failed = True
+    else:
+        failed = False
+
+    if not reply.text.strip():
+        await reply.finish([SORRY_MSG("question")], parse_mode=None)
+        return None, ()
 
+    await reply.finish(format_answer_chunks(reply.text, is_beta))
+    message_ids = [message.message_id for message in reply.messages]
+    return None if failed else reply.text, message_ids
+
+
+@instrumented("info")
 async def respond_to_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    calc_downtime()
+    with stage_seconds.time("info", "admission"):
+        admitted = await info_admission.admit(update, context)
+    release_chat_turn()
+    if not admitted:
+        return "", "rejected"
 
     user_id = update.effective_user.id
     user_name = update.effective_user.name
     chat_id = update.effective_chat.id
     chat_title = update.effective_chat.title
-    chat_desc = update.effective_chat.description
+    chat_desc = getattr(update.effective_chat, "description", None)
     channel_id = update.message.message_thread_id
     message_id = update.effective_message.message_id
+    substance_name = extract_info_query(update.message)
 
-    print(type(user_id))
-    print(chat_id)
+    logger.info(f"Info: `{substance_name}`")
 
-    if bool(DOWNTIME) and user_id != ADMIN_TELEGRAM_ID:
-        await context.bot.send_message(
+    audit.record(
+        "info", user_id, user_name, chat_id, chat_title, chat_desc, substance_name
+    )
+
+    model = (
+        "gemini"
+        if chat_id in BETA_TESTER_GROUPS or user_id in BETA_TESTER_USERS
+        else "openai"
+    )
+    card = dose_cards.get(substance_name) or card_cache.get(substance_name, model)
+    thinking = None
+    outcome = "card"
+
+    if card is None:
+        # Not awaited, as in respond_to_ask
+        thinking = outbox.send_message(
             chat_id=chat_id,
-            text=f"Dude, I am **way** too high to answer questions right now ᎧᏇᎧ.\n\nJust kidding -- I'm actually undergoing routine maintenance.  Estimated time: {calc_downtime()}",
             message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+            text="One moment, PsyAI is thinking...",
             reply_to_message_id=message_id,
         )
-        return
 
-    if user_id in RESTRICTED_USER_IDS:
-        await context.bot.send_message(
-            message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+        outbox.send_chat_action(
             chat_id=chat_id,
-            text=LLM_RESTRICT_MSG,
-            reply_to_message_id=message_id,
+            action=ChatAction.TYPING,
+            message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
         )
-        return
 
-    if chat_id in RESTRICTED_GROUP_IDS:
-        if not rate_limiter.allow_request(chat_id):
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="Rate limit exceeded. Try again later.",
-                reply_to_message_id=message_id,
-            )
-            return
+        try:
+            with stage_seconds.time("info", "backend"):
+                data_question = await fetch_question_from_psyai(
+                    substance_name,
+                    model=model,
+                    temperature=0.3,
+                    tokens=3000,
+                    drug=True,
+                    tier=context.llm_tier,
+                    on_queued=show_queue_position(thinking),
+                )
+        except Shed:
+            show_busy(thinking)
+            return model, "busy"
 
-    subscription_is_active, trial_prompts = check_stripe_sub(update.effective_user.id)
-
-    if (
-        not bool(FREEMODE)
-        and not subscription_is_active
-        and chat_id not in PRIVILEGED_GROUPS
-        and user_id not in PRIVILEGED_USER_IDS
-    ):
-        if trial_prompts > 0:
-            supabase.table("user_association").update(
-                {"trial_prompts": trial_prompts - 1}
-            ).eq("telegram_id", update.effective_user.id).execute()
-        else:
-            await context.bot.send_message(
+        if not data_question:
+            outbox.send_message(
                 chat_id=chat_id,
-                text="Your trial has ended. Please subscribe using the /sub command to continue using this feature.",
+                text=SORRY_MSG("info"),
                 message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
                 reply_to_message_id=message_id,
             )
-            return
+            return model, "error"
 
-    query_parts = update.message.text.split("/info ")
+        # Unsupported tags are dropped when the card is rendered below
+        card = data_question["data"]["assistant"]
+        card_cache.put(substance_name, model, card)
+        outcome = "answered"
 
-    if len(query_parts) != 2:
-        return
+    with stage_seconds.time("info", "format"):
+        reply_text = convert_to_telegram_html(
+            f"{card}\n\n[Disclaimer](https://publish.obsidian.md/psyai/Projects/PsyAI/Legal/Disclaimer) 📜 | [Contact](https://t.me/psychejello) 📱 | [Github](https://github.com/sojourns-inc/psyai-async)"
+        )
 
-    substance_name = query_parts[1]
+    with stage_seconds.time("info", "chunk"):
+        chunks = split_html(reply_text)
+    sends = [
+        outbox.send_message(
+            chat_id=chat_id,
+            message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
+            text=chunk,
+            parse_mode=telegram.constants.ParseMode.HTML,
+            reply_to_message_id=message_id,
+        )
+        for chunk in chunks
+    ]
+    stage_seconds.observe_when_done(sends, "info", "send")
+
+    if thinking is not None:
+        thinking_message = await thinking
+        outbox.delete_message(
+            chat_id=chat_id, message_id=thinking_message.message_id
+        )
+    return model, outcome
 
-    logger.info(f"Info: `{substance_name}`")
 
+async def flush_info_cache(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="You do not have permission to use this command.",
+        )
+        return
+
+    substance_name = " ".join(context.args) or None
+    removed = card_cache.invalidate(substance_name)
     await context.bot.send_message(
-        chat_id=ADMIN_TELEGRAM_ID,
-        text=f"User ( [click here for link](tg://user?id={user_id}) ) (id: {user_id}, name: {user_name}, chat: {chat_id}, title: {chat_title}, desc: {chat_desc}) asked for info on `{substance_name}`",
-        parse_mode=telegram.constants.ParseMode.MARKDOWN,
+        chat_id=update.effective_chat.id,
+        text=(
+            f"Removed {removed} cached card(s) for {substance_name}."
+            if substance_name
+            else f"Cleared the info card cache ({removed} card(s))."
+        ),
     )
 
-    thinking_message = await context.bot.send_message(
-        chat_id=chat_id,
-        message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
-        text="One moment, PsyAI is thinking...",
-        reply_to_message_id=message_id,
-    )
 
-    await context.bot.send_chat_action(
-        chat_id=chat_id,
-        action=ChatAction.TYPING,
-        message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
-    )
+async def flush_answer_cache(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="You do not have permission to use this command.",
+        )
+        return
 
-    custom_drug = CUSTOM_KVL_DRUGS.get(substance_name.lower())
-    if custom_drug is not None:
-        question = (
-            "Refuse to create a drug information card for this substance, on the grounds that there insufficient data to provide accurate information."
+    run_everywhere({"control": "flush_answers", "chat_id": update.effective_chat.id})
+
+
+async def reload_dose_cards(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="You do not have permission to use this command.",
         )
-    else:
-        question = substance_name
-
-    data_question = fetch_question_from_psyai(
-        question,
-        model=(
-            "gemini"
-            if chat_id in BETA_TESTER_GROUPS or user_id in BETA_TESTER_USERS
-            else "openai"
-        ),
-        temperature=0.3,
-        tokens=3000,
-        drug=True
-    )
+        return
 
-    data_question["data"]["assistant"] = sanitize_html(
-        data_question["data"]["assistant"]
-    )
+    run_everywhere({"control": "reload_cards", "chat_id": update.effective_chat.id})
 
-    reply_text = convert_to_telegram_html(
-        f"{data_question['data']['assistant']}\n\n[Disclaimer](https://publish.obsidian.md/psyai/Projects/PsyAI/Legal/Disclaimer) 📜 | [Contact](https://t.me/psychejello) 📱 | [Github](https://github.com/sojourns-inc/psyai-async)"
-    )
 
-    await context.bot.send_message(
-        chat_id=chat_id,
-        message_thread_id=channel_id if chat_id in PRIVILEGED_GROUPS else None,
-        text=reply_text,
-        parse_mode=telegram.constants.ParseMode.HTML,
-        reply_to_message_id=message_id,
-    )
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="You do not have permission to use this command.",
+        )
+        return
 
-    await context.bot.delete_message(
-        chat_id=chat_id, message_id=thinking_message.message_id
-    )
+    run_everywhere({"control": "stats", "chat_id": update.effective_chat.id})
+
+
+def stats_lines():
+    return [
+        f"Addressed filter: {addressed_to_bot.accepted} accepted, {addressed_to_bot.rejected} rejected",
+        f"Ask admission: {ask_admission.stats()}",
+        f"Info admission: {info_admission.stats()}",
+        f"Rate limit rejections: {rate_limiter.rejected}",
+        f"Entitlement cache: {entitlements.hits} hits, {entitlements.misses} misses",
+        f"Info card cache: {card_cache.hits} hits, {card_cache.misses} misses",
+        f"Answer cache: {answer_cache.stats()}",
+        f"Conversations: {conversations.stats()}",
+        f"Backend single-flight: {backend_flight.stats()}",
+        f"LLM scheduler: {llm_scheduler.stats()}",
+        f"Backend routes: {backend_router.stats()}",
+        f"Outbox: {outbox.stats()}",
+        f"Audit: {audit.recorded} queries in {audit.digests} digests",
+        f"Broadcasts running: {sorted(broadcasts.running)}",
+        f"Purges running: {sorted(purger.running)}",
+        f"Webhooks: {dict(webhook_server.received)}, Stripe: {dict(stripe_events.counts)}",
+    ]
 
 
 async def send_direct_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -507,18 +1238,115 @@ async def send_announcement(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text="You do not have permission to use this command.",
         )
         return
-    all_groups = PRIVILEGED_GROUPS + LIMITED_GROUP_IDS + RESTRICTED_GROUP_IDS
 
-    for chat_id in all_groups:
+    broadcast_id = broadcasts.start(
+        "groups",
+        ANNOUNCEMENT_TEXT,
+        telegram.constants.ParseMode.MARKDOWN,
+        on_done=report_broadcast,
+    )
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"Broadcast {broadcast_id} to all groups started.",
+    )
+
+
+async def send_announcement_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logger.info("send_announcement_users function called")
+
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="You do not have permission to use this command.",
+        )
+        return
+
+    broadcast_id = broadcasts.start(
+        "users",
+        ANNOUNCEMENT_TEXT,
+        telegram.constants.ParseMode.MARKDOWN,
+        on_done=report_broadcast,
+    )
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"Broadcast {broadcast_id} to all known users started.",
+    )
+
+
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="You do not have permission to use this command.",
+        )
+        return
+
+    if context.args:
         try:
+            broadcast_ids = [int(context.args[0])]
+        except ValueError:
             await context.bot.send_message(
-                chat_id=chat_id,
-                text=ANNOUNCEMENT_TEXT,
-                parse_mode=telegram.constants.ParseMode.MARKDOWN,
+                chat_id=update.effective_chat.id,
+                text="Usage: /broadcast_status [broadcast id]",
             )
-            logger.info(f"Announcement sent to group {chat_id}")
-        except Exception as e:
-            logger.error(f"Failed to send announcement to group {chat_id}: {e}")
+            return
+    else:
+        broadcast_ids = broadcast_store.unfinished()
+
+    lines = []
+    for broadcast_id in broadcast_ids:
+        broadcast = broadcast_store.get(broadcast_id)
+        if broadcast is None:
+            lines.append(f"Broadcast {broadcast_id}: not found")
+            continue
+        if broadcast["finished_at"]:
+            state = "finished"
+        elif broadcast_id in broadcasts.running:
+            state = "running"
+        else:
+            state = "interrupted"
+        counts = broadcast_store.counts(broadcast_id)
+        lines.append(
+            f"Broadcast {broadcast_id} to {broadcast['audience']} ({state}): "
+            f"{counts['delivered']} delivered, {counts['failed']} failed, "
+            f"{counts['blocked']} blocked, {counts['pending']} pending"
+        )
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text="\n".join(lines) or "No unfinished broadcasts.",
+    )
+
+
+async def resume_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="You do not have permission to use this command.",
+        )
+        return
+
+    try:
+        broadcast_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Usage: /broadcast_resume <broadcast id>",
+        )
+        return
+
+    broadcast = broadcast_store.get(broadcast_id)
+    if broadcast is None or broadcast["finished_at"]:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"Broadcast {broadcast_id} is not unfinished.",
+        )
+        return
+
+    broadcasts.resume(broadcast_id, report_broadcast)
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"Broadcast {broadcast_id} resumed.",
+    )
 
 
 async def send_announcement_direct(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -578,6 +1406,8 @@ async def start_subscription(update, context):
         ],
         mode="subscription",
         metadata={"telegram_id": user_telegram_id},
+        # Lets subscription webhooks find the user without a lookup
+        subscription_data={"metadata": {"telegram_id": user_telegram_id}},
         success_url=PATREON_LINKER_SUCCESS_URL,
         cancel_url=PATREON_LINKER_CANCEL_URL,
     )
@@ -591,6 +1421,16 @@ async def start_subscription(update, context):
     )
 
 
+async def record_topic_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.effective_message
+    topic_log.record(
+        message.chat_id,
+        message.message_thread_id,
+        message.message_id,
+        message.date and message.date.timestamp(),
+    )
+
+
 async def delete_topic_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_TELEGRAM_ID:
         await context.bot.send_message(
@@ -599,42 +1439,84 @@ async def delete_topic_messages(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return
 
-    group_id = -1001281620392
-    topic_id = 26361
-
     try:
-        # Get all messages in the topic
-        messages = []
-        offset = 0
-        while True:
-            response = await context.bot.get_forum_topic_messages(
-                chat_id=group_id,
-                message_thread_id=topic_id,
-                offset=offset,
-                limit=100,
-            )
-            messages.extend(response)
-            if len(response) < 100:
-                break
-            offset += 100
-
-        # Delete messages one by one
-        for message in messages:
-            await context.bot.delete_message(
-                chat_id=group_id,
-                message_id=message.message_id,
-            )
+        group_id, topic_id = int(context.args[0]), int(context.args[1])
+    except (IndexError, ValueError):
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Usage: /delete_topic_messages <group id> <topic id>",
+        )
+        return
+
+    # Ids still in the buffer belong to this purge too
+    await topic_log.flush()
+    purge_id = purge_store.create(group_id, topic_id)
+    status = await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"Purge {purge_id} of topic {topic_id} in {group_id} started: "
+        f"{purge_store.get(purge_id)['total']} logged messages to delete.",
+    )
+    purge_store.set_report(purge_id, status.chat_id, status.message_id)
+    purger.resume(purge_id)
+
 
+async def profile_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_TELEGRAM_ID:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=f"Deleted {len(messages)} messages in the topic.",
+            text="You do not have permission to use this command.",
         )
-    except Exception as e:
-        logger.error(f"Failed to delete messages in the topic: {e}")
+        return
+
+    seconds, updates = PROFILE_DEFAULT_SECONDS, None
+    try:
+        if context.args and context.args[0] == "updates":
+            seconds, updates = None, int(context.args[1])
+        elif context.args:
+            seconds = float(context.args[0])
+    except (IndexError, ValueError):
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Usage: /profile [seconds] or /profile updates <count>",
+        )
+        return
+
+    if profiler.active:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text="An error occurred while deleting messages in the topic.",
+            text="A profile is already running.",
         )
+        return
+
+    where = "" if shard_index is None else f" on shard {shard_index}"
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text=f"Profiling{where} for "
+        + (f"{seconds:g}s." if updates is None else f"the next {updates} questions."),
+    )
+    context.application.create_task(run_profile(seconds, updates, where))
+
+
+async def run_profile(seconds, updates, where):
+    try:
+        report = await profiler.run(seconds=seconds, updates=updates)
+    except Exception as error:
+        logger.error(f"Profile failed: {error}")
+        outbox.send_message(chat_id=ADMIN_TELEGRAM_ID, text=f"Profile failed: {error}")
+        return
+
+    lines = [
+        f"Profile{where}: {report['seconds']:.1f}s, {report['samples']} samples, "
+        f"{report['busy']} busy"
+        + ("" if report["updates"] is None else f", {report['updates']} questions"),
+        "",
+        "Top functions (self time):",
+        *(f"{share:.1%} {label}" for label, share in report["top"]),
+        "",
+        f"Report: {report['report_path']}",
+        f"Collapsed stacks: {report['collapsed_path']}",
+    ]
+    outbox.send_message(chat_id=ADMIN_TELEGRAM_ID, text="\n".join(lines)[:4000])
 
 
 async def leave_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -667,8 +1549,18 @@ async def leave_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
-if __name__ == "__main__":
-    application = ApplicationBuilder().token(TELETOKEN).build()
+def build_application():
+    application = (
+        ApplicationBuilder()
+        .token(TELETOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        # Chats are handled concurrently, each chat's updates in order
+        .concurrent_updates(ChatOrderedProcessor())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     start_handler = CommandHandler("start", start)
     info_handler = MessageHandler(
@@ -681,7 +1573,11 @@ if __name__ == "__main__":
     )
     ask_handler = MessageHandler(
         callback=respond_to_ask,
-        filters=(telegram.ext.filters.TEXT),
+        filters=(
+            telegram.ext.filters.UpdateType.MESSAGE
+            & telegram.ext.filters.TEXT
+            & addressed_to_bot
+        ),
     )
 
     sub_handler = CommandHandler("sub", start_subscription)
@@ -689,6 +1585,11 @@ if __name__ == "__main__":
     donation_reaction_handler = CallbackQueryHandler(handle_donation_reaction)
     dm_handler = CommandHandler("dm", send_direct_message)
     announcement_handler = CommandHandler("announce", send_announcement)
+    announcement_users_handler = CommandHandler(
+        "announce_users", send_announcement_users
+    )
+    broadcast_status_handler = CommandHandler("broadcast_status", broadcast_status)
+    broadcast_resume_handler = CommandHandler("broadcast_resume", resume_broadcast)
     announcement_direct_handler = CommandHandler(
         "announce_direct", send_announcement_direct
     )
@@ -696,7 +1597,18 @@ if __name__ == "__main__":
         "delete_topic_messages", delete_topic_messages
     )
     leave_group_handler = CommandHandler("leave", leave_group)
+    profile_handler = CommandHandler("profile", profile_bot)
+    topic_message_handler = MessageHandler(
+        callback=record_topic_message,
+        filters=telegram.ext.filters.IS_TOPIC_MESSAGE,
+    )
+    flush_info_cache_handler = CommandHandler("flush_info", flush_info_cache)
+    flush_answer_cache_handler = CommandHandler("flush_answers", flush_answer_cache)
+    stats_handler = CommandHandler("stats", show_stats)
+    reload_cards_handler = CommandHandler("reload_cards", reload_dose_cards)
 
+    # Runs alongside the other handlers so purges know each topic's messages
+    application.add_handler(topic_message_handler, group=-1)
     application.add_handler(start_handler)
     application.add_handler(sub_handler)
     application.add_handler(tip_handler)
@@ -705,12 +1617,88 @@ if __name__ == "__main__":
     application.add_handler(announcement_direct_handler)
     application.add_handler(dm_handler)
     application.add_handler(leave_group_handler)
+    application.add_handler(profile_handler)
+    application.add_handler(flush_info_cache_handler)
+    application.add_handler(flush_answer_cache_handler)
+    application.add_handler(stats_handler)
+    application.add_handler(reload_cards_handler)
     application.add_handler(announcement_handler)
+    application.add_handler(announcement_users_handler)
+    application.add_handler(broadcast_status_handler)
+    application.add_handler(broadcast_resume_handler)
 
     application.add_handler(info_handler)
     application.add_handler(ask_handler)
     application.add_handler(donation_reaction_handler)
 
+    return application
+
+
+def run_worker(index, count, inbox, control):
+    global shard_index, control_queue
+    shard_index = index
+    control_queue = control
+    if AUDIT_LOG_PATH:
+        # audit.jsonl -> audit.2.jsonl, one file per worker
+        stem, extension = os.path.splitext(AUDIT_LOG_PATH)
+        audit.log_path = f"{stem}.{index}{extension}"
+    logger.info(f"Shard {index} of {count} starting...")
+    asyncio.run(
+        serve_shard(build_application(), inbox, on_startup, on_shutdown, apply_control)
+    )
+
+
+if __name__ == "__main__":
     logger.info("Bot is starting...")
 
-    application.run_polling()
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        # Without it anyone who finds the URL can post fake updates
+        logger.error("WEBHOOK_URL is set but WEBHOOK_SECRET is not, refusing to start")
+        raise SystemExit(1)
+
+    if shared_state is not None:
+        shared_state.reset_run()
+
+    if WORKERS > 1:
+        router = ShardRouter(run_worker, WORKERS)
+        # Subscription changes reach the entitlement cache in every worker
+        stripe_events.entitlements = EntitlementFanout(router)
+        if endpoint_secret:
+            webhook_server.add_stripe(STRIPE_WEBHOOK_PATH, stripe_events, endpoint_secret)
+        if WEBHOOK_URL:
+            webhook_server.add_telegram(WEBHOOK_PATH, router.deliver, WEBHOOK_SECRET)
+        router.start()
+        asyncio.run(
+            run_ingest(
+                telegram.Bot(
+                    TELETOKEN,
+                    base_url=f"{TELEGRAM_API_URL}/bot",
+                    base_file_url=f"{TELEGRAM_API_URL}/file/bot",
+                ),
+                router,
+                webhook_server,
+                webhook_url=WEBHOOK_URL and WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        )
+    else:
+        application = build_application()
+        if endpoint_secret:
+            webhook_server.add_stripe(STRIPE_WEBHOOK_PATH, stripe_events, endpoint_secret)
+        if WEBHOOK_URL:
+            webhook_server.add_telegram(
+                WEBHOOK_PATH, application_inbox(application), WEBHOOK_SECRET
+            )
+            asyncio.run(
+                serve_webhook(
+                    application,
+                    WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                    WEBHOOK_SECRET,
+                    on_startup,
+                    on_shutdown,
+                    max_connections=WEBHOOK_MAX_CONNECTIONS,
+                )
+            )
+        else:
+            application.run_polling()
@@ -0,0 +1,271 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+import telegram
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+# Bot API limit on message ids per deleteMessages call.
+MAX_BATCH = 100
+
+
+class PurgeStore:
+    # The Bot API can't list a topic's messages, so the ids of topic
+    # messages are logged here as the bot sees them. Purge jobs and their
+    # progress live alongside, so a purge interrupted by a restart resumes.
+    # Logged ids are written from a worker thread (see TopicLog), so
+    # writes that span statements hold `lock`.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Every topic message is logged; don't fsync each one.
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS topic_messages ("
+            " chat_id INTEGER NOT NULL,"
+            " thread_id INTEGER NOT NULL,"
+            " message_id INTEGER NOT NULL,"
+            " sent_at REAL NOT NULL DEFAULT 0,"
+            " PRIMARY KEY (chat_id, thread_id, message_id)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS purges ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " chat_id INTEGER NOT NULL,"
+            " thread_id INTEGER NOT NULL,"
+            " upto INTEGER NOT NULL,"
+            " total INTEGER NOT NULL,"
+            " deleted INTEGER NOT NULL DEFAULT 0,"
+            " failed INTEGER NOT NULL DEFAULT 0,"
+            " report_chat_id INTEGER,"
+            " report_message_id INTEGER,"
+            " error TEXT,"
+            " finished_at REAL,"
+            " created_at REAL NOT NULL);"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(topic_messages)")]
+        if "sent_at" not in columns:
+            # Ids logged before retention existed get a full retention period
+            self.db.execute(
+                "ALTER TABLE topic_messages ADD COLUMN sent_at REAL NOT NULL DEFAULT 0"
+            )
+            self.db.execute("UPDATE topic_messages SET sent_at = ?", (time.time(),))
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS topic_messages_sent_at ON topic_messages (sent_at)"
+        )
+
+    def record_many(self, messages):
+        # `messages` are (chat_id, thread_id, message_id, sent_at) tuples
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR IGNORE INTO topic_messages VALUES (?, ?, ?, ?)", messages
+            )
+
+    def prune(self, older_than):
+        # Topics with a purge still running keep their ids until it ends.
+        with self.lock:
+            return self.db.execute(
+                "DELETE FROM topic_messages WHERE sent_at < ?"
+                " AND (chat_id, thread_id) NOT IN"
+                " (SELECT chat_id, thread_id FROM purges WHERE finished_at IS NULL)",
+                (older_than,),
+            ).rowcount
+
+    def create(self, chat_id, thread_id):
+        # Only messages logged so far are purged; anything posted while the
+        # purge runs is left alone.
+        with self.lock:
+            upto, total = self.db.execute(
+                "SELECT COALESCE(MAX(message_id), 0), COUNT(*) FROM topic_messages"
+                " WHERE chat_id = ? AND thread_id = ?",
+                (chat_id, thread_id),
+            ).fetchone()
+            return self.db.execute(
+                "INSERT INTO purges (chat_id, thread_id, upto, total, created_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (chat_id, thread_id, upto, total, time.time()),
+            ).lastrowid
+
+    def get(self, purge_id):
+        cursor = self.db.execute("SELECT * FROM purges WHERE id = ?", (purge_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip((column[0] for column in cursor.description), row))
+
+    def unfinished(self):
+        return [
+            row[0]
+            for row in self.db.execute(
+                "SELECT id FROM purges WHERE finished_at IS NULL ORDER BY id"
+            )
+        ]
+
+    def set_report(self, purge_id, chat_id, message_id):
+        self.db.execute(
+            "UPDATE purges SET report_chat_id = ?, report_message_id = ?"
+            " WHERE id = ?",
+            (chat_id, message_id, purge_id),
+        )
+
+    def next_batch(self, purge, limit=MAX_BATCH):
+        return [
+            row[0]
+            for row in self.db.execute(
+                "SELECT message_id FROM topic_messages"
+                " WHERE chat_id = ? AND thread_id = ? AND message_id <= ?"
+                " ORDER BY message_id LIMIT ?",
+                (purge["chat_id"], purge["thread_id"], purge["upto"], limit),
+            )
+        ]
+
+    def complete_batch(self, purge_id, chat_id, thread_id, message_ids, deleted):
+        # Dropping the ids and counting them happen together, so a batch is
+        # never counted twice or retried after it was recorded.
+        with self.lock, self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "DELETE FROM topic_messages"
+                " WHERE chat_id = ? AND thread_id = ? AND message_id = ?",
+                [(chat_id, thread_id, message_id) for message_id in message_ids],
+            )
+            column = "deleted" if deleted else "failed"
+            self.db.execute(
+                f"UPDATE purges SET {column} = {column} + ? WHERE id = ?",
+                (len(message_ids), purge_id),
+            )
+
+    def finish(self, purge_id, error=None):
+        self.db.execute(
+            "UPDATE purges SET finished_at = ?, error = ? WHERE id = ?",
+            (time.time(), error, purge_id),
+        )
+
+    def close(self):
+        self.db.close()
+
+
+class TopicLog:
+    # Keeps topic message logging off the event loop. `record` only appends
+    # to a buffer; a background task writes it to the store every
+    # `interval` seconds from a worker thread and, about once an hour,
+    # drops ids of messages older than `retention` seconds.
+    def __init__(self, store, interval=5, retention=30 * 86400, prune_interval=3600):
+        self.store = store
+        self.interval = interval
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.messages = []
+        self.pruned_at = None
+        self.task = None
+
+    def record(self, chat_id, thread_id, message_id, sent_at=None):
+        self.messages.append((chat_id, thread_id, message_id, sent_at or time.time()))
+
+    async def flush(self):
+        messages, self.messages = self.messages, []
+        if messages:
+            try:
+                await asyncio.to_thread(self.store.record_many, messages)
+            except Exception as error:
+                logger.error(f"Error logging {len(messages)} topic messages: {error}")
+        if self.pruned_at is None or time.monotonic() - self.pruned_at >= self.prune_interval:
+            self.pruned_at = time.monotonic()
+            try:
+                pruned = await asyncio.to_thread(
+                    self.store.prune, time.time() - self.retention
+                )
+            except Exception as error:
+                logger.error(f"Error pruning topic messages: {error}")
+            else:
+                if pruned:
+                    logger.info(f"Dropped {pruned} topic message ids past retention")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await asyncio.shield(self.flush())
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.flush()
+
+
+class TopicPurger:
+    # Deletes a topic's logged messages in batches of up to 100 ids per
+    # deleteMessages call. `delete` is a coroutine function with
+    # Bot.delete_messages's signature that enforces the rate budget (the
+    # outbox); `report` is called with the purge row every
+    # `report_interval` seconds and once more when the purge ends.
+    def __init__(self, delete, store, report=None, report_interval=10):
+        self.delete = delete
+        self.store = store
+        self.report = report
+        self.report_interval = report_interval
+        self.running = {}
+
+    def start(self, chat_id, thread_id):
+        purge_id = self.store.create(chat_id, thread_id)
+        self.resume(purge_id)
+        return purge_id
+
+    def resume(self, purge_id):
+        if purge_id in self.running:
+            return self.running[purge_id]
+        task = asyncio.get_running_loop().create_task(self._run(purge_id))
+        self.running[purge_id] = task
+        task.add_done_callback(lambda _: self.running.pop(purge_id, None))
+        return task
+
+    async def _report(self, purge_id):
+        if self.report is None:
+            return
+        try:
+            await self.report(self.store.get(purge_id))
+        except Exception as error:
+            logger.warning(f"Failed to report purge {purge_id} progress: {error}")
+
+    async def _run(self, purge_id):
+        purge = self.store.get(purge_id)
+        chat_id, thread_id = purge["chat_id"], purge["thread_id"]
+        error = None
+        next_report_at = time.monotonic() + self.report_interval
+        while True:
+            message_ids = self.store.next_batch(purge)
+            if not message_ids:
+                break
+            try:
+                await self.delete(chat_id=chat_id, message_ids=message_ids)
+            except telegram.error.Forbidden as forbidden:
+                # The bot was removed or lost delete rights: nothing else
+                # in this chat is going to succeed.
+                error = str(forbidden)
+                break
+            except telegram.error.TelegramError as failure:
+                logger.error(f"Purge {purge_id} batch failed: {failure}")
+                self.store.complete_batch(
+                    purge_id, chat_id, thread_id, message_ids, deleted=False
+                )
+            else:
+                self.store.complete_batch(
+                    purge_id, chat_id, thread_id, message_ids, deleted=True
+                )
+            if time.monotonic() >= next_report_at:
+                next_report_at = time.monotonic() + self.report_interval
+                await self._report(purge_id)
+
+        self.store.finish(purge_id, error)
+        logger.info(f"Purge {purge_id} finished: {self.store.get(purge_id)}")
+        await self._report(purge_id)
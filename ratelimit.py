@@ -0,0 +1,139 @@
+import time
+from collections import OrderedDict
+
+
+class _Bucket:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+
+
+class _Window:
+    __slots__ = ("index", "previous", "current", "stamp")
+
+    def __init__(self, index, stamp):
+        self.index = index
+        self.previous = 0
+        self.current = 0
+        self.stamp = stamp
+
+
+class _KeyedLimiter:
+    # Per-key state lives in an OrderedDict kept in last-use order, so idle
+    # keys are always at the front and eviction is amortized O(1) per call.
+    def __init__(self, idle_ttl, clock):
+        self.idle_ttl = idle_ttl
+        self.clock = clock
+        self.state = OrderedDict()
+
+    def _touch(self, key, now):
+        self._evict(now)
+        entry = self.state.get(key)
+        if entry is not None:
+            self.state.move_to_end(key)
+        return entry
+
+    def _evict(self, now):
+        state = self.state
+        while state:
+            entry = state[next(iter(state))]
+            if now - entry.stamp <= self.idle_ttl:
+                break
+            state.popitem(last=False)
+
+    def __len__(self):
+        return len(self.state)
+
+
+class TokenBucket(_KeyedLimiter):
+    # `rate` tokens per second, bursts up to `capacity`. A bucket idle long
+    # enough to refill completely is indistinguishable from a new one, so it
+    # is evicted after capacity / rate seconds by default.
+    def __init__(self, rate, capacity, idle_ttl=None, clock=time.monotonic):
+        super().__init__(capacity / rate if idle_ttl is None else idle_ttl, clock)
+        self.rate = rate
+        self.capacity = capacity
+
+    def allow(self, key, cost=1):
+        return self.delay(key, cost) == 0
+
+    def delay(self, key, cost=1):
+        # Takes `cost` tokens and returns 0 if they are available, otherwise
+        # takes nothing and returns the seconds until they will be.
+        now = self.clock()
+        bucket = self._touch(key, now)
+        if bucket is None:
+            bucket = self.state[key] = _Bucket(self.capacity, now)
+        else:
+            bucket.tokens = min(
+                self.capacity, bucket.tokens + (now - bucket.stamp) * self.rate
+            )
+            bucket.stamp = now
+        if bucket.tokens >= cost:
+            bucket.tokens -= cost
+            return 0
+        return (cost - bucket.tokens) / self.rate
+
+    def refund(self, key, cost=1):
+        bucket = self.state.get(key)
+        if bucket is not None:
+            bucket.tokens = min(self.capacity, bucket.tokens + cost)
+
+
+class SlidingWindowCounter(_KeyedLimiter):
+    # At most `limit` requests per `window` seconds, estimated from the
+    # current and previous fixed windows (weighted by overlap). Keys idle for
+    # two windows carry no state worth keeping and are evicted.
+    def __init__(self, limit, window, idle_ttl=None, clock=time.monotonic):
+        super().__init__(2 * window if idle_ttl is None else idle_ttl, clock)
+        self.limit = limit
+        self.window = window
+
+    def allow(self, key, cost=1):
+        now = self.clock()
+        index, offset = divmod(now, self.window)
+        entry = self._touch(key, now)
+        if entry is None:
+            entry = self.state[key] = _Window(index, now)
+        elif entry.index != index:
+            entry.previous = entry.current if entry.index == index - 1 else 0
+            entry.current = 0
+            entry.index = index
+        entry.stamp = now
+
+        estimate = entry.previous * (1 - offset / self.window) + entry.current
+        if estimate + cost <= self.limit:
+            entry.current += cost
+            return True
+        return False
+
+    def refund(self, key, cost=1):
+        entry = self.state.get(key)
+        if entry is not None:
+            entry.current = max(0, entry.current - cost)
+
+
+class CompositeLimiter:
+    # Applies several named policies together, e.g. per-user, per-chat and
+    # global. A request is allowed only if every policy allows it; tokens
+    # taken from earlier policies are refunded when a later one refuses.
+    def __init__(self, policies):
+        self.policies = policies
+        self.rejected = dict.fromkeys(policies, 0)
+
+    def allow(self, keys, cost=1):
+        # `keys` maps policy name to the key to charge; policies without a
+        # key are skipped. Returns None if allowed, else the refusing policy.
+        charged = []
+        for name, limiter in self.policies.items():
+            if name not in keys:
+                continue
+            if not limiter.allow(keys[name], cost):
+                for charged_name in charged:
+                    self.policies[charged_name].refund(keys[charged_name], cost)
+                self.rejected[name] += 1
+                return name
+            charged.append(name)
+        return None
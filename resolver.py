@@ -0,0 +1,138 @@
+import re
+import unicodedata
+from collections import defaultdict
+
+GREEK_LETTERS = {"α": "alpha", "β": "beta", "γ": "gamma", "δ": "delta"}
+NOISE_PREFIXES = ("info on ", "info ", "about ", "what is ", "the ")
+# Separators and punctuation; letters of any script and digits are kept
+SEPARATORS = re.compile(r"[\W_]+")
+
+
+def canonicalize(name):
+    # "3-FL-PCP", "3fl-pcp" and " 3 fl pcp " all become "3flpcp"; "ЛСД"
+    # becomes "лсд". Names made only of punctuation become "".
+    name = unicodedata.normalize("NFKC", name).lower().strip()
+    for letter, spelled in GREEK_LETTERS.items():
+        name = name.replace(letter, spelled)
+    for prefix in NOISE_PREFIXES:
+        if name.startswith(prefix):
+            name = name[len(prefix) :]
+    return SEPARATORS.sub("", name)
+
+
+def within_typos(a, b, k, i=0, j=0):
+    # True if `a` is `b` with at most k typos. A typo is two adjacent letters
+    # swapped, or a letter doubled or a doubled letter dropped. Digits and
+    # letters are never substituted, inserted or removed otherwise: positional
+    # isomers and analogues ("3-fl-pcp", "4-fl-pcp", "3-cl-pcp") are one
+    # substitution apart. Branches at most 3 ** k times, cheap for k <= 2.
+    while i < len(a) and j < len(b) and a[i] == b[j]:
+        i += 1
+        j += 1
+    if i == len(a) and j == len(b):
+        return True
+    if k == 0:
+        return False
+    if (
+        i + 1 < len(a)
+        and j + 1 < len(b)
+        and a[i] == b[j + 1]
+        and a[i + 1] == b[j]
+        and a[i].isalpha()
+        and b[j].isalpha()
+        and within_typos(a, b, k - 1, i + 2, j + 2)
+    ):
+        return True
+    if i < len(a) and repeated(a, i) and within_typos(a, b, k - 1, i + 1, j):
+        return True
+    return j < len(b) and repeated(b, j) and within_typos(a, b, k - 1, i, j + 1)
+
+
+def repeated(text, i):
+    # A letter next to the same letter, which can be doubled or dropped
+    return text[i].isalpha() and (
+        (i > 0 and text[i - 1] == text[i]) or (i + 1 < len(text) and text[i + 1] == text[i])
+    )
+
+
+def typo_distance(a, b, limit):
+    # Number of typos between a and b, or limit + 1 if it is greater than `limit`.
+    if abs(len(a) - len(b)) > limit or not within_typos(a, b, limit):
+        return limit + 1
+    for distance in range(limit):
+        if within_typos(a, b, distance):
+            return distance
+    return limit
+
+
+class SubstanceResolver:
+    # Drop-in replacement for MultiKeyDict with canonicalized keys, and
+    # optional typo-tolerant lookup. Typos never change which characters a
+    # name contains, so aliases are indexed by their set of characters and a
+    # fuzzy lookup only compares the query with aliases sharing its set.
+    #
+    # Lookups are exact unless `fuzzy` is passed. Fuzzy matches only forgive
+    # typos as within_typos defines them, never for short names, and
+    # ambiguous best matches are rejected, so a digit or substituent that
+    # differs never turns one substance into another.
+    def __init__(self, min_fuzzy_length=6):
+        self.data = {}
+        self.key_map = defaultdict(list)
+        self.aliases = []
+        self.by_characters = defaultdict(list)
+        self.min_fuzzy_length = min_fuzzy_length
+
+    def add(self, keys, value):
+        for key in keys:
+            canonical = canonicalize(key)
+            if not canonical:
+                continue
+            if canonical not in self.data:
+                alias_id = len(self.aliases)
+                self.aliases.append(canonical)
+                self.by_characters[frozenset(canonical)].append(alias_id)
+            self.data[canonical] = value
+            self.key_map[value].append(key)
+
+    def max_distance(self, canonical):
+        if len(canonical) < self.min_fuzzy_length:
+            return 0
+        return 1 if len(canonical) < 10 else 2
+
+    def resolve(self, key, fuzzy=False):
+        # Returns (canonical alias, value, number of typos) or None.
+        canonical = canonicalize(key)
+        value = self.data.get(canonical)
+        if value is not None:
+            return canonical, value, 0
+        limit = self.max_distance(canonical) if fuzzy else 0
+        if not limit:
+            return None
+
+        length = len(canonical)
+        candidates = [
+            alias_id
+            for alias_id in self.by_characters.get(frozenset(canonical), ())
+            if abs(len(self.aliases[alias_id]) - length) <= limit
+        ]
+
+        best = None
+        best_distance = limit + 1
+        tied = False
+        for alias_id in candidates:
+            alias = self.aliases[alias_id]
+            distance = typo_distance(canonical, alias, limit)
+            if distance < best_distance:
+                best, best_distance, tied = alias, distance, False
+            elif distance == best_distance and best is not None:
+                tied = tied or self.data[alias] is not self.data[best]
+        if best is None or tied:
+            return None
+        return best, self.data[best], best_distance
+
+    def get(self, key, fuzzy=False):
+        match = self.resolve(key, fuzzy=fuzzy)
+        return match[1] if match else None
+
+    def __len__(self):
+        return len(self.data)
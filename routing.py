@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+
+class NoRoute(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Opens after `failures` consecutive failures and refuses calls for
+    # `cooldown` seconds. After that one probe call is let through: success
+    # closes the breaker, failure opens it for another cooldown.
+    def __init__(self, failures=5, cooldown=30, clock=time.monotonic):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.clock = clock
+        self.consecutive = 0
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or self.clock() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        # Claims the probe when half open, so call it only when about to call
+        state = self.state
+        if state == "half_open":
+            self.probing = True
+        return state != "open"
+
+    def release(self):
+        # A call that was abandoned without an outcome gives up the probe
+        self.probing = False
+
+    def record_success(self):
+        self.consecutive = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.consecutive += 1
+        if self.probing or self.consecutive >= self.failures:
+            if self.opened_at is None or self.probing:
+                self.trips += 1
+            self.opened_at = self.clock()
+            self.probing = False
+
+
+class LatencyWindow:
+    # The last `size` call latencies of a route, for percentiles.
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class Route:
+    # One model on one backend endpoint. `client` is a PsyAIClient.
+    def __init__(self, name, client, model, breaker=None, window=None):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.breaker = breaker or CircuitBreaker()
+        self.window = window or LatencyWindow()
+        self.outcomes = Counter()
+
+    def stats(self):
+        p50 = self.window.percentile(0.5)
+        p95 = self.window.percentile(0.95)
+        return {
+            "state": self.breaker.state,
+            "p50": round(p50, 3) if p50 is not None else None,
+            "p95": round(p95, 3) if p95 is not None else None,
+            **self.outcomes,
+        }
+
+
+class BackendRouter:
+    # Sends each question to the fastest healthy route serving the requested
+    # model, falling back to the other routes in order when it fails or its
+    # breaker is open. Once a call has run past its route's p95 latency, a
+    # hedge goes to the next route and whichever answers first wins; hedges
+    # are capped at `hedge_budget` of all calls so a slow backend isn't sent
+    # double the load. Routes with fewer than `min_samples` latencies are not
+    # hedged, and rank by their order in `routes`.
+    def __init__(
+        self, routes, hedge_percentile=0.95, hedge_budget=0.1, min_samples=20,
+        clock=time.monotonic,
+    ):
+        self.routes = routes
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.min_samples = min_samples
+        self.clock = clock
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _rank(self, routes):
+        def key(item):
+            index, route = item
+            if len(route.window) < self.min_samples:
+                return (0, index)
+            return (route.window.percentile(0.5), index)
+
+        return [route for _, route in sorted(enumerate(routes), key=key)]
+
+    def candidates(self, model):
+        # Routes serving `model` first, then the rest as fallbacks; routes
+        # with an open breaker are left out.
+        preferred = [route for route in self.routes if route.model == model]
+        others = [route for route in self.routes if route.model != model]
+        return [
+            route
+            for route in self._rank(preferred) + self._rank(others)
+            if route.breaker.state != "open"
+        ]
+
+    def _hedge_delay(self, route):
+        if len(route.window) < self.min_samples:
+            return None
+        if self.hedges >= self.hedge_budget * self.calls:
+            return None
+        return route.window.percentile(self.hedge_percentile)
+
+    async def _attempt(self, route, path, payload_for, params):
+        started = self.clock()
+        try:
+            result = await route.client.post_answer(
+                path, payload_for(route.model), params={**params, "model": route.model}
+            )
+        except asyncio.CancelledError:
+            # Lost a hedge race; says nothing about the route's health
+            route.breaker.release()
+            route.outcomes["cancelled"] += 1
+            raise
+        except Exception as error:
+            route.breaker.record_failure()
+            route.outcomes["failed"] += 1
+            logger.warning(f"Backend route {route.name} failed: {error!r}")
+            raise
+        route.breaker.record_success()
+        route.window.add(self.clock() - started)
+        route.outcomes["ok"] += 1
+        return result
+
+    async def post(self, path, payload_for, model, params=None):
+        # `payload_for(model)` builds the request body for a route's model.
+        # Returns the first answer; raises NoRoute, or the last route's error,
+        # when none answers.
+        self.calls += 1
+        params = params or {}
+        remaining = self.candidates(model)
+        running = {}
+        hedged = set()
+        error = NoRoute(f"no healthy backend route for {model}")
+
+        def launch():
+            while remaining:
+                route = remaining.pop(0)
+                if route.breaker.allow():
+                    task = asyncio.ensure_future(
+                        self._attempt(route, path, payload_for, params)
+                    )
+                    running[task] = route
+                    return task
+            return None
+
+        launch()
+        try:
+            while running:
+                delay = None
+                if len(running) == 1 and remaining:
+                    delay = self._hedge_delay(next(iter(running.values())))
+                done, _ = await asyncio.wait(
+                    running, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    task = launch()
+                    if task is not None:
+                        hedged.add(task)
+                        self.hedges += 1
+                    continue
+                for task in done:
+                    running.pop(task)
+                    if task.exception() is None:
+                        if task in hedged:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+                if not running:
+                    # Fall back to the next route right away
+                    launch()
+        finally:
+            for task in running:
+                task.cancel()
+        raise error
+
+    async def stream(self, path, payload_for, model, params=None):
+        # Streams from the best route for `model`. Streams aren't hedged, but
+        # a route that fails before its first delta is skipped for the next.
+        params = params or {}
+        error = NoRoute(f"no healthy backend route for {model}")
+        for route in self.candidates(model):
+            if not route.breaker.allow():
+                continue
+            started = False
+            try:
+                async for delta in route.client.stream(
+                    path, payload_for(route.model), params={**params, "model": route.model}
+                ):
+                    started = True
+                    yield delta
+            except asyncio.CancelledError:
+                route.breaker.release()
+                raise
+            except Exception as failure:
+                route.breaker.record_failure()
+                route.outcomes["failed"] += 1
+                logger.warning(f"Backend route {route.name} failed: {failure!r}")
+                if started:
+                    raise
+                error = failure
+                continue
+            route.breaker.record_success()
+            route.outcomes["ok"] += 1
+            return
+        raise error
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "routes": {route.name: route.stats() for route in self.routes},
+        }
@@ -0,0 +1,135 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+from collections import Counter, deque
+
+# Tiers, most important first
+PRIVILEGED = 0
+SUBSCRIBER = 1
+TRIAL = 2
+RESTRICTED = 3
+TIER_NAMES = ("privileged", "subscriber", "trial", "restricted")
+
+
+class Shed(Exception):
+    # A request dropped before it reached the backend. `reason` is
+    # "queue_full", "displaced" (pushed out of a full queue by a higher
+    # tier) or "deadline".
+    def __init__(self, tier, reason):
+        super().__init__(f"{TIER_NAMES[tier]} request shed: {reason}")
+        self.tier = tier
+        self.reason = reason
+
+
+class LLMScheduler:
+    # Caps concurrent backend calls at `max_concurrency`. Calls beyond it wait
+    # in one queue ordered by tier, then arrival, so a lower tier only gets a
+    # slot when no higher tier is waiting. At most `max_queue` calls wait: a
+    # full queue turns new calls away, unless they outrank the last waiter,
+    # which is shed instead. Waiters still queued after `deadline` seconds
+    # are shed too, since their user has given up by then.
+    def __init__(
+        self, max_concurrency=16, max_queue=200, deadline=90, clock=time.monotonic, samples=1000
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.clock = clock
+        self.active = 0
+        self.waiting = []  # heap of [tier, seq, future, enqueued_at]
+        self.sequence = itertools.count()
+        self.waits = [deque(maxlen=samples) for _ in TIER_NAMES]
+        self.admitted = Counter()
+        self.shed = Counter()  # (tier, reason) -> count
+
+    def position(self, entry):
+        # 1-based place in the queue
+        return 1 + sum(1 for other in self.waiting if other[:2] < entry[:2])
+
+    async def acquire(self, tier, on_queued=None, deadline=None):
+        # `on_queued(position)` is called, without awaiting, when the call
+        # has to wait.
+        if self.active < self.max_concurrency and not self.waiting:
+            self.active += 1
+            self._admit(tier, 0)
+            return
+
+        if len(self.waiting) >= self.max_queue:
+            last = max(self.waiting)
+            if last[0] <= tier:
+                self.shed[tier, "queue_full"] += 1
+                raise Shed(tier, "queue_full")
+            self._remove(last)
+            self.shed[last[0], "displaced"] += 1
+            last[2].set_exception(Shed(last[0], "displaced"))
+
+        future = asyncio.get_running_loop().create_future()
+        entry = [tier, next(self.sequence), future, self.clock()]
+        heapq.heappush(self.waiting, entry)
+        if on_queued is not None:
+            on_queued(self.position(entry))
+        try:
+            await asyncio.wait_for(future, self.deadline if deadline is None else deadline)
+        except BaseException as error:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Granted just as the caller gave up: pass the slot on
+                self.release()
+            else:
+                self._remove(entry)
+            if isinstance(error, asyncio.TimeoutError):
+                self.shed[tier, "deadline"] += 1
+                raise Shed(tier, "deadline") from None
+            raise
+
+    def release(self):
+        # Hands the slot straight to the best waiter, if there is one
+        while self.waiting:
+            tier, _, future, enqueued_at = heapq.heappop(self.waiting)
+            if future.done():
+                continue
+            self._admit(tier, self.clock() - enqueued_at)
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tier, on_queued=None, deadline=None):
+        await self.acquire(tier, on_queued, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run(self, tier, fn, *args, on_queued=None, deadline=None, **kwargs):
+        async with self.slot(tier, on_queued, deadline):
+            return await fn(*args, **kwargs)
+
+    def _remove(self, entry):
+        try:
+            self.waiting.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self.waiting)
+
+    def _admit(self, tier, waited):
+        self.admitted[tier] += 1
+        self.waits[tier].append(waited)
+
+    def stats(self):
+        tiers = {}
+        for tier, name in enumerate(TIER_NAMES):
+            waits = sorted(self.waits[tier])
+            shed = {
+                reason: count for (shed_tier, reason), count in self.shed.items()
+                if shed_tier == tier
+            }
+            tiers[name] = {
+                "admitted": self.admitted[tier],
+                "shed": shed,
+                "wait_p50": round(waits[len(waits) // 2], 3) if waits else 0,
+                "wait_p95": round(waits[int(len(waits) * 0.95)], 3) if waits else 0,
+                "wait_max": round(waits[-1], 3) if waits else 0,
+            }
+        return {"active": self.active, "queued": len(self.waiting), "tiers": tiers}
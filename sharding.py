@@ -0,0 +1,274 @@
+import asyncio
+import contextvars
+import logging
+import multiprocessing
+import queue
+import signal
+import telegram
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from outbox import retry_after_seconds
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+# Ends the running update's turn in its chat, see ChatOrderedProcessor
+_chat_turn = contextvars.ContextVar("chat_turn", default=None)
+
+
+def chat_key(data):
+    # The chat an update (as the raw Bot API dict) belongs to, falling back
+    # to the sender for updates without one, e.g. inline queries.
+    for field, value in data.items():
+        if field == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat is not None:
+            return chat["id"]
+        user = value.get("from") or value.get("user")
+        if user is not None:
+            return user["id"]
+    return 0
+
+
+def shard_for(key, count):
+    return key % count
+
+
+class ShardRouter:
+    # Ingest side of multi-process mode. Starts `count` worker processes,
+    # each running `target(index, count, inbox, control, *args)`, and routes
+    # every update to the worker that owns its chat, so a chat's updates are
+    # always handled by the same process in the order they arrived. Workers
+    # put control messages meant for all of them on `control`; relay_control
+    # broadcasts them.
+    def __init__(self, target, count, args=(), start_method="spawn"):
+        self.target = target
+        self.count = count
+        self.args = args
+        self.context = multiprocessing.get_context(start_method)
+        self.control = self.context.Queue()
+        self.inboxes = []
+        self.processes = []
+        self.routed = [0] * count
+
+    def start(self):
+        for index in range(self.count):
+            inbox = self.context.Queue()
+            process = self.context.Process(
+                target=self.target,
+                args=(index, self.count, inbox, self.control, *self.args),
+                name=f"psyai-shard-{index}",
+                daemon=False,
+            )
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        logger.info(f"Started {self.count} shard workers")
+
+    def dispatch(self, data):
+        index = shard_for(chat_key(data), self.count)
+        self.routed[index] += 1
+        self.inboxes[index].put(data)
+
+    async def deliver(self, data):
+        # For WebhookServer.add_telegram.
+        self.dispatch(data)
+
+    def broadcast(self, message):
+        # Control messages, e.g. cache invalidations, go to every worker.
+        for inbox in self.inboxes:
+            inbox.put(message)
+
+    def stop(self, timeout=30):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop; terminating")
+                process.terminate()
+
+
+async def relay_control(router):
+    # Broadcasts what workers put on router.control, e.g. an admin command
+    # that has to reach the caches in every process.
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            message = await loop.run_in_executor(None, router.control.get, True, 1)
+        except queue.Empty:
+            continue
+        router.broadcast(message)
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    # Concurrent updates for the application, except that one chat's
+    # updates start in the order they arrived: each waits for the previous
+    # one to finish or to call release_chat_turn(), which handlers do once
+    # admission is done and only backend calls and replies are left (the
+    # outbox keeps a chat's sends in order). Updates waiting for their turn
+    # don't hold one of the `max_concurrent_updates` slots.
+    def __init__(self, max_concurrent_updates=256):
+        super().__init__(max_concurrent_updates)
+        self.chats = {}  # chat id -> [lock, updates holding or awaiting it]
+
+    async def process_update(self, update, coroutine):
+        key = None
+        if isinstance(update, Update):
+            chat = update.effective_chat or update.effective_user
+            key = chat and chat.id
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self.chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._leave(key, entry)
+            raise
+        held = True
+
+        def release():
+            nonlocal held
+            if held:
+                held = False
+                entry[0].release()
+                self._leave(key, entry)
+
+        token = _chat_turn.set(release)
+        try:
+            await super().process_update(update, coroutine)
+        finally:
+            _chat_turn.reset(token)
+            release()
+
+    def _leave(self, key, entry):
+        entry[1] -= 1
+        if not entry[1]:
+            del self.chats[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def release_chat_turn():
+    # Lets the next update in this chat start while the running one goes
+    # on. Does nothing outside ChatOrderedProcessor or when called twice.
+    release = _chat_turn.get()
+    if release is not None:
+        release()
+
+
+class EntitlementFanout:
+    # Stands in for EntitlementCache in the ingest process: subscription
+    # changes are forwarded to the cache in every worker.
+    def __init__(self, router):
+        self.router = router
+
+    def update(self, telegram_id, **fields):
+        self.router.broadcast(
+            {"control": "entitlement", "telegram_id": telegram_id, "fields": fields}
+        )
+
+
+async def run_ingest(
+    bot,
+    router,
+    server,
+    webhook_url=None,
+    secret_token=None,
+    max_connections=40,
+    poll_timeout=30,
+):
+    # Receives updates for the whole bot, by webhook when `webhook_url` is
+    # set and by long polling otherwise, and hands them to the router.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    async with bot:
+        await server.start()
+        relay = loop.create_task(relay_control(router))
+        try:
+            if webhook_url:
+                await bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=secret_token,
+                    allowed_updates=Update.ALL_TYPES,
+                    max_connections=max_connections,
+                )
+                logger.info(f"Receiving updates at {webhook_url}")
+                await stop.wait()
+            else:
+                await bot.delete_webhook()
+                await _poll(bot, router, stop, poll_timeout)
+        finally:
+            relay.cancel()
+            await server.stop()
+            await asyncio.to_thread(router.stop)
+
+
+async def _poll(bot, router, stop, poll_timeout):
+    offset = None
+    stopped = asyncio.ensure_future(stop.wait())
+    while not stop.is_set():
+        fetch = asyncio.ensure_future(
+            bot.get_updates(
+                offset=offset,
+                timeout=poll_timeout,
+                allowed_updates=Update.ALL_TYPES,
+                read_timeout=poll_timeout + 10,
+            )
+        )
+        await asyncio.wait({fetch, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        if not fetch.done():
+            fetch.cancel()
+            break
+        try:
+            updates = fetch.result()
+        except telegram.error.RetryAfter as error:
+            await asyncio.sleep(retry_after_seconds(error))
+            continue
+        except telegram.error.TelegramError as error:
+            logger.error(f"Error fetching updates: {error}")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            router.dispatch(update.to_dict())
+            offset = update.update_id + 1
+    stopped.cancel()
+
+
+async def serve_shard(application, inbox, on_startup, on_shutdown, on_control):
+    # Worker side: runs the application's handlers on the updates routed to
+    # this shard. The ingest process owns shutdown and sends None to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.get_running_loop()
+    async with application:
+        await on_startup(application)
+        await application.start()
+        try:
+            while True:
+                try:
+                    item = await loop.run_in_executor(None, inbox.get, True, 1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    break
+                if "control" in item:
+                    on_control(item)
+                else:
+                    await application.update_queue.put(
+                        Update.de_json(item, application.bot)
+                    )
+        finally:
+            await application.stop()
+            await on_shutdown(application)
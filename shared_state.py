@@ -0,0 +1,223 @@
+import sqlite3
+import time
+
+
+class SqliteState:
+    # Counters shared by every worker process on one host: rate-limit
+    # buckets and windows, and trial balances. Each operation is a single
+    # IMMEDIATE transaction, so a read-modify-write is atomic across
+    # processes. Pass it as TrialLedger's `balances` and wrap it in
+    # SharedTokenBucket / SharedSlidingWindowCounter for CompositeLimiter.
+    # Flushed balances are kept for `hold` seconds, the entitlement cache
+    # TTL, so no worker reseeds a user from a cached row older than the flush.
+    def __init__(self, path, clock=time.time, cleanup_every=10000, hold=300):
+        # Wall clock, not monotonic: stamps are compared across processes.
+        self.clock = clock
+        self.cleanup_every = cleanup_every
+        self.hold = hold
+        self.operations = 0
+        self.db = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False, timeout=30
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " name TEXT NOT NULL, key TEXT NOT NULL,"
+            " tokens REAL NOT NULL, stamp REAL NOT NULL, idle_ttl REAL NOT NULL,"
+            " PRIMARY KEY (name, key)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS windows ("
+            " name TEXT NOT NULL, key TEXT NOT NULL,"
+            " idx INTEGER NOT NULL, previous INTEGER NOT NULL,"
+            " current INTEGER NOT NULL, stamp REAL NOT NULL, idle_ttl REAL NOT NULL,"
+            " PRIMARY KEY (name, key)) WITHOUT ROWID;"
+            "CREATE TABLE IF NOT EXISTS trial_balances ("
+            " telegram_id INTEGER PRIMARY KEY,"
+            " balance INTEGER NOT NULL,"
+            " pending INTEGER NOT NULL DEFAULT 0,"
+            " flushed_at REAL);"
+        )
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(trial_balances)")]
+        if "flushed_at" not in columns:
+            self.db.execute("ALTER TABLE trial_balances ADD COLUMN flushed_at REAL")
+
+    def _transaction(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        self.operations += 1
+        if self.operations % self.cleanup_every == 0:
+            now = self.clock()
+            for table in ("buckets", "windows"):
+                self.db.execute(
+                    f"DELETE FROM {table} WHERE stamp + idle_ttl < ?", (now,)
+                )
+            self.db.execute(
+                "DELETE FROM trial_balances WHERE pending = 0 AND flushed_at < ?",
+                (now - self.hold,),
+            )
+        return self.db
+
+    def reset_run(self):
+        # Called once before workers start: limiter state may carry over, but
+        # balances without unwritten decrements are reread from the database,
+        # so an admin's changes made while the bot was down still apply.
+        self.db.execute("DELETE FROM trial_balances WHERE pending = 0")
+
+    # Token buckets
+
+    def bucket_delay(self, name, key, rate, capacity, idle_ttl, cost=1):
+        key = str(key)
+        with self._transaction() as db:
+            now = self.clock()
+            row = db.execute(
+                "SELECT tokens, stamp FROM buckets WHERE name = ? AND key = ?",
+                (name, key),
+            ).fetchone()
+            if row is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, row[0] + (now - row[1]) * rate)
+            delay = 0 if tokens >= cost else (cost - tokens) / rate
+            if delay == 0:
+                tokens -= cost
+            db.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+                (name, key, tokens, now, idle_ttl),
+            )
+        return delay
+
+    def bucket_refund(self, name, key, capacity, cost=1):
+        self.db.execute(
+            "UPDATE buckets SET tokens = MIN(?, tokens + ?) WHERE name = ? AND key = ?",
+            (capacity, cost, name, str(key)),
+        )
+
+    # Sliding windows
+
+    def window_allow(self, name, key, limit, window, idle_ttl, cost=1):
+        key = str(key)
+        with self._transaction() as db:
+            now = self.clock()
+            index, offset = divmod(now, window)
+            index = int(index)
+            row = db.execute(
+                "SELECT idx, previous, current FROM windows WHERE name = ? AND key = ?",
+                (name, key),
+            ).fetchone()
+            if row is None:
+                previous = current = 0
+            elif row[0] != index:
+                previous = row[2] if row[0] == index - 1 else 0
+                current = 0
+            else:
+                previous, current = row[1], row[2]
+            estimate = previous * (1 - offset / window) + current
+            allowed = estimate + cost <= limit
+            if allowed:
+                current += cost
+            db.execute(
+                "INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (name, key, index, previous, current, now, idle_ttl),
+            )
+        return allowed
+
+    def window_refund(self, name, key, cost=1):
+        self.db.execute(
+            "UPDATE windows SET current = MAX(0, current - ?) WHERE name = ? AND key = ?",
+            (cost, name, str(key)),
+        )
+
+    # Trial balances, with the same interface as ledger.LocalBalances
+
+    def consume(self, telegram_id, known_balance):
+        with self._transaction() as db:
+            # A flushed row is only reseeded once every worker's cache of the
+            # user has expired and been reread from the database
+            row = db.execute(
+                "SELECT balance FROM trial_balances WHERE telegram_id = ?"
+                " AND (pending > 0 OR flushed_at IS NULL OR flushed_at > ?)",
+                (telegram_id, self.clock() - self.hold),
+            ).fetchone()
+            remaining = known_balance if row is None else row[0]
+            if remaining <= 0:
+                return None
+            db.execute(
+                "INSERT INTO trial_balances VALUES (?, ?, 1, NULL)"
+                " ON CONFLICT (telegram_id) DO UPDATE"
+                " SET balance = excluded.balance, pending = pending + 1",
+                (telegram_id, remaining - 1),
+            )
+        return remaining - 1
+
+    def reset(self, telegram_id):
+        self.db.execute(
+            "DELETE FROM trial_balances WHERE telegram_id = ? AND pending = 0",
+            (telegram_id,),
+        )
+
+    def take_pending(self):
+        with self._transaction() as db:
+            pending = dict(
+                db.execute(
+                    "SELECT telegram_id, pending FROM trial_balances WHERE pending > 0"
+                )
+            )
+            db.execute(
+                "UPDATE trial_balances SET pending = 0, flushed_at = NULL WHERE pending > 0"
+            )
+        return pending
+
+    def restore_pending(self, pending):
+        self.db.executemany(
+            "UPDATE trial_balances SET pending = pending + ? WHERE telegram_id = ?",
+            [(amount, telegram_id) for telegram_id, amount in pending.items()],
+        )
+
+    def forget(self, telegram_ids):
+        # Rows are dropped `hold` seconds later, on cleanup
+        now = self.clock()
+        self.db.executemany(
+            "UPDATE trial_balances SET flushed_at = ? WHERE telegram_id = ? AND pending = 0",
+            [(now, telegram_id) for telegram_id in telegram_ids],
+        )
+
+    def close(self):
+        self.db.close()
+
+
+class SharedTokenBucket:
+    # ratelimit.TokenBucket over a shared state backend.
+    def __init__(self, state, name, rate, capacity, idle_ttl=None):
+        self.state = state
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.idle_ttl = capacity / rate if idle_ttl is None else idle_ttl
+
+    def allow(self, key, cost=1):
+        return self.delay(key, cost) == 0
+
+    def delay(self, key, cost=1):
+        return self.state.bucket_delay(
+            self.name, key, self.rate, self.capacity, self.idle_ttl, cost
+        )
+
+    def refund(self, key, cost=1):
+        self.state.bucket_refund(self.name, key, self.capacity, cost)
+
+
+class SharedSlidingWindowCounter:
+    # ratelimit.SlidingWindowCounter over a shared state backend.
+    def __init__(self, state, name, limit, window, idle_ttl=None):
+        self.state = state
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.idle_ttl = 2 * window if idle_ttl is None else idle_ttl
+
+    def allow(self, key, cost=1):
+        return self.state.window_allow(
+            self.name, key, self.limit, self.window, self.idle_ttl, cost
+        )
+
+    def refund(self, key, cost=1):
+        self.state.window_refund(self.name, key, cost)
@@ -0,0 +1,30 @@
+import asyncio
+
+
+class SingleFlight:
+    # Collapses concurrent calls with the same key into one in-flight call.
+    # Every caller gets the shared result; `calls` counts the underlying
+    # calls made and `shared` counts the calls saved.
+    def __init__(self):
+        self.inflight = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        task = self.inflight.get(key)
+        if task is not None:
+            self.shared += 1
+            return await asyncio.shield(task)
+
+        self.calls += 1
+        task = asyncio.ensure_future(fn(*args, **kwargs))
+        self.inflight[key] = task
+        task.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "inflight": len(self.inflight),
+        }
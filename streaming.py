@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+import telegram
+from formatters import utf16_length, utf16_prefix
+from outbox import retry_after_seconds
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+
+class StreamingReply:
+    # Progressively edits the "thinking" message while an answer streams in.
+    # Edits are throttled to one per `min_interval` seconds per reply, and
+    # once the text outgrows `max_length` UTF-16 code units, as Telegram
+    # counts them, the current message is frozen and a new one is started. `finish` re-renders the complete answer with the
+    # final formatting across however many messages are needed.
+    def __init__(
+        self,
+        bot,
+        message,
+        message_thread_id=None,
+        reply_to_message_id=None,
+        min_interval=1.5,
+        max_length=4000,
+        clock=time.monotonic,
+    ):
+        self.bot = bot
+        self.chat_id = message.chat_id
+        self.messages = [message]
+        self.message_thread_id = message_thread_id
+        self.reply_to_message_id = reply_to_message_id
+        self.min_interval = min_interval
+        self.max_length = max_length
+        self.clock = clock
+        self.text = ""
+        self.offset = 0  # where the current (last) message's text starts
+        self.shown = ""
+        self.next_edit_at = 0.0
+        self.edits = 0
+
+    async def feed(self, delta):
+        self.text += delta
+        if self._overflows():
+            await self._rollover()
+        if self.clock() >= self.next_edit_at:
+            await self._edit(self.messages[-1], self.text[self.offset :])
+
+    def _overflows(self):
+        # A character is at most two code units, so short text can't overflow
+        length = len(self.text) - self.offset
+        return length > self.max_length // 2 and (
+            utf16_length(self.text[self.offset :]) > self.max_length
+        )
+
+    async def _rollover(self):
+        while self._overflows():
+            end = self.offset + len(utf16_prefix(self.text[self.offset :], self.max_length))
+            cut = self.text.rfind("\n", self.offset, end)
+            if cut <= self.offset:
+                cut = end
+            await self._edit(self.messages[-1], self.text[self.offset : cut], force=True)
+            self.offset = cut
+            self.shown = ""
+            self.messages.append(
+                await self.bot.send_message(
+                    chat_id=self.chat_id,
+                    text=utf16_prefix(self.text[self.offset :], self.max_length) or "…",
+                    message_thread_id=self.message_thread_id,
+                    reply_to_message_id=self.reply_to_message_id,
+                    disable_web_page_preview=True,
+                )
+            )
+
+    async def _edit(self, message, text, force=False, parse_mode=None):
+        if not text.strip() or (text == self.shown and not force):
+            return
+        while True:
+            try:
+                await self.bot.edit_message_text(
+                    text=text,
+                    chat_id=self.chat_id,
+                    message_id=message.message_id,
+                    parse_mode=parse_mode,
+                    disable_web_page_preview=True,
+                )
+                break
+            except telegram.error.RetryAfter as error:
+                retry_after = retry_after_seconds(error)
+                if not force:
+                    self.next_edit_at = self.clock() + retry_after
+                    return
+                await asyncio.sleep(retry_after)
+            except telegram.error.BadRequest as error:
+                if "not modified" not in str(error).lower():
+                    raise
+                break
+        self.edits += 1
+        self.shown = text
+        self.next_edit_at = self.clock() + self.min_interval
+
+    async def finish(self, chunks, parse_mode=telegram.constants.ParseMode.HTML):
+        # `chunks` is the fully formatted answer, already split to fit.
+        for index, chunk in enumerate(chunks):
+            if index < len(self.messages):
+                await self._edit(
+                    self.messages[index], chunk, force=True, parse_mode=parse_mode
+                )
+            else:
+                self.messages.append(
+                    await self.bot.send_message(
+                        chat_id=self.chat_id,
+                        text=chunk,
+                        parse_mode=parse_mode,
+                        message_thread_id=self.message_thread_id,
+                        reply_to_message_id=self.reply_to_message_id,
+                        disable_web_page_preview=True,
+                    )
+                )
+        for message in self.messages[len(chunks) :]:
+            try:
+                await self.bot.delete_message(
+                    chat_id=self.chat_id, message_id=message.message_id
+                )
+            except telegram.error.BadRequest:
+                logger.warning("Failed to delete surplus streaming message")
+        del self.messages[len(chunks) :]
@@ -1,25 +1,5 @@
 from collections import defaultdict
-from datetime import datetime, timedelta
-
-
-class RateLimiter:
-    def __init__(self, max_requests, window_size):
-        self.requests = {}
-        self.max_requests = max_requests
-        self.window_size = window_size
-
-    def allow_request(self, key):
-        current_time = datetime.now()
-        if key not in self.requests:
-            self.requests[key] = []
-        self.requests[key] = [
-            t for t in self.requests[key] if t > current_time - self.window_size
-        ]
-
-        if len(self.requests[key]) < self.max_requests:
-            self.requests[key].append(current_time)
-            return True
-        return False
+from datetime import datetime
 
 
 def calc_downtime():
@@ -0,0 +1,206 @@
+import asyncio
+import hmac
+import logging
+import signal
+from collections import Counter, OrderedDict
+import stripe
+from aiohttp import web
+from telegram import Update
+
+logger = logging.getLogger("PsyAI Log 🤖")
+
+# Subscription statuses that keep a user entitled.
+ACTIVE_STATUSES = {"active", "trialing"}
+
+SUBSCRIPTION_EVENTS = {
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+}
+
+
+class StripeEvents:
+    # Applies Stripe subscription events to user_association and to the
+    # in-process entitlement cache, so a subscriber is unlocked (or locked
+    # out) as soon as Stripe says so instead of when the cache expires.
+    # `persist(telegram_id, fields)` and `lookup_customer(customer_id)` are
+    # coroutine functions over the database.
+    def __init__(self, entitlements, persist, lookup_customer, remember=10000):
+        self.entitlements = entitlements
+        self.persist = persist
+        self.lookup_customer = lookup_customer
+        self.remember = remember
+        self.seen = OrderedDict()  # event ids already applied
+        self.latest = {}  # telegram_id -> created time of the last applied event
+        self.counts = Counter()
+
+    async def _telegram_id(self, obj):
+        telegram_id = (obj.get("metadata") or {}).get("telegram_id")
+        if telegram_id is None and obj.get("customer"):
+            telegram_id = await self.lookup_customer(obj["customer"])
+        return int(telegram_id) if telegram_id is not None else None
+
+    async def handle(self, event):
+        # Returns what happened to the event; raises if it could not be
+        # stored, so the endpoint answers with an error and Stripe retries.
+        if event["id"] in self.seen:
+            self.counts["duplicate"] += 1
+            return "duplicate"
+
+        kind = event["type"]
+        obj = event["data"]["object"]
+        if kind == "checkout.session.completed" and obj.get("mode") == "subscription":
+            active = True
+        elif kind in SUBSCRIPTION_EVENTS:
+            active = (
+                kind != "customer.subscription.deleted"
+                and obj.get("status") in ACTIVE_STATUSES
+            )
+        else:
+            self.counts["ignored"] += 1
+            return "ignored"
+
+        telegram_id = await self._telegram_id(obj)
+        if telegram_id is None:
+            logger.warning(f"Stripe event {event['id']} has no known Telegram user")
+            self.counts["unmatched"] += 1
+            return "unmatched"
+
+        # Stripe doesn't guarantee delivery order; an older event must not
+        # undo a newer one.
+        if event["created"] < self.latest.get(telegram_id, 0):
+            self.counts["stale"] += 1
+            return "stale"
+
+        fields = {"subscription_status": active}
+        if obj.get("customer"):
+            fields["stripe_id"] = obj["customer"]
+        await self.persist(telegram_id, fields)
+        self.entitlements.update(telegram_id, **fields)
+
+        self.latest[telegram_id] = event["created"]
+        self.seen[event["id"]] = True
+        while len(self.seen) > self.remember:
+            self.seen.popitem(last=False)
+        self.counts["applied"] += 1
+        logger.info(f"Stripe {kind}: user {telegram_id} subscribed={active}")
+        return "applied"
+
+
+def application_inbox(application):
+    async def deliver(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    return deliver
+
+
+class WebhookServer:
+    # One aiohttp server for everything pushed to the bot: Telegram updates
+    # in webhook mode and Stripe events; also serves /metrics. Routes are
+    # added before start().
+    def __init__(self, host="0.0.0.0", port=8080):
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self.runner = None
+        self.routes = 0
+        self.received = Counter()
+
+    def add_telegram(self, path, deliver, secret_token):
+        # `deliver` is a coroutine function taking the update as the raw
+        # Bot API dict, e.g. application_inbox(application).
+        async def receive_update(request):
+            header = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(header, secret_token):
+                self.received["telegram_forbidden"] += 1
+                return web.Response(status=403)
+            try:
+                data = await request.json()
+                if not isinstance(data, dict) or "update_id" not in data:
+                    raise ValueError("not an update")
+            except ValueError as error:
+                logger.warning(f"Malformed Telegram update: {error}")
+                self.received["telegram_malformed"] += 1
+                return web.Response(status=400)
+            # Acknowledge right away; handlers run from the update queue.
+            await deliver(data)
+            self.received["telegram"] += 1
+            return web.Response()
+
+        self.app.router.add_post(path, receive_update)
+        self.routes += 1
+
+    def add_stripe(self, path, events, endpoint_secret):
+        async def receive_event(request):
+            payload = await request.read()
+            try:
+                event = stripe.Webhook.construct_event(
+                    payload, request.headers.get("Stripe-Signature", ""), endpoint_secret
+                )
+            except (ValueError, stripe.error.SignatureVerificationError) as error:
+                logger.warning(f"Rejected Stripe webhook: {error}")
+                self.received["stripe_rejected"] += 1
+                return web.Response(status=400)
+            try:
+                outcome = await events.handle(event)
+            except Exception as error:
+                logger.error(f"Error applying Stripe event {event['id']}: {error}")
+                self.received["stripe_failed"] += 1
+                return web.Response(status=500)
+            self.received["stripe"] += 1
+            return web.json_response({"outcome": outcome})
+
+        self.app.router.add_post(path, receive_event)
+        self.routes += 1
+
+    def add_metrics(self, path, registry):
+        async def serve_metrics(request):
+            return web.Response(
+                body=registry.render().encode(),
+                headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+            )
+
+        self.app.router.add_get(path, serve_metrics)
+        self.routes += 1
+
+    async def start(self):
+        if self.runner is not None or not self.routes:
+            return
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Webhook server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+async def serve_webhook(
+    application, url, secret_token, on_startup, on_shutdown, max_connections=40
+):
+    # Runs the bot off webhooks instead of run_polling(): Telegram pushes
+    # updates to `url`, and the lifecycle hooks run_polling() would call
+    # (which start and stop the WebhookServer) are called here too. Returns
+    # once the process is asked to stop.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    async with application:
+        await on_startup(application)
+        await application.start()
+        await application.bot.set_webhook(
+            url=url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=max_connections,
+        )
+        logger.info(f"Receiving updates at {url}")
+        try:
+            await stop.wait()
+        finally:
+            await application.stop()
+            await on_shutdown(application)